@@ -0,0 +1,3 @@
+from harness import *
+from dataset import *
+from suite import *
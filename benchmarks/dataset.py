@@ -0,0 +1,26 @@
+import random
+
+"""
+Synthetic datasets. These write straight to the DB, so setting up a big
+network doesn't take longer than the benchmark itself.
+"""
+
+def generate(env, lists, members, first_shortcode=2000, owner="12345", seed=0):
+    """ Create lists lists, each owned by owner and with members members
+    (including the owner). Member numbers are random but reproducible for a
+    given seed. Returns the shortcodes created. """
+    rng = random.Random(seed)
+    conf = env.conf
+    db = env.db
+    shortcodes = [str(first_shortcode + i) for i in xrange(lists)]
+    db.executemany("INSERT INTO %s VALUES (?,?,?)" % conf.t_list,
+                   ((sc, 0, 1) for sc in shortcodes))
+    db.executemany("INSERT INTO %s(list, owner) VALUES (?,?)" % conf.t_owner,
+                   ((sc, owner) for sc in shortcodes))
+    for sc in shortcodes:
+        numbers = [owner] + [str(n) for n in rng.sample(xrange(100000, 10000000), members - 1)]
+        db.executemany("INSERT INTO %s(list, member) VALUES (?,?)" % conf.t_membership,
+                       ((sc, n) for n in numbers))
+    db.commit()
+    env.app.list_cache.invalidate()
+    return shortcodes
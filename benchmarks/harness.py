@@ -0,0 +1,89 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import yaml
+
+import smswall
+
+"""
+Plumbing for in-process benchmarks: a throwaway DB and SMSWall per benchmark,
+a Sender that only counts, and a timer.
+"""
+
+default_config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "..", "conf", "smswall.yaml")
+
+class CountingSender(smswall.Sender):
+    """ Counts what would have been sent, and nothing else, so benchmarks
+    measure smswall rather than log formatting or a switch. """
+
+    name = "bench"
+
+    def __init__(self):
+        self.messages = 0
+        self.calls = 0
+
+    def send_sms(self, sender, recipient, subject, data):
+        self.messages += 1
+        self.calls += 1
+
+    def send_bulk(self, sender, recipients, subject, data):
+        for r in recipients:
+            self.messages += 1
+        self.calls += 1
+
+class BenchEnv:
+    """ A temporary smswall DB with an SMSWall in front of it. Settings
+    override the ones in the config file. """
+
+    def __init__(self, config_file=None, **settings):
+        config_file = config_file or default_config_file
+        self.dir = tempfile.mkdtemp(prefix="smswall-bench-")
+        f = open(config_file, "r")
+        config_dict = yaml.safe_load(f.read())
+        f.close()
+        config_dict["db_file"] = os.path.join(self.dir, "smswall.sqlite3")
+        config_dict.update(settings)
+
+        log = logging.getLogger("smswall.bench")
+        if not log.handlers:
+            log.addHandler(logging.NullHandler())
+        log.propagate = False
+        self.conf = smswall.Config(config_dict, log)
+        self.app = smswall.SMSWall(self.conf)
+        self.sender = CountingSender()
+        self.app.set_sender(self.sender)
+
+    @property
+    def db(self):
+        return self.app.db
+
+    def message(self, sender, recipient, body):
+        """ Handle an incoming message, as if it came from the switch. """
+        self.app.handle_incoming(smswall.Message(str(sender), str(recipient), None, body))
+
+    def close(self):
+        self.app.stop_workers()
+        self.app.db.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def timed(func, iterations):
+    """ Call func(i) for i in range(iterations) and return timing stats, in
+    seconds. """
+    samples = []
+    clock = time.time
+    for i in xrange(iterations):
+        t = clock()
+        func(i)
+        samples.append(clock() - t)
+    samples.sort()
+    total = sum(samples)
+    return {"iterations": iterations,
+            "total": total,
+            "mean": total / iterations if iterations else 0.0,
+            "min": samples[0] if samples else 0.0,
+            "median": samples[len(samples) / 2] if samples else 0.0,
+            "p95": samples[int(len(samples) * 0.95)] if samples else 0.0,
+            "max": samples[-1] if samples else 0.0}
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import time
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from benchmarks.suite import *
+
+"""
+Runs the in-process benchmark suite and writes the results as JSON, so runs
+from different releases can be compared. From the top of the tree:
+
+    python benchmarks/run.py -o results.json
+"""
+
+parser = argparse.ArgumentParser(description="In-process smswall benchmarks.")
+parser.add_argument('--output', '-o', action='store', dest='output', \
+                    help="Write JSON results here (default: stdout).")
+parser.add_argument('--only', action='append', dest='only', \
+                    help="Only run the named benchmark (may be repeated).")
+parser.add_argument('--config', '-c', action='store', dest='config', \
+                    help="Base config file (default: conf/smswall.yaml).")
+parser.add_argument('--set', action='append', dest='settings', default=[], \
+                    help="Override a config setting, e.g. --set db_profile=safe.")
+parser.add_argument('--list', action='store_true', dest='list', \
+                    help="List the benchmarks and exit.")
+args = parser.parse_args()
+
+if args.list:
+    for name, func, kwargs in default_suite:
+        print "%-20s %s" % (name, func.__doc__.strip().split("\n")[0])
+    exit()
+
+settings = {}
+for s in args.settings:
+    key, value = s.split("=", 1)
+    settings[key] = yaml.safe_load(value)
+if args.config:
+    settings["config_file"] = args.config
+
+results = {}
+for name, func, kwargs in default_suite:
+    if args.only and not name in args.only:
+        continue
+    sys.stderr.write("Running %s...\n" % name)
+    kwargs = dict(kwargs)
+    kwargs.update(settings)
+    results[name] = func(**kwargs)
+
+report = {"timestamp": time.time(),
+          "python": platform.python_version(),
+          "sqlite": sqlite3.sqlite_version,
+          "settings": settings,
+          "results": results}
+
+out = json.dumps(report, indent=2, sort_keys=True)
+if args.output:
+    f = open(args.output, "w")
+    f.write(out + "\n")
+    f.close()
+else:
+    print out
@@ -0,0 +1,131 @@
+import smswall
+
+from harness import *
+from dataset import *
+
+"""
+The benchmarks. Each one sets up its own BenchEnv, times one thing, and
+returns a dict of results; run.py collects them into JSON.
+"""
+
+def bench_create_lists(num=100, **settings):
+    """ 'create' sent to the app number. """
+    env = BenchEnv(**settings)
+    try:
+        r = timed(lambda i: env.message("1234", env.conf.app_number, "create %d" % (3000 + i)), num)
+    finally:
+        env.close()
+    return r
+
+def bench_joins(num=1000, **settings):
+    """ 'join' to one list from num different numbers. """
+    env = BenchEnv(**settings)
+    try:
+        env.message("1234", env.conf.app_number, "create 1500")
+        r = timed(lambda i: env.message(str(10000 + i), "1500", "join"), num)
+    finally:
+        env.close()
+    return r
+
+def bench_posts(members=100, posts=100, **settings):
+    """ Posts to a single list with members members. """
+    env = BenchEnv(**settings)
+    try:
+        sc = generate(env, 1, members)[0]
+        env.sender.messages = 0
+        r = timed(lambda i: env.message("12345", sc, "testmessage"), posts)
+        r["members"] = members
+        r["sent"] = env.sender.messages
+        r["per_recipient"] = r["mean"] / max(members - 1, 1)
+    finally:
+        env.close()
+    return r
+
+def bench_posts_many_lists(lists=100, members=3, **settings):
+    """ One post to each of lists lists with members members. """
+    env = BenchEnv(**settings)
+    try:
+        shortcodes = generate(env, lists, members)
+        r = timed(lambda i: env.message("12345", shortcodes[i], "testmessage"), lists)
+        r["lists"] = lists
+        r["members"] = members
+    finally:
+        env.close()
+    return r
+
+def bench_dispatch(num=1000, **settings):
+    """ Command parsing and dispatch alone ('help' to the app number). """
+    env = BenchEnv(**settings)
+    try:
+        r = timed(lambda i: env.message("12345", env.conf.app_number, "help"), num)
+    finally:
+        env.close()
+    return r
+
+def bench_list_post(members=1000, posts=100, **settings):
+    """ List.post alone: no parsing, no authorization checks. """
+    env = BenchEnv(**settings)
+    try:
+        sc = generate(env, 1, members)[0]
+        msg = smswall.Message("12345", sc, None, "testmessage")
+        list_ = smswall.List(sc, env.app)
+        r = timed(lambda i: list_.post(msg), posts)
+        r["members"] = members
+    finally:
+        env.close()
+    return r
+
+def bench_member_query(members=1000, num=100, **settings):
+    """ The membership query List.post runs, fetched in full. """
+    env = BenchEnv(**settings)
+    try:
+        sc = generate(env, 1, members)[0]
+        sql = "SELECT member FROM %s WHERE list=?" % env.conf.t_membership
+        r = timed(lambda i: env.db.execute(sql, (sc,)).fetchall(), num)
+        r["members"] = members
+    finally:
+        env.close()
+    return r
+
+def bench_smqueue(recipients=1000, sends=5, window=32, **settings):
+    """ SmqueueSender.send_bulk to a local FakeSmqueue. """
+    smqueue = smswall.FakeSmqueue()
+    smqueue.start()
+    settings.update(smqueue_port=smqueue.port, smqueue_window=window)
+    env = BenchEnv(**settings)
+    sender = smswall.SmqueueSender(env.conf)
+    numbers = [str(100000 + i) for i in xrange(recipients)]
+    try:
+        r = timed(lambda i: sender.send_bulk("1500", numbers, None, "testmessage"), sends)
+        r["recipients"] = recipients
+        r["window"] = window
+        r["per_recipient"] = r["mean"] / recipients
+    finally:
+        sender.close()
+        env.close()
+        smqueue.stop()
+    return r
+
+def curve_post_members(sizes=(10, 100, 1000, 10000), posts=20, **settings):
+    """ Post latency as a function of list size. """
+    return [bench_posts(members=m, posts=posts, **settings) for m in sizes]
+
+def curve_lists(counts=(10, 100, 1000), members=3, **settings):
+    """ Post latency as a function of the number of lists in the DB. """
+    return [bench_posts_many_lists(lists=n, members=members, **settings) for n in counts]
+
+# name -> (function, kwargs) for everything run.py runs by default.
+default_suite = [
+    ("create_lists", bench_create_lists, {}),
+    ("joins", bench_joins, {}),
+    ("dispatch", bench_dispatch, {}),
+    ("posts_100", bench_posts, {"members": 100}),
+    ("posts_1000", bench_posts, {"members": 1000}),
+    ("list_post_1000", bench_list_post, {}),
+    ("member_query_1000", bench_member_query, {}),
+    ("posts_many_lists", bench_posts_many_lists, {}),
+    ("smqueue_1", bench_smqueue, {"window": 1}),
+    ("smqueue_32", bench_smqueue, {"window": 32}),
+    ("curve_post_members", curve_post_members, {}),
+    ("curve_lists", curve_lists, {}),
+]
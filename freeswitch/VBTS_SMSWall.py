@@ -2,14 +2,21 @@
 from libvbts import FreeSwitchMessenger
 from freeswitch import *
 import logging
+import os
 import sys
 import re
+import threading
 import time
 import smswall
 import yaml
 
+CONFIG_FILE = "/etc/smswall.yaml"
+LOG_FILE = "/var/log/smswall.log"
+
 class FreeSwitchSender(smswall.Sender):
 
+    name = "freeswitch"
+
     def __init__(self, smsw):
     	self.smsw = smsw
 
@@ -18,6 +25,70 @@ class FreeSwitchSender(smswall.Sender):
         consoleLog('info', "sending '%s' to %s from %s\n" % (data, recipient, sender)) 
         self.smsw.fs.send_smqueue_sms("", recipient, sender, data)
 
+    def send_bulk(self, sender, recipients, subject, data):
+        sender = str(sender)
+        recipients = list(recipients)
+        consoleLog('info', "sending '%s' to %d recipients from %s\n" % (data, len(recipients), sender))
+        send = self.smsw.fs.send_smqueue_sms
+        for r in recipients:
+            send("", r, sender, data)
+
+class SMSWallContext:
+    """ Everything chat() needs, built once per FreeSWITCH Python interpreter
+    instead of once per message. The SMSWall (and its DB connection) is
+    rebuilt only when the config file's mtime changes. """
+
+    def __init__(self, config_file):
+        logging.basicConfig(filename=LOG_FILE, level="DEBUG")
+        self.log = logging.getLogger("SMSWall.SMSWall")
+        self.config_file = config_file
+        self.config_mtime = None
+        self.fs = FreeSwitchMessenger.FreeSwitchMessenger()
+        self.app = None
+        # FreeSWITCH may call us from several threads; they share one app.
+        self.lock = threading.Lock()
+
+    def _reload_if_changed(self):
+        mtime = os.stat(self.config_file).st_mtime
+        if mtime == self.config_mtime:
+            return
+        conf_file = open(self.config_file, "r")
+        config_dict = yaml.load("".join(conf_file.readlines()))
+        conf_file.close()
+        conf = smswall.Config(config_dict, self.log, shared_conn=True)
+
+        app = smswall.SMSWall(conf)
+        app.fs = self.fs
+        # With sender_type 'smqueue', SMSWall already talks to smqueue
+        # itself.
+        if conf.sender_type != "smqueue":
+            app.set_sender(FreeSwitchSender(app))
+        if self.app:
+            self.log.info("Config changed, reloading.")
+            self.app.stop_workers()
+            self.app.db.close()
+        self.app = app
+        self.config_mtime = mtime
+        self.app.start_workers()
+
+    def handle_incoming(self, msg):
+        with self.lock:
+            self._reload_if_changed()
+            try:
+                self.app.handle_incoming(msg)
+            finally:
+                self.app.reset()
+
+_context = None
+_context_lock = threading.Lock()
+
+def get_context():
+    global _context
+    with _context_lock:
+        if _context is None:
+            _context = SMSWallContext(CONFIG_FILE)
+        return _context
+
 def chat(message, args):
     args = args.split('|')
     if (len(args) < 3):
@@ -31,19 +102,9 @@ def chat(message, args):
         consoleLog('err', 'Malformed Args\n')
         exit(1)
 
-    logging.basicConfig(filename="/var/log/smswall.log", level="DEBUG")
-    smswall_log = logging.getLogger("SMSWall.SMSWall")
-    conf_file = open("/etc/smswall.yaml", "r")
-    config_dict = yaml.load("".join(conf_file.readlines()))
-    conf = smswall.Config(config_dict, smswall_log)
-
-    app = smswall.SMSWall(conf)
-    app.fs = FreeSwitchMessenger.FreeSwitchMessenger()
-    fss = FreeSwitchSender(app)
-    app.msg_sender = fss
     consoleLog('info', "Got '%s' from %s to %s\n" % (text, fromm, to))
     msg = smswall.Message(fromm, to, None, text)
-    app.handle_incoming(msg)
+    get_context().handle_incoming(msg)
 
 def fsapi(session, stream, env, args):
     #chat doesn't use message anyhow
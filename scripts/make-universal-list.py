@@ -1,35 +1,114 @@
 #!/usr/bin/python
 
-import sqlite3
+import argparse
+import logging
+import os
+import yaml
+
+import smswall
 
 """
 A hacky script to keep a "everyone who ever joined the network" mailing list up
-to date. Reads all the numbers from the subscriber registry, loads them
-directly into the smswall DB.
+to date. Syncs the numbers in the subscriber registry into the list's
+membership: new subscribers are added and departed ones removed (list owners
+are always kept).
+
+The sync is done in SQL with both databases attached, so no numbers are
+loaded into Python and only the ones that changed are written. Working out
+what changed still reads both sets in full (the subscriber registry doesn't
+record its changes), so a sync costs a scan of the network. To keep frequent
+runs cheap, we also remember the state of the subscriber registry file after
+each sync, so a run where nothing has changed doesn't touch the list at all.
 
 This should be set up as a cron job to run every few minutes.
 """
 
-subscriber_dbfile = "/var/lib/asterisk/sqlite3dir/sqlite3.db"
-smswall_dbfile = "/etc/OpenBTS/smswall.sqlite3"
-everyone_list_shortcode = 9999
+parser = argparse.ArgumentParser(description="Sync the subscriber registry into the everyone list.")
+parser.add_argument('--subscriber-db', action='store', dest='subscriber_dbfile', \
+                    default="/var/lib/asterisk/sqlite3dir/sqlite3.db", \
+                    help="Subscriber registry DB (default: %(default)s)")
+parser.add_argument('--config', '-c', action='store', dest='config', \
+                    help="Configuration file (default: %(default)s)", \
+                    default="/etc/smswall.yaml")
+parser.add_argument('--smswall-db', action='store', dest='smswall_dbfile', \
+                    help="smswall DB (default: db_file from the config file)")
+parser.add_argument('--shortcode', action='store', dest='shortcode', \
+                    default="9999", help="Shortcode of the everyone list (default: %(default)s)")
+parser.add_argument('--full', action='store_true', dest='full', \
+                    help="Sync even if the subscriber registry looks unchanged.")
+parser.add_argument('-v', action='store_true', dest='verbose', \
+                    help="Report what changed.")
+args = parser.parse_args()
+
+everyone_list_shortcode = args.shortcode
 
-smswall_db = sqlite3.connect(smswall_dbfile)
-subscriber_db = sqlite3.connect(subscriber_dbfile)
+def watermark(dbfile):
+    """ Identifies the current state of a sqlite DB file. Any write to the DB
+    changes the main file or, in WAL mode, the -wal file. """
+    state = []
+    for f in [dbfile, dbfile + "-wal"]:
+        try:
+            st = os.stat(f)
+            state.append("%r:%d" % (st.st_mtime, st.st_size))
+        except OSError:
+            state.append("-")
+    return "|".join(state)
+
+logging.basicConfig()
+conf_file = open(args.config, "r")
+config_dict = yaml.load("".join(conf_file.readlines()))
+conf_file.close()
+if args.smswall_dbfile:
+    config_dict['db_file'] = args.smswall_dbfile
+conf = smswall.Config(config_dict, logging.getLogger('smswall'))
+t_list = conf.t_list
+t_membership = conf.t_membership
+t_owner = conf.t_owner
+t_sync = conf.t_universal_sync
+
+# Brings the schema up to date, including our table.
+smswall_db = smswall.SMSWall(conf).db
+# We manage the transaction ourselves so the whole sync commits at once.
+smswall_db.isolation_level = None
 
 # make sure the "everyone" list exists
-r = smswall_db.execute("SELECT * FROM list WHERE shortcode=?", (everyone_list_shortcode,))
+r = smswall_db.execute("SELECT * FROM %s WHERE shortcode=?" % t_list, (everyone_list_shortcode,))
 if not len(r.fetchall()) == 1:
     exit("The everyone list shortcode doesn't exist.")
 
-# get numbers from subscriber registry
-r = subscriber_db.execute("SELECT callerid FROM sip_buddies")
-numbers = [str(x[0]) for x in r.fetchall()]
+# Take the watermark before reading anything, so a change that lands while
+# we're syncing gets picked up next time.
+mark = watermark(args.subscriber_dbfile)
+r = smswall_db.execute("SELECT watermark FROM %s WHERE list=?" % t_sync, (everyone_list_shortcode,))
+row = r.fetchone()
+if row and row[0] == mark and not args.full:
+    if args.verbose:
+        print "Subscriber registry unchanged, nothing to do."
+    exit()
+
+smswall_db.execute("ATTACH DATABASE ? AS sr", (args.subscriber_dbfile,))
+sc = everyone_list_shortcode
+smswall_db.execute("BEGIN IMMEDIATE")
+try:
+    r = smswall_db.execute(("INSERT INTO %s(list, member) " % t_membership) +
+                           "SELECT DISTINCT ?, CAST(callerid AS TEXT) FROM sr.sip_buddies " +
+                           "WHERE callerid IS NOT NULL AND callerid != '' " +
+                           ("AND CAST(callerid AS TEXT) NOT IN (SELECT member FROM %s WHERE list=?)" % t_membership),
+                           (sc, sc))
+    added = r.rowcount
+    r = smswall_db.execute(("DELETE FROM %s WHERE list=? " % t_membership) +
+                           "AND member NOT IN (SELECT CAST(callerid AS TEXT) FROM sr.sip_buddies WHERE callerid IS NOT NULL) " +
+                           ("AND member NOT IN (SELECT owner FROM %s WHERE list=?)" % t_owner),
+                           (sc, sc))
+    removed = r.rowcount
+    smswall_db.execute("INSERT OR REPLACE INTO %s VALUES (?,?)" % t_sync, (sc, mark))
+    smswall_db.execute("COMMIT")
+except:
+    smswall_db.execute("ROLLBACK")
+    raise
 
-# insert the numbers into the smswall db
-for n in numbers:
-    r = smswall_db.execute("INSERT INTO membership VALUES(?,?)", (everyone_list_shortcode, n))
-smswall_db.commit()
+if args.verbose:
+    print "Added %d, removed %d." % (added, removed)
 
+smswall_db.execute("DETACH DATABASE sr")
 smswall_db.close()
-subscriber_db.close()
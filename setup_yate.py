@@ -9,6 +9,7 @@ setup(name="smswall",
       license='bsd',
       packages=['smswall'],
       scripts=['smswall-interactive',
+               'smswall-daemon',
                'scripts/make-universal-list.py',
                'scripts/smswall-clean-confirm'],
       data_files=[('/etc/', ['conf/smswall.yaml']),
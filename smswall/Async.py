@@ -0,0 +1,277 @@
+import Queue
+import sys
+import threading
+
+from Sender import *
+from SMSWall import *
+
+"""
+A non-blocking front end to SMSWall. AsyncSMSWall.handle_incoming returns a
+Future straight away; the message is handled on a thread of its own, which
+owns the DB connection, and what it sends goes out through an AsyncSender, so
+a slow Sender doesn't hold up handling of the next message and many sends can
+be in flight at once.
+
+Python 2 has no asyncio, so this is built on threads: an Executor runs
+callables on a fixed set of threads and hands back a Future for each. Messages
+are handled one at a time, in the order they were submitted; sends overlap,
+up to the AsyncSender's number of workers. The synchronous SMSWall and Sender
+API is unchanged, and AsyncSender's own send_* methods still wait, so it works
+wherever a Sender does.
+"""
+
+class TimeoutError(RuntimeError):
+    pass
+
+class Future:
+    """ The result of a call that runs on another thread. """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """ exc_info is a sys.exc_info() tuple, so result() can re-raise it
+        with its traceback. """
+        self._exc_info = exc_info
+        self._finish()
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        self.wait(timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("Timed out waiting for a result.")
+
+    def result(self, timeout=None):
+        """ Wait for the call to finish and return what it returned, or raise
+        what it raised. """
+        self.wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, fn):
+        """ Call fn(future) when it's done; right away if it already is. """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+class Executor:
+    """ Runs submitted calls on workers threads. With one worker, calls run
+    one after another in the order they were submitted, all on the same
+    thread. With a depth, at most that many calls wait to be run, and
+    submit() blocks until there's room. """
+
+    def __init__(self, workers, name="executor", depth=0):
+        self.queue = Queue.Queue(depth)
+        self.threads = []
+        for i in range(max(workers, 1)):
+            t = threading.Thread(target=self._run, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, fn, args = item
+            try:
+                future.set_result(fn(*args))
+            except Exception:
+                future.set_exception(sys.exc_info())
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.queue.put((future, fn, args))
+        return future
+
+    def shutdown(self):
+        """ Run everything already submitted, then stop. """
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+class AsyncSender(Sender):
+    """ Wraps a Sender so sends can be started without waiting for them.
+    The *_async methods return a Future; the usual ones wait for it. The
+    wrapped Sender is called from several threads at once, so it has to be
+    thread-safe.
+
+    Up to depth sends (by default, two per worker) wait for a worker; past
+    that, starting another blocks until one finishes. So a big fan-out is
+    held in memory a few batches at a time, and goes out no faster than the
+    Sender takes it. """
+
+    def __init__(self, sender, workers, depth=None):
+        self.sender = sender
+        self.name = sender.name
+        if depth is None:
+            depth = 2 * workers
+        self.executor = Executor(workers, "send", depth)
+
+    def send_sms_async(self, sender, recipient, subject, data):
+        return self.executor.submit(self.sender.send_sms, sender, recipient, subject, data)
+
+    def send_bulk_async(self, sender, recipients, subject, data):
+        return self.executor.submit(self.sender.send_bulk, sender, list(recipients), subject, data)
+
+    def send_rendered_async(self, sender, recipients, subject, rendered):
+        return self.executor.submit(self.sender.send_rendered, sender, list(recipients), subject, rendered)
+
+    def expect(self, sender, messages):
+        self.sender.expect(sender, messages)
+
+    def send_sms(self, sender, recipient, subject, data):
+        return self.send_sms_async(sender, recipient, subject, data).result()
+
+    def send_bulk(self, sender, recipients, subject, data):
+        return self.send_bulk_async(sender, recipients, subject, data).result()
+
+    def send_rendered(self, sender, recipients, subject, rendered):
+        return self.send_rendered_async(sender, recipients, subject, rendered).result()
+
+    def close(self):
+        self.executor.shutdown()
+
+class _SendBehind(Sender):
+    """ What AsyncSMSWall's SMSWall sends direct messages through: starts each
+    send on the AsyncSender and returns without waiting for it. """
+
+    deferred = True
+
+    def __init__(self, wall):
+        self.wall = wall
+        self.name = wall.sender.name
+
+    def expect(self, sender, messages):
+        self.wall.sender.expect(sender, messages)
+
+    def send_sms(self, sender, recipient, subject, data):
+        self.wall._track(self.wall.sender.send_sms_async(sender, recipient, subject, data), 1)
+
+    def send_bulk(self, sender, recipients, subject, data):
+        recipients = list(recipients)
+        self.wall._track(self.wall.sender.send_bulk_async(sender, recipients, subject, data), len(recipients))
+
+    def send_rendered(self, sender, recipients, subject, rendered):
+        recipients = list(recipients)
+        self.wall._track(self.wall.sender.send_rendered_async(sender, recipients, subject, rendered), len(recipients))
+
+class AsyncSMSWall:
+    """ Handles messages on a thread of its own with its own DB connection,
+    and sends through up to send_workers concurrent sends. With no sender,
+    it sends through the one the config's sender_type picks. Send failures
+    are logged and counted in send_errors, since by then nobody is waiting
+    for them; use outbox delivery if they need retrying.
+
+    With outbox delivery, handling a message only queues what it sends, and
+    the delivery workers (see start_workers) send it, waiting for each send
+    as usual so failed ones are retried. The send workers aren't used. """
+
+    def __init__(self, conf, sender=None, send_workers=8):
+        self.conf = conf
+        self.log = conf.log
+        self.metrics = conf.metrics
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.idle = threading.Condition(self.lock)
+        self.executor = Executor(1, "smswall")
+        self.app = self.executor.submit(self._build, sender, send_workers).result()
+
+    def _build(self, sender, send_workers):
+        app = SMSWall(self.conf, self.conf.connect())
+        # Let SMSWall pick (and pace) the backend, then send through it from
+        # the send workers, so pacing doesn't hold up handling either.
+        if sender:
+            app.set_sender(sender)
+        self.sender = AsyncSender(app.msg_sender, send_workers)
+        # The outbox needs to know whether a send went through, so its
+        # delivery keeps the real sender.
+        if not app.outbox:
+            app.msg_sender = _SendBehind(self)
+        return app
+
+    def _track(self, future, count):
+        with self.lock:
+            self.in_flight.add(future)
+        future.add_done_callback(lambda f: self._sent(f, count))
+
+    def _sent(self, future, count):
+        name = self.sender.name
+        e = future.exception()
+        if e:
+            failed = count
+            if isinstance(e, SendError) and e.failed is not None:
+                failed = len(e.failed)
+            self.log.error("Sending to %d of %d recipients failed: %s" % (failed, count, e))
+            self.metrics.inc("send_errors", name, failed)
+            count -= failed
+        if count:
+            self.metrics.inc("sent", name, count)
+        with self.lock:
+            self.in_flight.discard(future)
+            if not self.in_flight:
+                self.idle.notify_all()
+
+    def _handle(self, message, confirmed):
+        try:
+            return self.app.handle_incoming(message, confirmed)
+        finally:
+            self.app.reset()
+
+    def handle_incoming(self, message, confirmed=False):
+        """ Queue message for handling. Returns a Future that's done once it's
+        been handled; its sends may still be in flight. """
+        return self.executor.submit(self._handle, message, confirmed)
+
+    def start_workers(self):
+        """ Start the SMSWall's background threads (outbox delivery and
+        confirm expiry). """
+        self.app.start_workers()
+
+    def deliver_pending(self):
+        """ Deliver everything that's due in the outbox. Returns a Future. """
+        return self.executor.submit(self.app.deliver_pending)
+
+    def pending(self):
+        """ Number of sends still in flight. """
+        with self.lock:
+            return len(self.in_flight)
+
+    def drain(self):
+        """ Wait until everything submitted so far is handled and sent. """
+        self.executor.submit(lambda: None).result()
+        with self.lock:
+            while self.in_flight:
+                self.idle.wait()
+
+    def close(self):
+        self.drain()
+        self.app.stop_workers()
+        self.executor.submit(self.app.db.close).result()
+        self.executor.shutdown()
+        self.sender.close()
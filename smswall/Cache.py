@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+"""
+Per-process caches for data that's read on every message but rarely changes.
+
+These only cache reads made through the app's own DB connection. Writes made
+through smswall invalidate the affected entries directly; writes made by other
+connections (other processes, or our own delivery workers) are picked up by
+revalidate(), which SMSWall calls once per incoming message.
+"""
+
+class VersionedCache:
+    """ Base for caches backed by a version counter table.
+
+    Revalidation first checks PRAGMA data_version, which only changes when some
+    other connection commits to the DB. Since most of those commits have
+    nothing to do with what we cache (outbox deliveries, membership changes),
+    we then check the version counter, which triggers on the cached tables
+    bump, and only drop the cache if that has moved too.
+    """
+
+    def __init__(self, conf, db, t_version):
+        self.conf = conf
+        self.db = db
+        self.t_version = t_version
+        self.entries = {}
+        self.data_version = None
+        self.version = None
+
+    def revalidate(self):
+        db = self.db
+        data_version = db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self.data_version:
+            return
+        self.data_version = data_version
+        version = db.execute("SELECT version FROM %s" % self.t_version).fetchone()[0]
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+class ListCache(VersionedCache):
+    """ Caches the list table row and the owner set for each list. """
+
+    def __init__(self, conf, db):
+        VersionedCache.__init__(self, conf, db, conf.t_list_version)
+
+    def get(self, shortcode):
+        """ Returns (row, owners) for the list, where row is the list's
+        (owner_only, is_public) or None if the list doesn't exist, and owners
+        is a frozenset of owner numbers. """
+        key = str(shortcode)
+        entry = self.entries.get(key)
+        if entry is None:
+            db = self.db
+            r = db.execute("SELECT owner_only, is_public FROM %s WHERE shortcode=?" % self.conf.t_list, (key,))
+            row = r.fetchone()
+            r = db.execute("SELECT owner FROM %s WHERE list=?" % self.conf.t_owner, (key,))
+            owners = frozenset(str(o[0]) for o in r.fetchall())
+            entry = (row, owners)
+            self.entries[key] = entry
+        return entry
+
+    def invalidate(self, shortcode=None):
+        """ Forget the given list, or everything if no list is given. """
+        if shortcode is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(str(shortcode), None)
+
+class NameCache(VersionedCache):
+    """ Bounded LRU cache of number -> username. A cached None means we looked
+    and the number has no name set. """
+
+    MISSING = object()
+
+    def __init__(self, conf, db, size):
+        VersionedCache.__init__(self, conf, db, conf.t_name_version)
+        self.entries = OrderedDict()
+        self.size = size
+
+    def get(self, number):
+        """ Returns the cached name, or NameCache.MISSING on a cache miss. """
+        key = str(number)
+        try:
+            name = self.entries.pop(key)
+        except KeyError:
+            return NameCache.MISSING
+        self.entries[key] = name # most recently used goes to the back
+        return name
+
+    def invalidate(self):
+        self.entries.clear()
+
+    def put(self, number, name):
+        key = str(number)
+        self.entries.pop(key, None)
+        self.entries[key] = name
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
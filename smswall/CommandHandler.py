@@ -7,92 +7,166 @@ class CommandError(RuntimeError):
     def __str__(self):
         return repr(self.value)
 
+# Where a command may be sent.
+APP = "app"   # only to the app number
+LIST = "list" # only directly to a list
+ANY = "any"
+
+class CommandSpec:
+    """ Everything dispatch() checks before calling a command's handler.
+        - target: APP, LIST or ANY.
+        - min_args, max_args: allowed number of arguments (max_args None
+          means no limit).
+        - owner: None if anyone may run the command. Otherwise, whose list
+          the sender has to own: the list the command was sent to ("list") or
+          the one named by the first argument ("argument").
+        - numeric: every argument has to be a number.
+        - usage: the help text, with %(app)s for the app number.
+    """
+
+    def __init__(self, name, handler, target, min_args=0, max_args=0,
+                 owner=None, numeric=False, usage=None,
+                 owner_error="Sorry, only a list owner may do that."):
+        self.name = name
+        self.handler = handler
+        self.target = target
+        self.min_args = min_args
+        self.max_args = max_args
+        self.owner = owner
+        self.numeric = numeric
+        self.usage = usage
+        self.owner_error = owner_error
+
+class ParsedCommand:
+    """ A tokenized command: its name (lowercased), arguments, and spec, which
+    is None if there's no such command. """
+
+    def __init__(self, name, args, spec):
+        self.name = name
+        self.args = args
+        self.spec = spec
+
+# The command table, in the order 'help' lists the commands.
+COMMANDS = [
+    CommandSpec("create", "create_list", APP, 1, 1, numeric=True,
+                usage="Send 'create <number>' to %(app)s to create a new list with specified number."),
+    CommandSpec("delete", "delete_list", APP, 1, 1, owner="argument", numeric=True,
+                owner_error="Sorry, you have to own a list to delete it.",
+                usage="Send 'delete <number>' to %(app)s to delete a list with specified number. Must be an owner of a list to delete it."),
+    CommandSpec("confirm", "confirm", APP, 0, None,
+                usage="Send 'confirm' to %(app)s to confirm a pending action."),
+    CommandSpec("setname", "setname", APP, 1, None,
+                usage="Send 'setname <name>' to %(app)s to set your name (displayed when you send messages)."),
+    CommandSpec("join", "join", LIST,
+                usage="Send 'join' to any list to join that list."),
+    CommandSpec("leave", "leave", LIST,
+                usage="Send 'leave' to any list to leave that list."),
+    CommandSpec("add", "add", LIST, 1, None, owner="list", numeric=True,
+                usage="Send 'add <number> [<number> ...]' to any list you're an owner of to add the specified numbers to the list."),
+    CommandSpec("remove", "remove", LIST, 1, None, owner="list", numeric=True,
+                usage="Send 'remove <number> [<number> ...]' to any list you're an owner of to remove the specified numbers from the list."),
+    CommandSpec("addowner", "addowner", LIST, 1, 1, owner="list", numeric=True,
+                usage="Send 'addowner <number>' to any list you're an owner of to make the specified number a list owner."),
+    CommandSpec("removeowner", "removeowner", LIST, 1, 1, owner="list", numeric=True,
+                usage="Send 'removeowner <number>' to any list you're an owner of to remove the specified number as a list owner."),
+    CommandSpec("makepublic", "makepublic", LIST, owner="list",
+                usage="Send 'makepublic' to any list you're an owner of to allow anyone to join; otherwise, list owners must add members."),
+    CommandSpec("makeprivate", "makeprivate", LIST, owner="list",
+                usage="Send 'makeprivate' to any list you're an owner of to disallow people joining without an owner adding them."),
+    CommandSpec("makeopen", "makeopen", LIST, owner="list",
+                usage="Send 'makeopen' to any list you're an owner of to allow all members to post to the list."),
+    CommandSpec("makeclosed", "makeclosed", LIST, owner="list",
+                usage="Send 'makeclosed' to any list you're an owner of to only let list owners post to the list."),
+    CommandSpec("help", "cmd_help", ANY, 0, None,
+                usage="For more info send 'help <command>' to %(app)s. Available commands: %(commands)s. More questions? Call 411."),
+]
+
 class CommandHandler(object):
 
     """
     The command handler performs authentication and basic syntax checking for
-    commands. We dispatch the command to the right handler, then check whether
-    or not the issuer of the command is authorized to execute it. We also
-    verify the command has the right number of arguments. The semantics of each
-    command should be implemented elsewhere -- we'll check whether or not the
-    command is semantically valid where it's defined.
+    commands. Each command's requirements (where it may be sent, how many
+    arguments it takes, whether the sender must own the list, whether its
+    arguments must be numbers) are in the COMMANDS table; dispatch() checks
+    them before calling the handler. The semantics of each command should be
+    implemented elsewhere -- we'll check whether or not the command is
+    semantically valid where it's defined.
 
     If command handling fails at any point, we raise a CommandError. The value
     of the exception should be sent as a reply by the calling application.
-
-    TODO: we really should validate arguments here (should all be ints).
     """
     def __init__(self, app):
         self.app = app
         self.conf = app.conf
-        self.commands = {"create": self.create_list,
-                         "delete": self.delete_list,
-                         "help": self.cmd_help,
-                         "join": self.join,
-                         "leave": self.leave,
-                         "makepublic": self.makepublic,
-                         "makeprivate": self.makeprivate,
-                         "makeopen": self.makeopen,
-                         "makeclosed": self.makeclosed,
-                         "add": self.add,
-                         "remove": self.remove,
-                         "addowner": self.addowner,
-                         "removeowner": self.removeowner,
-                         "setname": self.setname,
-                         "confirm": self.confirm
-                        }
-
-    app_commands = ["confirm", "create", "delete", "setname"]
-
-    def dispatch(self, message, cmd, arguments, confirmed):
-        """ Dispatch a command to the appropriate handler. We check to make
-        sure the command exists and is directed to a valid number before
-        dispatching.
+        self.app_number = str(self.conf.app_number)
+        self.commands = dict((spec.name, spec) for spec in COMMANDS)
+        self.handlers = dict((spec.name, getattr(self, spec.handler)) for spec in COMMANDS)
+        names = {"app": self.conf.app_number,
+                 "commands": ", ".join(spec.name for spec in COMMANDS)}
+        self.help_strings = dict((spec.name, spec.usage % names) for spec in COMMANDS)
+
+    def tokenize(self, message):
+        """ Returns the message as a ParsedCommand, or None if it doesn't
+        look like a command (i.e., it's a post to a list).
+
+        dispatch() will verify the command actually exists and is sent to the
+        proper number. The goal here is to accept anything that looks like it
+        could have been intended as a command, and then deliver an appropriate
+        error to the user if the command turns out to be malformed.
         """
+        body = message.body
+        has_cmd_char = body.startswith(self.conf.cmd_char)
+        if has_cmd_char:
+            body = body[len(self.conf.cmd_char):]
+        words = body.split()
         # case insensitive -- lowercase is impossible in T9-land!
-        cmd = cmd.lower()
+        name = words[0].lower() if words else ""
+        spec = self.commands.get(name)
+        is_to_app = str(message.recipient) == self.app_number
+        if not (is_to_app or has_cmd_char or spec):
+            return None
+        return ParsedCommand(name, words[1:], spec)
 
-        # Don't dispatch non-commands
-        if not cmd in self.commands:
+    def looks_like_command(self, message):
+        return self.tokenize(message) is not None
+
+    def dispatch(self, message, command, confirmed):
+        """ Dispatch a ParsedCommand to the appropriate handler, after making
+        sure it exists, is directed to a valid number, has valid arguments,
+        and comes from someone allowed to run it.
+        """
+        spec = command.spec
+        if spec is None:
+            if not command.name:
+                self.invalid_command(None)
             e = "The command '%s' doesn't exist. Try sending 'help' to %s, or call 411 for Information." \
-                % (cmd, self.conf.app_number)
+                % (command.name, self.conf.app_number)
             raise CommandError(e)
 
-        # Check if an app number command was sent to the right place
-        recp = message.recipient
-        app_number = str(self.conf.app_number)
-        if cmd in CommandHandler.app_commands and not recp == app_number:
-            e = "The command '%s' must be sent to %s." % (cmd, app_number)
+        # Check if the command was sent to the right place
+        to_app = str(message.recipient) == self.app_number
+        if spec.target == APP and not to_app:
+            e = "The command '%s' must be sent to %s." % (spec.name, self.app_number)
             raise CommandError(e)
-        elif cmd == "help":
-            pass # we'd fail on the next check with this so we special case it
-        elif not cmd in CommandHandler.app_commands and recp == app_number:
-            e = "The command '%s' must be sent directly to a list." % (cmd)
+        elif spec.target == LIST and to_app:
+            e = "The command '%s' must be sent directly to a list." % (spec.name)
             raise CommandError(e)
 
-        if not arguments:
-            arguments = []
+        args = command.args
+        if len(args) < spec.min_args or \
+           (spec.max_args is not None and len(args) > spec.max_args):
+            self.invalid_command(spec.name)
+        if spec.numeric:
+            for a in args:
+                if not a.isdigit():
+                    self.invalid_command(spec.name)
 
-        handler_func = self.commands[cmd]
-        handler_func(message, cmd, arguments, confirmed)
-
-    def looks_like_command(self, message):
-        body = message.body
-        has_cmd_char = body.startswith(self.conf.cmd_char)
-        if has_cmd_char:
-            cmd = body[1:].split()[0].lower()
-        elif len(body.split()) >= 1:
-            cmd = body.split()[0].lower()
-        else:
-            return False
+        if spec.owner:
+            shortcode = args[0] if spec.owner == "argument" else message.recipient
+            if not List(shortcode, self.app).is_owner(message.sender):
+                raise CommandError(spec.owner_error)
 
-        # dispatch() will verify the command actually exists and is sent to the
-        # proper number. The goal here is to accept anything that looks like it
-        # could have been intended as a command, and then deliver an
-        # appropriate error to the user if the command turns out to be
-        # malformed.
-        is_to_app = str(message.recipient) == str(self.conf.app_number)
-        return is_to_app or has_cmd_char or cmd in self.commands.keys()
+        self.handlers[spec.name](message, spec.name, args, confirmed)
 
     def invalid_command(self, command):
         if not command:
@@ -108,9 +182,6 @@ class CommandHandler(object):
         This command is sent to the application.
         If list creation is enabled, anyone can create lists.
         """
-        if not len(args) == 1:
-            self.invalid_command("create")
-
         l = List(args[0], self.app)
         l.create(message.sender)
 
@@ -119,48 +190,17 @@ class CommandHandler(object):
         This command is sent to the application.
         Only list owners may delete lists, and this must be confirmed.
         """
-        if not len(args) == 1:
-            self.invalid_command("delete")
-
         l = List(args[0], self.app)
-
-        if not l.is_owner(message.sender):
-            e = "Sorry, you have to own a list to delete it."
-            raise CommandError(e)
-
         l.delete(confirmed)
 
     def cmd_help(self, message, cmd, args, confirmed):
         """
         This command is sent directly to a list or to the application.
-        Anyone can ask for help. Should return a list of commands, and if
-        there's an argument, should show help for specified command.
-        """
-        help_strings = {
-                        "help": "For more info send 'help <command>' to %s. Available commands: %s. More questions? Call 411." % (self.conf.app_number, ", ".join(self.commands.keys())),
-                        "create": "Send 'create <number>' to %s to create a new list with specified number." % self.conf.app_number,
-                        "delete": "Send 'delete <number>' to %s to delete a list with specified number. Must be an owner of a list to delete it." % self.conf.app_number,
-                        "setname": "Send 'setname <name>' to %s to set your name (displayed when you send messages)." % self.conf.app_number,
-                        "join": "Send 'join' to any list to join that list.",
-                        "leave": "Send 'leave' to any list to leave that list.",
-                        "makepublic": "Send 'makepublic' to any list you're an owner of to allow anyone to join; otherwise, list owners must add members.",
-                        "makeprivate": "Send 'makeprivate' to any list you're an owner of to disallow people joining without an owner adding them.",
-                        "makeopen": "Send 'makeopen' to any list you're an owner of to allow all members to post to the list.",
-                        "makeclosed": "Send 'makeclosed' to any list you're an owner of to only let list owners post to the list.",
-                        "remove": "Send 'remove <number>' to any list you're an owner of to remove the specified number from the list.",
-                        "add": "Send 'add <number>' to any list you're an owner of to add the specified number to the list.",
-                        "addowner": "Send 'addowner <number>' to any list you're an owner of to make the specified number a list owner.",
-                        "removeowner": "Send 'removeowner <number>' to any list you're an owner of to remove the specified number as a list owner.",
-                        "confirm": "Send 'confirm' to %s to confirm a pending action." % self.conf.app_number
-                       }
-        if cmd == "help":
-            if not args or len(args) == 0:
-                help_cmd = "help"
-            else:
-                help_cmd = args[0]
-            if help_cmd in help_strings:
-                raise CommandError(help_strings[help_cmd])
-        raise CommandError(help_strings["help"])
+        Anyone can ask for help. Replies with a list of commands, or if
+        there's an argument, help for the specified command.
+        """
+        help_cmd = args[0].lower() if args else "help"
+        self.app.reply(self.help_strings.get(help_cmd, self.help_strings["help"]))
 
     def join(self, message, cmd, args, confirmed):
         """
@@ -168,8 +208,6 @@ class CommandHandler(object):
         If the list is public, then anyone can join. If false, owners should
         use the "add" command to add a number to the list.
         """
-        if not len(args) == 0:
-            self.invalid_command("join")
         l = List(message.recipient, self.app)
         if not l.is_public():
             raise CommandError("Sorry, to join the list '%s' a list owner must add you." % l.shortcode)
@@ -180,8 +218,6 @@ class CommandHandler(object):
         This command is sent directly to a list.
         Anyone can leave a list at any time.
         """
-        if not len(args) == 0:
-            self.invalid_command("leave")
         l = List(message.recipient, self.app)
         l.delete_user(message.sender)
 
@@ -190,104 +226,70 @@ class CommandHandler(object):
         This command is sent directly to a list.
         Only owners can make a list public.
         """
-        if not len(args) == 0:
-            self.invalid_command("makepublic")
-        l = List(message.recipient, self.app)
-        if not l.is_owner(message.sender):
-            raise CommandError("Sorry, only a list owner may do that.")
-        l.set_list_public(True)
+        List(message.recipient, self.app).set_list_public(True)
 
     def makeprivate(self, message, cmd, args, confirmed):
         """
         This command is sent directly to a list.
         Only owners can make a list private.
         """
-        if not len(args) == 0:
-            self.invalid_command("makeprivate")
-        l = List(message.recipient, self.app)
-        if not l.is_owner(message.sender):
-            raise CommandError("Sorry, only a list owner may do that.")
-        l.set_list_public(False)
+        List(message.recipient, self.app).set_list_public(False)
 
     def makeopen(self, message, cmd, args, confirmed):
         """
         This command is sent directly to a list.
         Only owners can make a list open.
         """
-        if not len(args) == 0:
-            self.invalid_command("makeopen")
-        l = List(message.recipient, self.app)
-        if not l.is_owner(message.sender):
-            raise CommandError("Sorry, only a list owner may do that.")
-        l.set_owner_only_posting(False)
+        List(message.recipient, self.app).set_owner_only_posting(False)
 
     def makeclosed(self, message, cmd, args, confirmed):
         """
         This command is sent directly to a list.
         Only owners can make a list closed.
         """
-        if not len(args) == 0:
-            self.invalid_command("makeclosed")
-        l = List(message.recipient, self.app)
-        if not l.is_owner(message.sender):
-            raise CommandError("Sorry, only a list owner may do that.")
-        l.set_owner_only_posting(True)
+        List(message.recipient, self.app).set_owner_only_posting(True)
 
     def setname(self, message, cmd, args, confirmed):
         """
         This command is sent to the app. Used to set the username of a user.
         """
-        if not len(args) >= 1:
-            self.invalid_command("setname")
         self.app.set_username(message.sender, " ".join(args))
 
     def add(self, message, cmd, args, confirmed):
         """
         This command is sent directly to a list.
-        Only owners can add a user to the list.
+        Only owners can add users to the list. Takes one or more numbers.
         """
-        if not len(args) == 1:
-            self.invalid_command("add")
         l = List(message.recipient, self.app)
-        if not l.is_owner(message.sender):
-            raise CommandError("Sorry, only a list owner may do that.")
-        l.add_user(args[0])
+        if len(args) == 1:
+            l.add_user(args[0])
+        else:
+            l.add_users(args)
 
     def remove(self, message, cmd, args, confirmed):
         """
         This command is sent directly to a list.
-        Only owners can remove a user from the list.
+        Only owners can remove users from the list. Takes one or more numbers.
         """
-        if not len(args) == 1:
-            self.invalid_command("delete")
         l = List(message.recipient, self.app)
-        if not l.is_owner(message.sender):
-            raise CommandError("Sorry, only a list owner may do that.")
-        l.delete_user(args[0])
+        if len(args) == 1:
+            l.delete_user(args[0])
+        else:
+            l.remove_users(args)
 
     def addowner(self, message, cmd, args, confirmed):
         """
         This command is sent directly to a list.
         Only owners can add an owner to the list.
         """
-        if not len(args) == 1:
-            self.invalid_command("addowner")
-        l = List(message.recipient, self.app)
-        if not l.is_owner(message.sender):
-            raise CommandError("Sorry, only a list owner may do that.")
-        l.make_owner(args[0])
+        List(message.recipient, self.app).make_owner(args[0])
 
     def removeowner(self, message, cmd, args, confirmed):
         """
         This command is sent directly to a list.
         Only owners can remove an owner from the list.
         """
-        if not len(args) == 1:
-            self.invalid_command("removeowner")
-        l = List(message.recipient, self.app)
-        if not l.is_owner(message.sender):
-            raise CommandError("Sorry, only a list owner may do that.")
-        l.unmake_owner(args[0])
+        List(message.recipient, self.app).unmake_owner(args[0])
 
     def confirm(self, message, cmd, args, confirmed):
         """
@@ -1,7 +1,100 @@
+import random
 import sqlite3
+import time
+
+from Metrics import *
+
+# SQLite tuning profiles, selected with 'db_profile' in the config. Individual
+# settings can be overridden with a 'db_pragmas' dict.
+#   - default: WAL, so readers never block the writer, with fsync only at
+#     checkpoints. A power cut can lose the last few commits but never
+#     corrupts the DB.
+#   - safe: WAL, but fsync on every commit.
+#   - throughput: default plus a bigger page cache and memory-mapped reads,
+#     for busy sites with RAM to spare.
+#   - legacy: rollback journal and no busy timeout; how smswall used to open
+#     the DB. Only useful as a baseline for benchmarks.
+DB_PROFILES = {
+    "default": {"journal_mode": "WAL",
+                "synchronous": "NORMAL",
+                "cache_size": -2000, # negative means KiB rather than pages
+                "mmap_size": 0,
+                "busy_timeout": 5000},
+    "safe": {"journal_mode": "WAL",
+             "synchronous": "FULL",
+             "cache_size": -2000,
+             "mmap_size": 0,
+             "busy_timeout": 10000},
+    "throughput": {"journal_mode": "WAL",
+                   "synchronous": "NORMAL",
+                   "cache_size": -16000,
+                   "mmap_size": 64 * 1024 * 1024,
+                   "busy_timeout": 5000},
+    "legacy": {"journal_mode": "DELETE",
+               "synchronous": "FULL",
+               "cache_size": -2000,
+               "mmap_size": 0,
+               "busy_timeout": 0},
+}
+
+def _is_transient(error):
+    msg = str(error)
+    return "locked" in msg or "busy" in msg
+
+class RetryingConnection(sqlite3.Connection):
+    """ A connection that retries statements and commits that fail because
+    another connection holds a lock, backing off exponentially. busy_timeout
+    already makes SQLite wait for locks itself; this covers what's left over
+    (e.g., a writer that holds the lock for longer than the timeout).
+
+    If metrics is set, the latency of each call and any errors and retries
+    are recorded there. """
+
+    retries = 0
+    retry_delay = 0.05
+    log = None
+    metrics = None
+
+    def _retry(self, func, *args):
+        metrics = self.metrics
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                result = func(self, *args)
+            except sqlite3.Error as e:
+                transient = isinstance(e, sqlite3.OperationalError) and _is_transient(e)
+                if metrics:
+                    metrics.inc("db_errors", "busy" if transient else "other")
+                if attempt >= self.retries or not transient:
+                    raise
+                attempt += 1
+                if metrics:
+                    metrics.inc("db_retries")
+                if self.log:
+                    self.log.debug("DB busy (%s), retry %d in %.3fs." % (e, attempt, delay))
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay *= 2
+            else:
+                if metrics:
+                    metrics.observe("db_latency", time.time() - start)
+                return result
+
+    def execute(self, *args):
+        return self._retry(sqlite3.Connection.execute, *args)
+
+    def executemany(self, *args):
+        return self._retry(sqlite3.Connection.executemany, *args)
+
+    def commit(self):
+        return self._retry(sqlite3.Connection.commit)
 
 class Config:
-    def __init__(self, config_dict, logger):
+    def __init__(self, config_dict, logger, shared_conn=False):
+        """ If shared_conn is set, db_conn may be used from threads other than
+        the one that created it. The caller is then responsible for making sure
+        only one thread uses it at a time. """
         self.config_dict = config_dict
         self.log = logger
 
@@ -10,10 +103,42 @@ class Config:
         self._scrub(self.config_dict['t_membership'])
         self._scrub(self.config_dict['t_owner'])
         self._scrub(self.config_dict['t_confirm'])
+        self._scrub(self.t_outbox)
+        self._scrub(self.t_outbox_job)
+        self._scrub(self.t_schema)
+        self._scrub(self.t_list_version)
+        self._scrub(self.t_name_version)
+        self._scrub(self.t_inbound)
+        self._scrub(self.t_universal_sync)
 
-        self.db_conn = sqlite3.connect(self.db_file)
+        # One registry per process, shared by every connection we open.
+        self.metrics = Metrics(self.metrics_file, self.metrics_interval)
+        self.db_conn = self.connect(check_same_thread=not shared_conn)
         self.log.debug("Connected to DB: %s" % self.db_file)
 
+    def connect(self, check_same_thread=True):
+        """ Open a new connection to the smswall DB, set up according to the
+        configured tuning profile. Threads that need to hit the DB (e.g.,
+        delivery workers) should use their own connection. """
+        pragmas = self.db_pragmas
+        conn = sqlite3.connect(self.db_file,
+                               timeout=pragmas["busy_timeout"] / 1000.0,
+                               check_same_thread=check_same_thread,
+                               factory=RetryingConnection)
+        conn.retries = self.db_retries
+        conn.log = self.log
+        conn.metrics = self.metrics
+        # smswall deals in byte strings throughout; don't get unicode back.
+        conn.text_factory = str
+        for pragma in ["journal_mode", "synchronous", "cache_size", "mmap_size", "busy_timeout"]:
+            # Pragma values can't be bound as parameters; make sure they're
+            # plain words or numbers before pasting them in.
+            value = str(pragmas[pragma])
+            if not value.lstrip("-").isalnum():
+                raise ValueError("Bad value for pragma %s: %s" % (pragma, value))
+            conn.execute("PRAGMA %s=%s" % (pragma, value)).fetchall()
+        return conn
+
     def _scrub(self, string):
         """ Make sure the string is alphanumeric. We do this to sanitize our
         table names (since DB-API parameter substitution doesn't work for table
@@ -46,10 +171,78 @@ class Config:
     def t_name(self):
         return self._scrub(self.config_dict['t_name'])
 
+    @property
+    def t_outbox(self):
+        return self._scrub(self.config_dict.get('t_outbox', 'outbox'))
+
+    @property
+    def t_outbox_job(self):
+        return self._scrub(self.config_dict.get('t_outbox_job', 'outboxjob'))
+
+    @property
+    def t_list_version(self):
+        return self._scrub(self.config_dict.get('t_list_version', 'listversion'))
+
+    @property
+    def t_name_version(self):
+        return self._scrub(self.config_dict.get('t_name_version', 'nameversion'))
+
+    @property
+    def t_inbound(self):
+        return self._scrub(self.config_dict.get('t_inbound', 'inbound'))
+
+    @property
+    def t_universal_sync(self):
+        return self._scrub(self.config_dict.get('t_universal_sync', 'universalsync'))
+
+    @property
+    def t_schema(self):
+        return self._scrub(self.config_dict.get('t_schema', 'schemaversion'))
+
     @property
     def sender_type(self):
         return self.config_dict['sender_type']
 
+    @property
+    def smqueue_host(self):
+        return self.config_dict.get('smqueue_host', '127.0.0.1')
+
+    @property
+    def smqueue_port(self):
+        return self.config_dict.get('smqueue_port', 5063)
+
+    @property
+    def smqueue_connections(self):
+        """ Most sockets the smqueue sender keeps open. """
+        return self.config_dict.get('smqueue_connections', 4)
+
+    @property
+    def smqueue_window(self):
+        """ Most unanswered requests in flight on one socket. """
+        return self.config_dict.get('smqueue_window', 32)
+
+    @property
+    def smqueue_timeout(self):
+        """ Seconds to wait for an answer before retransmitting. """
+        return self.config_dict.get('smqueue_timeout', 0.5)
+
+    @property
+    def smqueue_retries(self):
+        return self.config_dict.get('smqueue_retries', 3)
+
+    @property
+    def send_rates(self):
+        """ Messages per second each sender backend may send, by Sender.name
+        (e.g., {'yate': 10}). Backends that aren't listed aren't paced. Each
+        process paces its own sends; with daemon_shards, the daemon splits
+        these (and send_burst) between its workers. """
+        return self.config_dict.get('send_rates') or {}
+
+    @property
+    def send_burst(self):
+        """ How many messages a paced backend may send back to back. """
+        return self.config_dict.get('send_burst', 10)
+
     @property
     def db_file(self):
         return self.config_dict['db_file']
@@ -69,3 +262,109 @@ class Config:
     @property
     def max_shortcode(self):
         return self.config_dict['max_shortcode']
+
+    @property
+    def max_segments(self):
+        """ Longest list post we'll send, in SMS segments per recipient. 0
+        means no limit. """
+        return self.config_dict.get('max_segments', 0)
+
+    @property
+    def confirm_ttl(self):
+        """ Seconds a pending action can be confirmed for. """
+        return self.config_dict.get('confirm_ttl', 3600)
+
+    @property
+    def dedupe_window(self):
+        """ Seconds within which a repeat of an incoming message (same
+        sender, recipient and body) is treated as a retry and dropped. 0
+        turns this off. """
+        return self.config_dict.get('dedupe_window', 0)
+
+    @property
+    def name_cache_size(self):
+        """ How many usernames each process keeps cached. """
+        return self.config_dict.get('name_cache_size', 1024)
+
+    @property
+    def db_profile(self):
+        return self.config_dict.get('db_profile', 'default')
+
+    @property
+    def db_pragmas(self):
+        """ SQLite settings: the tuning profile, plus any overrides. """
+        if not self.db_profile in DB_PROFILES:
+            raise ValueError("No DB profile '%s' exists." % self.db_profile)
+        pragmas = dict(DB_PROFILES[self.db_profile])
+        pragmas.update(self.config_dict.get('db_pragmas') or {})
+        return pragmas
+
+    @property
+    def db_retries(self):
+        """ How many times to retry a statement that failed on a lock. """
+        return self.config_dict.get('db_retries', 5)
+
+    @property
+    def trace_file(self):
+        """ Where to write per-message stage timings, or None to not trace.
+        """
+        return self.config_dict.get('trace_file')
+
+    @property
+    def metrics_file(self):
+        """ Where to periodically write a JSON snapshot of the runtime
+        metrics, or None to not write one. """
+        return self.config_dict.get('metrics_file')
+
+    @property
+    def metrics_interval(self):
+        """ Seconds between writes of the metrics file. """
+        return self.config_dict.get('metrics_interval', 60)
+
+    @property
+    def daemon_socket(self):
+        """ Unix socket the smswall daemon listens on, or None if the
+        deployment doesn't run a daemon. """
+        return self.config_dict.get('daemon_socket')
+
+    @property
+    def delivery(self):
+        """ Either 'direct' (send while handling the incoming message) or
+        'outbox' (queue in the DB, deliver in the background). """
+        return self.config_dict.get('delivery', 'direct')
+
+    @property
+    def delivery_workers(self):
+        return self.config_dict.get('delivery_workers', 2)
+
+    @property
+    def delivery_attempts(self):
+        return self.config_dict.get('delivery_attempts', 5)
+
+    @property
+    def delivery_backoff(self):
+        """ Seconds before the first retry; doubles on each attempt. """
+        return self.config_dict.get('delivery_backoff', 2)
+
+    @property
+    def daemon_shards(self):
+        """ Worker processes the daemon hands messages to (see Shard.py), or
+        0 to handle them in the daemon itself. """
+        return self.config_dict.get('daemon_shards', 0)
+
+    @property
+    def inbound_workers(self):
+        """ Threads handling incoming messages, for integrations that hand
+        them off (see Inbound.py). """
+        return self.config_dict.get('inbound_workers', 4)
+
+    @property
+    def inbound_depth(self):
+        """ Messages each inbound worker or daemon shard will queue before
+        refusing (or, for shards, waiting to accept) more. """
+        return self.config_dict.get('inbound_depth', 100)
+
+    @property
+    def delivery_lease(self):
+        """ Seconds before a claimed but unfinished delivery is retried. """
+        return self.config_dict.get('delivery_lease', 300)
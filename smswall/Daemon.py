@@ -0,0 +1,150 @@
+import json
+import os
+import socket
+import SocketServer
+import sys
+
+from Message import *
+
+"""
+A resident smswall process. The daemon keeps one SMSWall (and its Config and
+DB connection) alive and accepts requests over a local Unix socket, so that
+handling a message doesn't pay interpreter startup, YAML parsing and schema
+setup every time.
+
+The wire protocol is deliberately dumb: each request is a single line of JSON,
+and the daemon answers each request with a single line of JSON. A client may
+send any number of requests over one connection.
+
+    {"op": "message", "sender": ..., "recipient": ..., "subject": ..., "body": ...}
+    {"op": "clean_confirm", "age": <minutes>}
+    {"op": "ping"}
+    {"op": "status"}
+
+Responses are {"ok": true} on success, or {"ok": false, "error": "..."}. The
+response to "status" also carries the daemon's runtime metrics, as
+{"ok": true, "metrics": {...}} (see Metrics.py).
+
+A sharded daemon (see Shard.py) answers "message" and "clean_confirm" once
+they're queued for a worker, so errors handling them are only logged.
+"""
+
+class DaemonError(RuntimeError):
+    pass
+
+def _str(value):
+    """ JSON gives us unicode back; the rest of smswall deals in byte strings.
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+class DaemonHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {"ok": False, "error": "Malformed request."}
+            else:
+                response = self.server.dispatch(request)
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+class SMSWallDaemon(SocketServer.UnixStreamServer):
+    """ Serves requests for a single SMSWall instance, or a ShardPool.
+    Requests are handled one at a time, in the order they arrive. """
+
+    def __init__(self, app, socket_path):
+        self.app = app
+        self.log = app.log
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            # A stale socket from a previous run would make bind() fail.
+            os.unlink(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, DaemonHandler)
+        self.log.info("Listening on %s" % socket_path)
+
+    def dispatch(self, request):
+        op = request.get("op", "message")
+        response = {"ok": True}
+        try:
+            if op == "message":
+                msg = Message(_str(request.get("sender")),
+                              _str(request.get("recipient")),
+                              _str(request.get("subject")),
+                              _str(request.get("body")))
+                # No point in handling an empty message.
+                if not msg.is_empty():
+                    self.app.handle_incoming(msg)
+            elif op == "clean_confirm":
+                self.app.clean_confirm_actions(int(request["age"]))
+            elif op == "ping":
+                pass
+            elif op == "status":
+                response["metrics"] = self.app.metrics.snapshot()
+            else:
+                return {"ok": False, "error": "Unknown op '%s'." % op}
+        except Exception as e:
+            self.log.exception("Error handling request: %s" % request)
+            return {"ok": False, "error": str(e)}
+        return response
+
+    def handle_error(self, request, client_address):
+        # SocketServer calls this from a bare except, so without this a
+        # SIGTERM that arrives while a client is connected would be logged
+        # and ignored.
+        if isinstance(sys.exc_info()[1], (SystemExit, KeyboardInterrupt)):
+            raise
+        SocketServer.UnixStreamServer.handle_error(self, request, client_address)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+class SMSWallClient:
+    """ Thin client for talking to a running SMSWallDaemon. """
+
+    def __init__(self, socket_path, timeout=30):
+        self.socket_path = socket_path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self.rfile = self.sock.makefile("rb")
+
+    def _request(self, request):
+        self.sock.sendall(json.dumps(request) + "\n")
+        line = self.rfile.readline()
+        if not line:
+            raise DaemonError("Daemon closed the connection.")
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise DaemonError(_str(response.get("error")))
+        return response
+
+    def ping(self):
+        return self._request({"op": "ping"})
+
+    def status(self):
+        """ Returns the daemon's runtime metrics. """
+        return self._request({"op": "status"})["metrics"]
+
+    def handle_incoming(self, message):
+        return self._request({"op": "message",
+                              "sender": message.sender,
+                              "recipient": message.recipient,
+                              "subject": message.subject,
+                              "body": message.body})
+
+    def clean_confirm_actions(self, age):
+        return self._request({"op": "clean_confirm", "age": age})
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
@@ -0,0 +1,51 @@
+import hashlib
+import time
+
+"""
+Drops retried inbound messages. When smqueue or the switch doesn't hear back
+in time it delivers the same SMS to us again, and without this a retried post
+goes out to the whole list a second time.
+
+With 'dedupe_window' set, each incoming message is recorded (as a hash of its
+sender, recipient and body) in the inbound table, and the same message arriving
+again within the window is dropped. The record is written in the same
+transaction as the rest of the message's handling, so a message whose handling
+failed isn't recorded and its retry goes through. Records older than the
+window are pruned as we go, so the table stays small.
+"""
+
+class InboundDedupe:
+    def __init__(self, conf, db, window):
+        self.conf = conf
+        self.db = db
+        self.window = window
+        self.last_prune = 0
+
+    def _key(self, message):
+        return hashlib.sha1("\0".join([str(message.sender),
+                                       str(message.recipient),
+                                       str(message.body)])).hexdigest()
+
+    def seen(self, message):
+        """ Returns True if message is a duplicate of one handled within the
+        window. Otherwise records it, without committing, and returns False.
+        """
+        db = self.db
+        t_inbound = self.conf.t_inbound
+        now = time.time()
+        key = self._key(message)
+        # Record it if it's new, or if the last one is outside the window,
+        # as a single write each. The first write takes the DB's write lock
+        # until our transaction ends, so if another process is handling the
+        # same message at the same time, it waits for us and then finds our
+        # row, rather than both of us finding nothing.
+        r = db.execute("INSERT OR IGNORE INTO %s(key, time) VALUES (?,?)" % t_inbound, (key, now))
+        if r.rowcount == 0:
+            r = db.execute("UPDATE %s SET time=? WHERE key=? AND time<=?" % t_inbound,
+                           (now, key, now - self.window))
+            if r.rowcount == 0:
+                return True
+        if now - self.last_prune >= self.window:
+            db.execute("DELETE FROM %s WHERE time < ?" % t_inbound, (now - self.window,))
+            self.last_prune = now
+        return False
@@ -0,0 +1,62 @@
+import threading
+import time
+
+"""
+Expiry of pending confirmations. Each row in the confirm table carries the
+time it expires (its creation time plus 'confirm_ttl'); confirm_action ignores
+expired rows, and long-running processes run an ExpiryScheduler that deletes
+them as they come due, so nobody has to run --clean-confirm from cron.
+"""
+
+def expire_confirm_actions(conf, db, now=None, limit=100):
+    """ Delete up to limit expired confirm actions, oldest first, and commit.
+    Returns the number deleted. """
+    if now is None:
+        now = time.time()
+    t_confirm = conf.t_confirm
+    r = db.execute("DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s WHERE expires <= ? ORDER BY expires LIMIT ?)" % \
+                   (t_confirm, t_confirm), (now, limit))
+    db.commit()
+    return r.rowcount
+
+class ExpiryScheduler(threading.Thread):
+    """ Background thread that deletes confirm actions when they expire. It
+    sleeps until the earliest expiry in the table and deletes what's due a
+    batch at a time. New actions never expire sooner than confirm_ttl from
+    now, so if nothing is due before then it doesn't need to be told about
+    them; it just checks again after confirm_ttl.
+    """
+
+    def __init__(self, conf, batch_size=100):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conf = conf
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def _next_expiry(self, db):
+        r = db.execute("SELECT MIN(expires) FROM %s" % self.conf.t_confirm)
+        row = r.fetchone()
+        db.commit() # don't hold a read transaction open while we sleep
+        return row[0]
+
+    def run(self):
+        conf = self.conf
+        db = conf.connect()
+        while not self.stopped.is_set():
+            try:
+                while expire_confirm_actions(conf, db, limit=self.batch_size) == self.batch_size:
+                    pass
+                wake = self._next_expiry(db)
+            except Exception as e:
+                conf.log.exception("Confirm expiry error.")
+                wake = None
+            now = time.time()
+            if wake is None or wake > now + conf.confirm_ttl:
+                wake = now + conf.confirm_ttl
+            self.stopped.wait(max(wake - now, 0.01))
+        db.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
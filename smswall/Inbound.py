@@ -0,0 +1,109 @@
+import Queue
+import threading
+import zlib
+
+"""
+Off-thread handling of incoming messages, for integrations whose event loop
+shouldn't wait for a post to go out to the whole list before reading the next
+message.
+
+An InboundPool has a fixed set of workers, each with its own SMSWall (and so
+its own DB connection) and its own bounded queue. Messages are routed to a
+worker by message_key, so everything sent to one list is handled in the order
+it arrived, as is everything one subscriber sends to the app number. When a
+worker's queue is full, submit() refuses the message; the integration should
+then tell the switch it wasn't handled, so it's retried later rather than
+piling up in memory.
+"""
+
+def message_key(conf, message):
+    """ What a message has to stay in order with: the list it was sent to, or
+    for commands to the app number, whoever sent it. Creating a list goes
+    with the list, so it's handled before anything sent to the new list. """
+    if str(message.recipient) == str(conf.app_number):
+        body = message.body or ""
+        if body.startswith(conf.cmd_char):
+            body = body[len(conf.cmd_char):]
+        words = body.split()
+        if len(words) == 2 and words[0].lower() == "create":
+            return "list:%s" % words[1]
+        return "sender:%s" % message.sender
+    return "list:%s" % message.recipient
+
+class InboundWorker(threading.Thread):
+    def __init__(self, pool, depth):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pool = pool
+        self.queue = Queue.Queue(depth)
+        self.ready = threading.Event()
+        self.error = None
+
+    def run(self):
+        conf = self.pool.conf
+        # Built here, so its DB connection belongs to this thread.
+        try:
+            app = self.pool.make_app()
+        except Exception as e:
+            conf.log.exception("Inbound worker couldn't start.")
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            try:
+                app.handle_incoming(message)
+            except Exception as e:
+                conf.log.exception("Inbound worker error.")
+            finally:
+                app.reset()
+        app.db.close()
+
+class InboundPool:
+    """ make_app is called once in each worker thread and should return a
+    ready-to-use SMSWall with a DB connection of its own. start() waits for
+    them all, and raises the error if any of them fails. """
+
+    def __init__(self, conf, make_app, workers, depth):
+        self.conf = conf
+        self.make_app = make_app
+        self.workers = [InboundWorker(self, depth) for i in range(max(workers, 1))]
+
+    def start(self):
+        for w in self.workers:
+            w.start()
+        for w in self.workers:
+            w.ready.wait()
+        failed = [w.error for w in self.workers if w.error]
+        if failed:
+            self.stop()
+            raise failed[0]
+
+    def submit(self, message, timeout=None):
+        """ Queue message for handling. If its worker's queue is full, wait up
+        to timeout seconds (by default, not at all) for room. Returns False if
+        the message wasn't queued. """
+        key = message_key(self.conf, message)
+        worker = self.workers[zlib.crc32(key) % len(self.workers)]
+        try:
+            worker.queue.put(message, timeout is not None, timeout)
+        except Queue.Full:
+            self.conf.metrics.inc("inbound_rejected")
+            return False
+        return True
+
+    def depth(self):
+        """ Number of messages waiting across all workers. """
+        return sum(w.queue.qsize() for w in self.workers)
+
+    def stop(self):
+        """ Handle everything already queued, then stop the workers. """
+        for w in self.workers:
+            if w.is_alive():
+                w.queue.put(None)
+        for w in self.workers:
+            if w.ident is not None:
+                w.join()
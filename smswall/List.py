@@ -1,4 +1,31 @@
 from Message import *
+from Render import *
+
+def _unique(numbers):
+    """ Numbers as strings, without duplicates, in their original order. """
+    seen = set()
+    result = []
+    for n in numbers:
+        n = str(n)
+        if not n in seen:
+            seen.add(n)
+            result.append(n)
+    return result
+
+def _numbers(cursor, chunk=FanoutJob.batch_size, span=None):
+    """ Iterate over the first column of cursor's rows as strings, fetching a
+    chunk at a time. If given, span() is the context to fetch each chunk
+    in. """
+    while True:
+        if span:
+            with span():
+                rows = cursor.fetchmany(chunk)
+        else:
+            rows = cursor.fetchmany(chunk)
+        if not rows:
+            return
+        for row in rows:
+            yield str(row[0])
 
 class List:
     """ This class is a wrapper around all the list-centric commands. """
@@ -6,45 +33,68 @@ class List:
         self.shortcode = shortcode
         self.app = app # the SMSWall app that made this List object
         self.conf = app.conf
-        self.db = self.conf.db_conn
+        self.db = app.db
+
+    def _metadata(self):
+        """ Returns the list's (owner_only, is_public) row, or None if it
+        doesn't exist, and its set of owners. """
+        return self.app.list_cache.get(self.shortcode)
+
+    def _invalidate(self):
+        self.app.list_cache.invalidate(self.shortcode)
 
     def exists(self):
-        cur = self.db.cursor()
-        cur.execute("SELECT * FROM %s WHERE shortcode=?" % self.conf.t_list, (self.shortcode,))
-        if cur.fetchone():
-            return True
-        return False
+        return self._metadata()[0] is not None
 
     def is_reserved(self):
         return self.shortcode == self.conf.app_number
 
     def is_owner(self, number):
-        r = self.db.execute("SELECT * FROM %s WHERE list=? AND owner=?" % self.conf.t_owner, (self.shortcode, number))
-        if len(r.fetchall()):
-            return True
-        return False
+        return str(number) in self._metadata()[1]
+
+    def members(self, exclude=None):
+        """ Iterates over the list's members (except exclude, if given). Rows
+        are only fetched as they're needed, so memory use doesn't depend on
+        the size of the list. Consume it before changing the list's
+        membership. Each fetch is traced as a "members" span, inside whatever
+        span is consuming it (usually "send").
+
+        The query only runs once iteration starts. An open query holds on to
+        the DB as it was when it started, and in WAL mode, a connection can't
+        write if someone else has committed since; so the outbox has to start
+        writing before it reads the members, not after. """
+        span = lambda: self.app.tracer.span("members")
+        with span():
+            if exclude is None:
+                r = self.db.execute("SELECT member FROM %s WHERE list=?" % self.conf.t_membership, (self.shortcode,))
+            else:
+                r = self.db.execute("SELECT member FROM %s WHERE list=? AND member!=?" % self.conf.t_membership,
+                                    (self.shortcode, str(exclude)))
+        for number in _numbers(r, span=span):
+            yield number
+
+    def member_count(self, exclude=None):
+        with self.app.tracer.span("members"):
+            r = self.db.execute("SELECT COUNT(*) FROM %s WHERE list=? AND member!=?" % self.conf.t_membership,
+                                (self.shortcode, str(exclude)))
+            return r.fetchone()[0]
 
     def post_to_owners(self, body):
         """
         Send a message to all the list owners.
         """
-        r = self.db.execute("SELECT owner FROM %s WHERE list=?" % self.conf.t_owner, (self.shortcode,))
-        owners = [str(o[0]) for o in r.fetchall()]
-        for o in owners:
-            msg = Message(self.conf.app_number, o, None, body)
-            self.app.send(msg)
+        owners = sorted(self._metadata()[1])
+        self.app.send_bulk(self.conf.app_number, owners, None, body)
 
     def only_owners_can_post(self):
         """ Returns true if the list only allows owners to post, and false
         otherwise. """
-        r = self.db.execute("SELECT owner_only FROM %s WHERE shortcode=?" % self.conf.t_list, (self.shortcode,))
-        return bool(r.fetchone()[0])
+        return bool(self._metadata()[0][0])
 
     def is_public(self):
         """ Returns true if the list allows anyone to join, or false if only
         owners can add members. """
-        r = self.db.execute("SELECT is_public FROM %s WHERE shortcode=?" % self.conf.t_list, (self.shortcode,))
-        return bool(r.fetchone()[0])
+        return bool(self._metadata()[0][1])
 
     def create(self, initial_owner, owners_only=False, is_public=True):
         if not self.conf.allow_list_creation:
@@ -60,6 +110,7 @@ class List:
             self.conf.log.info("Creating list %s" % self.shortcode)
             items = (self.shortcode, owners_only, is_public)
             self.db.execute("INSERT INTO %s VALUES (?,?,?)" % self.conf.t_list, items)
+            self._invalidate()
             self.app.reply("Your list '%s' has been created! Tell people to join it by sending 'join' to '%s'." % (self.shortcode, self.shortcode))
             self.make_owner(initial_owner)
 
@@ -72,19 +123,24 @@ class List:
             db = self.db
             sc = self.shortcode
 
-            res = db.execute("SELECT member FROM %s WHERE list=?" % self.conf.t_membership, (sc,))
-            members = res.fetchall()
-
-            db.execute("BEGIN TRANSACTION")
+            # Keep the members aside (in a temp table SMSWall sets up on its
+            # connection), so we can stream them the notice.
+            db.execute("DELETE FROM temp.deletedmembers")
+            db.execute("INSERT INTO temp.deletedmembers SELECT member FROM %s WHERE list=?" % self.conf.t_membership, (sc,))
             db.execute("DELETE FROM %s WHERE shortcode=?" % self.conf.t_list, (sc,))
             db.execute("DELETE FROM %s WHERE list=?" % self.conf.t_membership, (sc,))
             db.execute("DELETE FROM %s WHERE list=?" % self.conf.t_owner, (sc,))
-            db.commit()
+            self._invalidate()
+            # Queued notices commit together with the delete; sent ones only
+            # go out once it has committed.
+            if not self.app.outbox:
+                db.commit()
 
             self.app.reply("The list %s has been deleted." % self.shortcode)
-            for m in members:
-                msg = Message(self.conf.app_number, str(m[0]), None, "The list %s has been deleted, and all members (including you!) have been removed." % self.shortcode)
-                self.app.send(msg)
+            body = "The list %s has been deleted, and all members (including you!) have been removed." % self.shortcode
+            self.app.send_bulk(self.conf.app_number, _numbers(db.execute("SELECT member FROM temp.deletedmembers")), None, body)
+            db.execute("DELETE FROM temp.deletedmembers")
+            db.commit()
         else:
             self.app.add_pending_action(self.app.msg)
 
@@ -97,21 +153,53 @@ class List:
         db = self.db
         item = (self.shortcode, number)
         db.execute("INSERT OR IGNORE INTO %s(list, member) VALUES (?,?)" % self.conf.t_membership, item)
-        db.commit()
         msg = Message(self.conf.app_number, number, None, "You've been added to the list '%s'." % self.shortcode)
         self.app.send(msg)
+        db.commit()
 
         # Set the initial username to the number -- the user will get a message
         # saying how to change it.
         if self.app.get_username(number) == number:
             self.app.set_username(number, number)
 
+    def add_users(self, numbers):
+        """ Add several users to the list in one transaction. Each gets the
+        same notification as with add_user. Returns how many of them weren't
+        members already, or None if the list doesn't exist. """
+        numbers = _unique(numbers)
+        self.conf.log.info("Adding %d users to list '%s'" % (len(numbers), self.shortcode))
+        if not self.exists():
+            self.app.reply("Sorry! The list '%s' doesn't exist! Send 'help' to 1000 for help." % self.shortcode)
+            return
+        db = self.db
+        r = db.executemany("INSERT OR IGNORE INTO %s(list, member) VALUES (?,?)" % self.conf.t_membership,
+                           ((self.shortcode, n) for n in numbers))
+        added = r.rowcount
+        self.app.send_bulk(self.conf.app_number, numbers, None, "You've been added to the list '%s'." % self.shortcode)
+        self.app.set_default_usernames(numbers)
+        db.commit()
+        return added
+
+    def remove_users(self, numbers):
+        """ Remove several users (and their ownership) from the list in one
+        transaction. """
+        numbers = _unique(numbers)
+        self.conf.log.info("Removing %d users from list '%s'" % (len(numbers), self.shortcode))
+        db = self.db
+        items = [(self.shortcode, n) for n in numbers]
+        db.executemany("DELETE FROM %s WHERE list=? AND member=?" % self.conf.t_membership, items)
+        db.executemany("DELETE FROM %s WHERE list=? AND owner=?" % self.conf.t_owner, items)
+        self._invalidate()
+        self.app.send_bulk(self.conf.app_number, numbers, None, "You've been removed from the list '%s'." % self.shortcode)
+        db.commit()
+
     def delete_user(self, number):
         """ Delete the specified user from the list """
         self.conf.log.info("Deleting user '%s' from list '%s'" % (number, self.shortcode))
         db = self.db
-        db.execute("DELETE FROM %s WHERE member=?" % self.conf.t_membership, (number,))
+        db.execute("DELETE FROM %s WHERE list=? AND member=?" % self.conf.t_membership, (self.shortcode, number))
         db.execute("DELETE FROM %s WHERE list=? AND owner=?" % self.conf.t_owner, (self.shortcode, number))
+        self._invalidate()
         msg = Message(self.conf.app_number, number, None, "You've been removed from the list '%s'." % self.shortcode)
         self.app.send(msg)
         db.commit()
@@ -128,11 +216,12 @@ class List:
             return
         items = (1 if owners_only else 0, self.shortcode)
         db.execute("UPDATE OR IGNORE %s SET owner_only=? WHERE shortcode=?" % self.conf.t_list, items)
-        db.commit()
+        self._invalidate()
         if owners_only:
             self.post_to_owners("List '%s' has been set to only allow owners to post." % self.shortcode)
         else:
             self.post_to_owners("List '%s' has been set to allow anyone to post." % self.shortcode)
+        db.commit()
 
     def set_list_public(self, is_public):
         self.conf.log.info("List '%s': Setting is_public to '%s'" % (self.shortcode, bool(is_public)))
@@ -142,11 +231,12 @@ class List:
             return
         items = (1 if is_public else 0, self.shortcode)
         db.execute("UPDATE OR IGNORE %s SET is_public=? WHERE shortcode=?" % self.conf.t_list, items)
-        db.commit()
+        self._invalidate()
         if is_public:
             self.post_to_owners("List '%s' has been set to allow anyone to join." % self.shortcode)
         else:
             self.post_to_owners("List '%s' has been set to only allow owners to add list members (no public joins)." % self.shortcode)
+        db.commit()
 
 
     def make_owner(self, number):
@@ -155,25 +245,43 @@ class List:
         db = self.db
         t_owner = self.conf.t_owner
         db.execute("INSERT OR IGNORE INTO %s(list, owner) VALUES (?,?)" % t_owner, (self.shortcode, number))
-        db.commit()
+        self._invalidate()
         msg = Message(self.conf.app_number, number, None, "You've been made an owner of the list '%s'." % self.shortcode)
         self.app.send(msg)
+        db.commit()
 
     def unmake_owner(self, number):
         self.conf.log.info("Removing user '%s' as owner of list '%s'" % (number, self.shortcode))
         db = self.db
         t_owner = self.conf.t_owner
         db.execute("DELETE FROM %s WHERE list=? AND owner=?" % t_owner, (self.shortcode, number))
-        db.commit()
+        self._invalidate()
         msg = Message(self.conf.app_number, number, None, "You're no longer an owner of the list '%s'." % self.shortcode)
         self.app.send(msg)
+        db.commit()
 
     def post(self, message):
         self.conf.log.info("Posting to list '%s' message: %s" % (self.shortcode, message))
-        item = (self.shortcode,)
-        r = self.db.execute("SELECT member FROM membership WHERE list=?", item)
-        members = [str(m[0]) for m in r.fetchall() if not str(m[0]) == str(message.sender)]
-        name = self.app.get_username(str(message.sender))
-        for m in members:
-            msg = Message(self.shortcode, m, message.subject, str("(from: %s) " % name) + message.body)
-            self.app.send(msg)
+        tracer = self.app.tracer
+        with tracer.span("names"):
+            name = self.app.get_username(str(message.sender))
+        body = str("(from: %s) " % name) + message.body
+        with tracer.span("render"):
+            try:
+                rendered = render(body)
+                segments = rendered.count
+            except TooLongError as e:
+                segments = e.parts
+        # No phone can put together more than MAX_PARTS anyway.
+        limit = min(self.conf.max_segments or MAX_PARTS, MAX_PARTS)
+        if segments > limit:
+            self.app.reply("Sorry, your message is too long: it would be sent as %d texts, and lists only allow %d. Please shorten it and try again." % \
+                           (segments, limit))
+            return
+        job = FanoutJob(self.shortcode, self.members(exclude=message.sender), message.subject, body, rendered,
+                        size=self.member_count(exclude=message.sender))
+        count = self.app.send_job(job)
+        self.conf.log.info("Posted to %d members as %d %s segment(s) each." % (count, rendered.count, rendered.encoding))
+        metrics = self.app.metrics
+        metrics.observe("fanout", count)
+        metrics.observe("segments", rendered.count)
@@ -1,3 +1,5 @@
+import itertools
+
 class Message:
     """ Simple wrapper for a message. Note that ALL fields may be None! """
     def __init__(self, sender, recipient, subject, body):
@@ -17,3 +19,32 @@ class Message:
                                                self.recipient,
                                                self.subject,
                                                self.body)
+
+class FanoutJob:
+    """ One message to many recipients. There's a single copy of the body, and
+    recipients can be any iterable (e.g., List.members()), consumed a batch at
+    a time, so a fan-out to every subscriber on the network doesn't need them
+    all in memory at once. """
+
+    batch_size = 500
+
+    def __init__(self, sender, recipients, subject, body, rendered=None, size=None):
+        self.sender = sender
+        self.recipients = recipients
+        self.subject = subject
+        self.body = body
+        self.rendered = rendered # RenderedBody, if the caller already made one
+        self.size = size # number of recipients, if the caller knows
+
+    def batches(self, size=None):
+        """ Yields the recipients as lists of up to size numbers. """
+        size = size or self.batch_size
+        it = iter(self.recipients)
+        while True:
+            batch = list(itertools.islice(it, size))
+            if not batch:
+                return
+            yield batch
+
+    def __str__(self):
+        return "f='%s' s='%s' b='%s'" % (self.sender, self.subject, self.body)
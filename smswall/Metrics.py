@@ -0,0 +1,156 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+"""
+Runtime counters and histograms, for watching a busy site's capacity. Each
+process keeps its own registry (Config.metrics), shared by every connection
+and delivery worker the process opens. What we track:
+
+    inbound             counter by command ("post" for list posts, "unknown"
+                        for commands that don't exist)
+    inbound_errors      counter of messages whose handling raised
+    inbound_latency     histogram of seconds spent in handle_incoming
+    fanout              histogram of recipients per list post
+    segments            histogram of SMS segments per list post
+    sent                counter of outbound messages by sender type
+    queued              counter of messages put in the outbox
+    send_errors         counter of failed outbox deliveries by sender type
+    db_latency          histogram of seconds per sqlite statement or commit
+    db_errors           counter of failed sqlite calls by kind ("busy" or
+                        "other")
+    db_retries          counter of retries after a busy/locked error
+
+The daemon returns a snapshot for the "status" op, and with 'metrics_file' set
+the snapshot is also written to that file (as JSON) at most every
+'metrics_interval' seconds: after handling a message, and in long-running
+processes also from a thread of its own (see start_flushing), so the file
+stays current while nothing is being handled. Counts are since the process
+started, so the numbers are only meaningful for long-running processes.
+"""
+
+# Upper bounds of the histogram buckets; anything bigger lands in the last
+# ("inf") bucket.
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+SIZE_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        buckets = [[str(b), c] for b, c in zip(self.bounds, self.counts)]
+        buckets.append(["inf", self.counts[-1]])
+        return {"count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / float(self.count) if self.count else None,
+                "max": self.max,
+                "buckets": buckets}
+
+class Metrics:
+    """ Thread-safe registry of named counters and histograms. """
+
+    histograms = {"inbound_latency": LATENCY_BUCKETS,
+                  "db_latency": LATENCY_BUCKETS,
+                  "fanout": SIZE_BUCKETS}
+
+    def __init__(self, path=None, interval=60):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.hists = {}
+        self.path = path
+        self.interval = interval
+        self.last_flush = self.started
+        self.flush_lock = threading.Lock()
+        self.flusher = None
+        self.stopped = threading.Event()
+
+    def inc(self, name, key=None, n=1):
+        """ Add n to a counter. Counters with a key are broken down by it,
+        e.g. inc("sent", "test"). """
+        with self.lock:
+            if key is None:
+                self.counters[name] = self.counters.get(name, 0) + n
+            else:
+                by_key = self.counters.setdefault(name, {})
+                by_key[key] = by_key.get(key, 0) + n
+
+    def observe(self, name, value):
+        """ Record value in a histogram. """
+        with self.lock:
+            hist = self.hists.get(name)
+            if hist is None:
+                hist = self.hists[name] = Histogram(Metrics.histograms.get(name, SIZE_BUCKETS))
+            hist.observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            counters = {}
+            for name, value in self.counters.items():
+                counters[name] = dict(value) if isinstance(value, dict) else value
+            return {"time": time.time(),
+                    "started": self.started,
+                    "pid": os.getpid(),
+                    "counters": counters,
+                    "histograms": dict((n, h.snapshot()) for n, h in self.hists.items())}
+
+    def maybe_flush(self):
+        """ Write a snapshot to the metrics file if it's been long enough
+        since the last one. """
+        if self.path and time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self.path:
+            return
+        # The flusher thread and whoever's handling messages share the
+        # temporary file.
+        with self.flush_lock:
+            self.last_flush = time.time()
+            # Write and rename, so readers never see a half-written file.
+            tmp = "%s.%d" % (self.path, os.getpid())
+            f = open(tmp, "w")
+            f.write(json.dumps(self.snapshot(), sort_keys=True) + "\n")
+            f.close()
+            os.rename(tmp, self.path)
+
+    def start_flushing(self):
+        """ Flush every interval from a thread of our own, until
+        stop_flushing(). Does nothing without a metrics file, or if it's
+        already running. """
+        with self.lock:
+            if not self.path or self.flusher:
+                return
+            self.stopped.clear()
+            flusher = self.flusher = threading.Thread(target=self._flush_loop, name="metrics")
+            flusher.daemon = True
+        flusher.start()
+
+    def _flush_loop(self):
+        while not self.stopped.wait(max(self.last_flush + self.interval - time.time(), 0.01)):
+            try:
+                self.maybe_flush()
+            except Exception as e:
+                logging.getLogger("smswall").exception("Couldn't write the metrics file.")
+
+    def stop_flushing(self):
+        with self.lock:
+            flusher, self.flusher = self.flusher, None
+        if flusher:
+            self.stopped.set()
+            flusher.join()
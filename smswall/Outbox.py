@@ -0,0 +1,198 @@
+import threading
+import time
+import uuid
+
+from Render import *
+from Sender import *
+
+"""
+Durable outbound delivery. When the config sets 'delivery: outbox',
+SMSWall.send doesn't call the Sender directly; it writes the message into the
+outbox tables on the app's DB connection, so the message is committed (or
+rolled back) together with whatever state change produced it. Delivery workers
+then drain the outbox to the Sender in the background.
+
+A message is stored as one job row (sender, subject and body) plus one outbox
+row per recipient. Workers claim due rows by stamping them with a claim token
+and time; a claim that's older than the lease is considered abandoned (e.g.
+the worker crashed) and may be claimed again. Rows are only deleted once the
+Sender has accepted them, so a crash never loses a message; the worst case is
+that a batch that was in flight when a worker died is sent a second time.
+"""
+
+def _failed_rows(rows, error):
+    """ The rows a failed send didn't deliver: the ones the Sender says
+    failed, if it knows, otherwise all of them. """
+    if not isinstance(error, SendError) or error.failed is None:
+        return rows
+    failed = set(str(r) for r in error.failed)
+    return [row for row in rows if str(row[1]) in failed]
+
+class Outbox:
+    def __init__(self, conf, db):
+        self.conf = conf
+        self.db = db
+        self.log = conf.log
+
+    def enqueue(self, sender, recipients, subject, body):
+        """ Queue a message for every number in recipients, and return how
+        many were queued. This doesn't commit; the caller's transaction
+        decides whether the message goes out. recipients may be a lazy query
+        on the same connection (see List.members): it's only read once we've
+        started writing. """
+        db = self.db
+        r = db.execute("INSERT INTO %s(sender, subject, body) VALUES (?,?,?)" % self.conf.t_outbox_job,
+                       (sender, subject, body))
+        job = r.lastrowid
+        now = time.time()
+        r = db.executemany("INSERT INTO %s(job, recipient, attempts, next_attempt) VALUES (?,?,0,?)" % self.conf.t_outbox,
+                           ((job, str(rcpt), now) for rcpt in recipients))
+        count = r.rowcount
+        if count == 0:
+            # Nobody to send to; don't leave a job that nothing will clean up.
+            db.execute("DELETE FROM %s WHERE id=?" % self.conf.t_outbox_job, (job,))
+        self.conf.metrics.inc("queued", n=count)
+        return count
+
+    def claim(self, limit):
+        """ Claim up to limit messages that are due for delivery. Returns a list
+        of (sender, subject, body, [(row id, recipient, attempts), ...]), one
+        entry per job. """
+        db = self.db
+        t_outbox = self.conf.t_outbox
+        now = time.time()
+        token = uuid.uuid4().hex
+        db.execute("UPDATE %s SET claimed=?, claim=? WHERE id IN (SELECT id FROM %s WHERE (claimed IS NULL OR claimed <= ?) AND next_attempt <= ? ORDER BY id LIMIT ?)" % (t_outbox, t_outbox),
+                   (now, token, now - self.conf.delivery_lease, now, limit))
+        db.commit()
+        r = db.execute("SELECT o.id, o.recipient, o.attempts, j.sender, j.subject, j.body FROM %s o JOIN %s j ON o.job = j.id WHERE o.claim=? ORDER BY o.id" % (t_outbox, self.conf.t_outbox_job),
+                       (token,))
+        batches = []
+        last = None
+        for row_id, recipient, attempts, sender, subject, body in r.fetchall():
+            key = (sender, subject, body)
+            if key != last:
+                batches.append((sender, subject, body, []))
+                last = key
+            batches[-1][3].append((row_id, recipient, attempts))
+        return batches
+
+    def delivered(self, rows):
+        """ Remove delivered rows, and any jobs that have nothing left. """
+        db = self.db
+        db.executemany("DELETE FROM %s WHERE id=?" % self.conf.t_outbox,
+                       ((row[0],) for row in rows))
+        db.execute("DELETE FROM %s WHERE NOT EXISTS (SELECT 1 FROM %s WHERE job=%s.id)" % \
+                   (self.conf.t_outbox_job, self.conf.t_outbox, self.conf.t_outbox_job))
+        db.commit()
+
+    def failed(self, rows):
+        """ Schedule failed rows for another attempt with exponential backoff,
+        or give up on them if they've run out of attempts. """
+        db = self.db
+        now = time.time()
+        retry = []
+        dead = []
+        for row_id, recipient, attempts in rows:
+            attempts += 1
+            if attempts >= self.conf.delivery_attempts:
+                self.log.error("Giving up on delivery to %s after %d attempts." % (recipient, attempts))
+                dead.append((row_id, recipient, attempts))
+            else:
+                delay = self.conf.delivery_backoff * (2 ** (attempts - 1))
+                retry.append((attempts, now + delay, row_id))
+        db.executemany("UPDATE %s SET attempts=?, next_attempt=?, claimed=NULL, claim=NULL WHERE id=?" % self.conf.t_outbox,
+                       retry)
+        db.commit()
+        if dead:
+            self.delivered(dead)
+
+    def deliver(self, sender, limit=100):
+        """ Claim one round of due messages and hand them to sender. Returns
+        the number of messages attempted. """
+        metrics = self.conf.metrics
+        sender_type = sender.name
+        count = 0
+        for from_, subject, body, rows in self.claim(limit):
+            recipients = [row[1] for row in rows]
+            try:
+                sender.send_rendered(from_, recipients, subject, render(body))
+                bad = []
+            except Exception as e:
+                bad = _failed_rows(rows, e)
+                self.log.exception("Delivery of %d of %d messages from %s failed." % (len(bad), len(rows), from_))
+            # Only retry what didn't go out; the rest would be duplicates.
+            bad_ids = set(row[0] for row in bad)
+            good = [row for row in rows if not row[0] in bad_ids]
+            if good:
+                metrics.inc("sent", sender_type, len(good))
+                self.delivered(good)
+            if bad:
+                metrics.inc("send_errors", sender_type, len(bad))
+                self.failed(bad)
+            count += len(rows)
+        return count
+
+    def drain(self, sender, limit=100):
+        """ Deliver everything that's currently due. """
+        total = 0
+        while True:
+            count = self.deliver(sender, limit)
+            if count == 0:
+                return total
+            total += count
+
+class DeliveryWorker(threading.Thread):
+    """ Background thread that drains the outbox to the app's Sender. Each
+    worker uses its own DB connection, since sqlite connections can't be shared
+    across threads. They all share the Sender, so unless it's thread_safe,
+    they take turns with it. """
+
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pool = pool
+
+    def run(self):
+        pool = self.pool
+        conf = pool.app.conf
+        outbox = Outbox(conf, conf.connect())
+        while not pool.stopped.is_set():
+            sender = pool.app.msg_sender
+            if not sender.thread_safe:
+                sender = LockedSender(sender, pool.send_lock)
+            try:
+                count = outbox.deliver(sender, pool.batch_size)
+            except Exception as e:
+                conf.log.exception("Delivery worker error.")
+                count = 0
+            if count == 0:
+                pool.wakeup.wait(pool.poll_interval)
+                pool.wakeup.clear()
+        outbox.db.close()
+
+class DeliveryPool:
+    """ A set of DeliveryWorkers for one SMSWall. """
+
+    def __init__(self, app, workers, batch_size=100, poll_interval=1.0):
+        self.app = app
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.send_lock = threading.Lock()
+        self.workers = [DeliveryWorker(self) for i in range(workers)]
+
+    def start(self):
+        for w in self.workers:
+            w.start()
+
+    def notify(self):
+        """ Tell idle workers there's new mail. """
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        for w in self.workers:
+            w.join()
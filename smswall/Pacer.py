@@ -0,0 +1,117 @@
+import threading
+import time
+
+from Sender import *
+
+"""
+Outbound pacing. Handing a big fan-out to smqueue (and the BTS behind it) all
+at once just fills its queues; messages then get retried and delivery ends up
+slower than if we'd sent at the rate the radio can actually take. So senders
+with a configured rate ('send_rates' in the config, keyed by Sender.name) get
+wrapped in a PacedSender, which spreads what it sends over time with a token
+bucket.
+
+Pacing blocks whoever is sending, so with direct delivery a post to a big list
+holds up handling of the next message until it's all out. With outbox delivery
+only the delivery workers wait. Each process has its own bucket, so the rate
+is per process; the sharded daemon (see Shard.py) splits it between its
+workers.
+"""
+
+class TokenBucket:
+    """ Allows rate tokens per second on average, and up to burst at once.
+    Thread-safe; threads that want tokens at the same time are served in
+    the order they asked. """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, n=1):
+        """ Take n tokens, going into debt if there aren't enough. Returns
+        how many seconds the caller has to wait before using them. """
+        with self.lock:
+            self._refill(time.time())
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def take(self, n=1):
+        """ Wait until n tokens are available and take them. """
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def eta(self, n):
+        """ Seconds until n more tokens could be taken, given what other
+        threads have already reserved. """
+        with self.lock:
+            self._refill(time.time())
+            return max(0, (n - self.tokens) / self.rate)
+
+class PacedSender(Sender):
+    """ Wraps a Sender so it sends no faster than its bucket allows. """
+
+    def __init__(self, sender, bucket, log):
+        self.sender = sender
+        self.bucket = bucket
+        self.log = log
+        self.name = sender.name
+        # Hand the wrapped sender about a tenth of a second's worth at a
+        # time, so a bulk send goes out steadily rather than in bursts.
+        self.chunk = max(1, min(bucket.burst, int(bucket.rate / 10)))
+
+    @property
+    def thread_safe(self):
+        # The bucket is; whether we are is up to the wrapped sender.
+        return self.sender.thread_safe
+
+    def send_sms(self, sender, recipient, subject, data):
+        self.bucket.take()
+        return self.sender.send_sms(sender, recipient, subject, data)
+
+    def expect(self, sender, messages):
+        eta = self.bucket.eta(messages)
+        if eta >= 1:
+            self.log.info("Pacing %d messages from %s at %g/s, expect to finish in %.0fs (at %s)." % \
+                          (messages, sender, self.bucket.rate, eta,
+                           time.strftime("%H:%M:%S", time.localtime(time.time() + eta))))
+
+    def _paced(self, sender, recipients, cost, send):
+        """ Call send(batch) for batches of recipients, where sending to one
+        recipient costs cost tokens. Recipients a SendError says failed are
+        collected and raised at the end. Any other failure is raised as it
+        is, as it would be without pacing: nobody knows which of that batch
+        went out, so neither do we. """
+        recipients = list(recipients)
+        chunk = max(1, self.chunk / cost)
+        failed = []
+        for i in range(0, len(recipients), chunk):
+            batch = recipients[i:i + chunk]
+            self.bucket.take(len(batch) * cost)
+            try:
+                send(batch)
+            except SendError as e:
+                if e.failed is None:
+                    raise
+                failed.extend(e.failed)
+        if failed:
+            raise SendError("Sending to %d of %d recipients failed." % (len(failed), len(recipients)), failed)
+
+    def send_bulk(self, sender, recipients, subject, data):
+        self._paced(sender, recipients, 1,
+                    lambda batch: self.sender.send_bulk(sender, batch, subject, data))
+
+    def send_rendered(self, sender, recipients, subject, rendered):
+        # Every segment takes its own slot on the air.
+        self._paced(sender, recipients, rendered.count,
+                    lambda batch: self.sender.send_rendered(sender, batch, subject, rendered))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Segment counting for outgoing bodies. A body that fits the GSM 03.38 7-bit
+alphabet goes out as GSM-7 (160 characters in a single SMS, 153 per part of a
+concatenated one); anything else needs UCS-2 (70, or 67 per part). We work
+this out and split the body once per post, so we know how many SMS a post will
+put on the air before we start sending it (for max_segments, pacing and
+metrics).
+
+All our Senders hand plain text (RenderedBody.text) to the switch, which does
+its own segmenting.
+"""
+
+GSM7_BASIC = (u"@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+              u"¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM7_EXTENSION = {u"\x0c": 0x0A, u"^": 0x14, u"{": 0x28, u"}": 0x29, u"\\": 0x2F,
+                  u"[": 0x3C, u"~": 0x3D, u"]": 0x3E, u"|": 0x40, u"€": 0x65}
+_gsm7_codes = dict((c, i) for i, c in enumerate(GSM7_BASIC) if c != u"\x1b")
+ESCAPE = 0x1B
+
+# (single SMS, each part of a concatenated SMS), in septets or UTF-16 units.
+LIMITS = {"gsm7": (160, 153), "ucs2": (70, 67)}
+MAX_PARTS = 255
+
+class TooLongError(ValueError):
+    """ The body would need more than MAX_PARTS segments; parts is how many.
+    """
+
+    def __init__(self, parts):
+        ValueError.__init__(self, "Body needs %d parts; SMS allows at most %d." % (parts, MAX_PARTS))
+        self.parts = parts
+
+def _decode(body):
+    if isinstance(body, unicode):
+        return body
+    try:
+        return body.decode("utf-8")
+    except UnicodeDecodeError:
+        return body.decode("latin-1")
+
+def _septets(c):
+    """ GSM-7 codes for c, or None if it's not in the alphabet. """
+    code = _gsm7_codes.get(c)
+    if code is not None:
+        return [code]
+    code = GSM7_EXTENSION.get(c)
+    if code is not None:
+        return [ESCAPE, code]
+    return None
+
+def _ucs2_units(c):
+    """ UTF-16 units c takes. On a narrow build, a character outside the BMP
+    is already a surrogate pair; the pair is counted against its first half,
+    so the two are never split between parts. """
+    if u"\ud800" <= c <= u"\udbff":
+        return 2
+    if u"\udc00" <= c <= u"\udfff":
+        return 0
+    return len(c.encode("utf-16-be")) / 2
+
+class RenderedBody:
+    """ A body split into SMS segments.
+        - text: the body as given.
+        - encoding: "gsm7" or "ucs2".
+        - parts: the text of each segment, as unicode.
+    """
+
+    def __init__(self, text, encoding, parts):
+        self.text = text
+        self.encoding = encoding
+        self.parts = parts
+
+    @property
+    def count(self):
+        """ Number of SMS it takes to send this to one recipient. """
+        return len(self.parts)
+
+def render(body):
+    """ Work out the encoding and segments for body (a byte string in UTF-8,
+    or unicode). """
+    text = _decode(body)
+    costs = []
+    encoding = "gsm7"
+    for c in text:
+        septets = _septets(c)
+        if septets is None:
+            encoding = "ucs2"
+            break
+        costs.append(len(septets))
+    if encoding == "ucs2":
+        costs = [_ucs2_units(c) for c in text]
+
+    single, multi = LIMITS[encoding]
+    if sum(costs) <= single:
+        parts = [text]
+    else:
+        # Split without breaking up an escape sequence or surrogate pair.
+        parts = []
+        start = 0
+        used = 0
+        for i, cost in enumerate(costs):
+            if used + cost > multi:
+                parts.append(text[start:i])
+                start = i
+                used = 0
+            used += cost
+        parts.append(text[start:])
+        if len(parts) > MAX_PARTS:
+            raise TooLongError(len(parts))
+    return RenderedBody(body, encoding, parts)
@@ -6,39 +6,178 @@ import yaml
 from smswall import *
 
 class SMSWall:
-    def __init__(self, conf):
+    def __init__(self, conf, db=None):
+        """ Uses conf's connection unless given another one, e.g. for an
+        SMSWall that runs in a thread of its own. """
         self.msg = None
         self.conf = conf
-        self.db = conf.db_conn
+        self.db = db or conf.db_conn
         self.cmd_handler = CommandHandler(self)
-        self.msg_sender = self._init_sender(self.conf.sender_type)
-        self._init_db(self.db)
+        self.set_sender(self._init_sender(self.conf.sender_type))
         self.log = self.conf.log
+        self._init_db(self.db)
+        self.list_cache = ListCache(self.conf, self.db)
+        self.name_cache = NameCache(self.conf, self.db, self.conf.name_cache_size)
+        self.outbox = self._init_outbox(self.conf.delivery)
+        self.dedupe = InboundDedupe(self.conf, self.db, self.conf.dedupe_window) if self.conf.dedupe_window else None
+        self.tracer = Tracer(self.conf.trace_file) if self.conf.trace_file else NullTracer()
+        self.metrics = self.conf.metrics
+        self.delivery_pool = None
+        self.expiry = None
         self.log.debug("Init done.")
 
     def _init_sender(self, sender_type):
         """ Returns a Sender object according to the specified sender type.
-        Currently, we support two types of Sender:
+        Currently, we support three types of Sender:
             - "log": Write the sent SMS messages to a log file
             - "test": Write the sent SMS messages to an easy-to-parse log
+            - "smqueue": Send straight to smqueue (see Smqueue.py)
+        The Yate and FreeSWITCH integrations replace the first two with their
+        own Sender.
         """
         if sender_type == "log":
             return LogSender()
         if sender_type == "test":
             return TestSender()
+        if sender_type == "smqueue":
+            return SmqueueSender(self.conf)
         raise ValueError("No sender of type '%s' exists." % sender_type)
 
+    def set_sender(self, sender, paced=False):
+        """ Send outgoing messages through sender, paced if the config sets a
+        rate for its backend. Integrations with their own Sender should set it
+        with this rather than assigning msg_sender. Pass paced=True if sender
+        is already paced, e.g. it's another SMSWall's msg_sender; SMSWalls in
+        one process should share one, so the rate applies to them all. """
+        rate = self.conf.send_rates.get(sender.name)
+        if rate and not paced:
+            sender = PacedSender(sender, TokenBucket(rate, self.conf.send_burst), self.conf.log)
+        self.msg_sender = sender
+
+    def _init_outbox(self, delivery):
+        """ Returns the Outbox to queue messages in, or None if we send
+        directly. """
+        if delivery == "direct":
+            return None
+        if delivery == "outbox":
+            return Outbox(self.conf, self.db)
+        raise ValueError("No delivery mode '%s' exists." % delivery)
+
+    def start_delivery(self):
+        """ Start background delivery workers. Only long-running processes
+        should do this; one-shot ones should call deliver_pending() instead. """
+        if self.outbox and not self.delivery_pool:
+            self.delivery_pool = DeliveryPool(self, self.conf.delivery_workers)
+            self.delivery_pool.start()
+
+    def stop_delivery(self):
+        if self.delivery_pool:
+            self.delivery_pool.stop()
+            self.delivery_pool = None
+
+    def start_expiry(self):
+        """ Start deleting confirm actions as they expire. Only long-running
+        processes should do this. """
+        if not self.expiry:
+            self.expiry = ExpiryScheduler(self.conf)
+            self.expiry.start()
+
+    def stop_expiry(self):
+        if self.expiry:
+            self.expiry.stop()
+            self.expiry = None
+
+    def start_workers(self):
+        """ Start all the background threads a long-running process should
+        run: outbox delivery, confirm expiry and writing the metrics file. """
+        self.start_delivery()
+        self.start_expiry()
+        self.metrics.start_flushing()
+
+    def stop_workers(self):
+        self.stop_delivery()
+        self.stop_expiry()
+        self.metrics.stop_flushing()
+
+    def deliver_pending(self):
+        """ Synchronously deliver everything that's due in the outbox. """
+        if self.outbox:
+            self.outbox.drain(self.msg_sender)
+
+    # Schema migrations, in order. Running migrations[i] takes the DB from
+    # schema version i to version i+1. Never change or reorder a migration that
+    # has shipped; add a new one at the end instead.
+    migrations = ["_migrate_base_tables",
+                  "_migrate_lookup_indexes",
+                  "_migrate_without_rowid",
+                  "_migrate_list_version",
+                  "_migrate_name_version",
+                  "_migrate_inbound",
+                  "_migrate_confirm_expiry",
+                  "_migrate_universal_sync"]
+
     def _init_db(self, db_conn, purge=False):
-        # XXX: Should use a separate connection for IMMEDIATE transactions?
         db = db_conn
         if purge:
             db.execute("BEGIN TRANSACTION")
             tables = [self.conf.t_list, self.conf.t_membership, \
-                      self.conf.t_owner, self.conf.t_confirm]
+                      self.conf.t_owner, self.conf.t_confirm, \
+                      self.conf.t_name, self.conf.t_outbox, \
+                      self.conf.t_outbox_job, self.conf.t_list_version, \
+                      self.conf.t_name_version, self.conf.t_inbound,
+                      self.conf.t_universal_sync, self.conf.t_schema]
             for t in tables:
-                db.execute("DROP TABLE %s" % t)
+                db.execute("DROP TABLE IF EXISTS %s" % t)
             db.commit()
 
+        # Once the schema is current this is the only query we make, so
+        # starting up doesn't cost a pile of DDL.
+        if self._schema_version(db) < len(SMSWall.migrations):
+            self._migrate(db)
+
+        # Scratch space for List.delete. It's DDL, which the sqlite3 module
+        # commits around, so it's done here rather than mid-message.
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS deletedmembers (member TEXT)")
+        db.commit()
+
+    def _schema_version(self, db):
+        try:
+            r = db.execute("SELECT version FROM %s" % self.conf.t_schema)
+        except sqlite3.OperationalError as e:
+            # No version table: either a new DB or one that predates
+            # versioning. Migration 0 is safe to run on either.
+            return 0
+        row = r.fetchone()
+        return row[0] if row else 0
+
+    def _migrate(self, db):
+        """ Bring the schema up to date. All pending migrations run in a single
+        IMMEDIATE transaction, so concurrent processes starting up at the same
+        time don't both try to migrate, and a failed migration leaves the DB as
+        it was. """
+        # The sqlite3 module commits before any DDL statement on its own, so
+        # take manual control of the transaction.
+        db.commit()
+        isolation_level = db.isolation_level
+        db.isolation_level = None
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("CREATE TABLE IF NOT EXISTS %s (version INTEGER)" % self.conf.t_schema)
+                version = self._schema_version(db)
+                for i in range(version, len(SMSWall.migrations)):
+                    self.log.info("Migrating DB schema to version %d." % (i + 1))
+                    getattr(self, SMSWall.migrations[i])(db)
+                db.execute("DELETE FROM %s" % self.conf.t_schema)
+                db.execute("INSERT INTO %s VALUES (?)" % self.conf.t_schema, (len(SMSWall.migrations),))
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.isolation_level = isolation_level
+
+    def _migrate_base_tables(self, db):
         # Parameter substitution doesn't work for table names, but we scrub
         # unsafe names in the accessors for the table name properties so these
         # should be fine.
@@ -47,7 +186,74 @@ class SMSWall:
         db.execute("CREATE TABLE IF NOT EXISTS %s (list TEXT, owner TEXT, UNIQUE(list, owner) ON CONFLICT IGNORE)" % self.conf.t_owner)
         db.execute("CREATE TABLE IF NOT EXISTS %s (time REAL, sender TEXT, receiver TEXT, command TEXT)" % self.conf.t_confirm)
         db.execute("CREATE TABLE IF NOT EXISTS %s (number TEXT, name TEXT, UNIQUE(number) ON CONFLICT IGNORE)" % self.conf.t_name)
-        db.commit()
+        db.execute("CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, sender TEXT, subject TEXT, body TEXT)" % self.conf.t_outbox_job)
+        db.execute("CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, job INTEGER, recipient TEXT, attempts INTEGER, next_attempt REAL, claimed REAL, claim TEXT)" % self.conf.t_outbox)
+        db.execute("CREATE INDEX IF NOT EXISTS %s_due ON %s (next_attempt)" % (self.conf.t_outbox, self.conf.t_outbox))
+        db.execute("CREATE INDEX IF NOT EXISTS %s_job ON %s (job)" % (self.conf.t_outbox, self.conf.t_outbox))
+        db.execute("CREATE INDEX IF NOT EXISTS %s_claim ON %s (claim)" % (self.conf.t_outbox, self.conf.t_outbox))
+
+    def _migrate_lookup_indexes(self, db):
+        # For lookups by member alone, confirm_action's by sender, and
+        # clean_confirm_actions' by time.
+        db.execute("CREATE INDEX IF NOT EXISTS %s_member ON %s (member)" % (self.conf.t_membership, self.conf.t_membership))
+        db.execute("CREATE INDEX IF NOT EXISTS %s_sender ON %s (sender)" % (self.conf.t_confirm, self.conf.t_confirm))
+        db.execute("CREATE INDEX IF NOT EXISTS %s_time ON %s (time)" % (self.conf.t_confirm, self.conf.t_confirm))
+
+    def _migrate_without_rowid(self, db):
+        """ Rebuild membership and owner as WITHOUT ROWID tables keyed on
+        (list, number). Every lookup on these tables goes through that key, so
+        this drops the rowid b-tree and the separate UNIQUE index. """
+        if sqlite3.sqlite_version_info < (3, 8, 2):
+            self.log.info("SQLite %s doesn't support WITHOUT ROWID, skipping." % sqlite3.sqlite_version)
+            return
+        for table, column in [(self.conf.t_membership, "member"),
+                              (self.conf.t_owner, "owner")]:
+            new = "%snew" % table
+            db.execute("CREATE TABLE %s (list TEXT, %s TEXT, PRIMARY KEY(list, %s) ON CONFLICT IGNORE) WITHOUT ROWID" % (new, column, column))
+            db.execute("INSERT INTO %s SELECT list, %s FROM %s WHERE list IS NOT NULL AND %s IS NOT NULL" % (new, column, table, column))
+            db.execute("DROP TABLE %s" % table)
+            db.execute("ALTER TABLE %s RENAME TO %s" % (new, table))
+        db.execute("CREATE INDEX IF NOT EXISTS %s_member ON %s (member)" % (self.conf.t_membership, self.conf.t_membership))
+
+    def _migrate_list_version(self, db):
+        """ Keep a counter that moves whenever the list or owner tables change,
+        so ListCache can tell whether another process touched list metadata.
+        """
+        t_version = self.conf.t_list_version
+        db.execute("CREATE TABLE IF NOT EXISTS %s (version INTEGER)" % t_version)
+        db.execute("INSERT INTO %s VALUES (0)" % t_version)
+        for table in [self.conf.t_list, self.conf.t_owner]:
+            for op in ["INSERT", "UPDATE", "DELETE"]:
+                db.execute("CREATE TRIGGER IF NOT EXISTS %s_%s_version AFTER %s ON %s BEGIN UPDATE %s SET version = version + 1; END" % \
+                           (table, op.lower(), op, table, t_version))
+
+    def _migrate_name_version(self, db):
+        """ Same as the list version counter, but for the name table. """
+        t_version = self.conf.t_name_version
+        db.execute("CREATE TABLE IF NOT EXISTS %s (version INTEGER)" % t_version)
+        db.execute("INSERT INTO %s VALUES (0)" % t_version)
+        for op in ["INSERT", "UPDATE", "DELETE"]:
+            db.execute("CREATE TRIGGER IF NOT EXISTS %s_%s_version AFTER %s ON %s BEGIN UPDATE %s SET version = version + 1; END" % \
+                       (self.conf.t_name, op.lower(), op, self.conf.t_name, t_version))
+
+    def _migrate_inbound(self, db):
+        """ Recently handled incoming messages, for InboundDedupe. """
+        db.execute("CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, time REAL)" % self.conf.t_inbound)
+        db.execute("CREATE INDEX IF NOT EXISTS %s_time ON %s (time)" % (self.conf.t_inbound, self.conf.t_inbound))
+
+    def _migrate_confirm_expiry(self, db):
+        """ Give each confirm action an expiry time, indexed so expired
+        actions can be found and deleted in order. """
+        t_confirm = self.conf.t_confirm
+        db.execute("ALTER TABLE %s ADD COLUMN expires REAL" % t_confirm)
+        db.execute("UPDATE %s SET expires = time + ?" % t_confirm, (self.conf.confirm_ttl,))
+        db.execute("CREATE INDEX IF NOT EXISTS %s_expires ON %s (expires)" % (t_confirm, t_confirm))
+
+    def _migrate_universal_sync(self, db):
+        """ The subscriber registry's state as of the last sync of each
+        universal list, for scripts/make-universal-list.py. Older versions of
+        that script created the table themselves. """
+        db.execute("CREATE TABLE IF NOT EXISTS %s (list TEXT PRIMARY KEY, watermark TEXT)" % self.conf.t_universal_sync)
 
     def is_valid_shortcode(self, number):
         try:
@@ -62,80 +268,212 @@ class SMSWall:
 
     def set_username(self, number, name):
         self.log.debug("Setting name %s: %s" % (number, name))
-        r = self.db.execute("SELECT name FROM %s WHERE number=?" % self.conf.t_name, (number,))
-        res = r.fetchall()
-        if len(res) == 0:
+        current = self._lookup_username(number)
+        if current is None:
             self.db.execute("INSERT INTO %s(number, name) VALUES (?,?)" % self.conf.t_name, (number, name))
-        elif res[0][0] == name:
+        elif current == name:
             self.log.debug("Name is the same, skipping.")
             return
         else:
             self.db.execute("UPDATE OR IGNORE %s SET name=? WHERE number=?" % self.conf.t_name, (name, number))
-        self.db.commit()
+        self.name_cache.put(number, name)
         resp = "Your name has been set to '%s'. Send 'help setname' to %s for info on changing it." % (name, self.conf.app_number)
         m = Message(self.conf.app_number, number, None, resp)
         self.send(m)
+        self.db.commit()
+
+    def set_default_usernames(self, numbers):
+        """ Batch version of what add_user does for new members: anyone who
+        doesn't have a name yet gets their number as their name, and a message
+        saying how to change it. Doesn't commit. """
+        names = self._lookup_usernames(numbers)
+        unnamed = [n for n in numbers if names[n] is None]
+        if not unnamed:
+            return
+        self.log.debug("Setting default names for %d numbers." % len(unnamed))
+        self.db.executemany("INSERT INTO %s(number, name) VALUES (?,?)" % self.conf.t_name,
+                            ((n, n) for n in unnamed))
+        for n in unnamed:
+            self.name_cache.put(n, n)
+            resp = "Your name has been set to '%s'. Send 'help setname' to %s for info on changing it." % (n, self.conf.app_number)
+            self.send(Message(self.conf.app_number, n, None, resp))
+
+    def import_members(self, shortcode, owner, numbers):
+        """ Owner-side bulk add, e.g. from a file: the same as owner sending
+        'add' with every number to the list. """
+        self.msg = Message(owner, shortcode, None, None)
+        list_ = List(shortcode, self)
+        if not list_.is_owner(owner):
+            raise CommandError("Sorry, only a list owner may do that.")
+        added = list_.add_users(numbers)
+        if added is None:
+            return
+        self.reply("Added %d numbers to the list '%s'." % (added, shortcode))
+        self.db.commit()
+
+    def _lookup_username(self, number):
+        """ Returns the name set for number, or None if there isn't one. """
+        name = self.name_cache.get(number)
+        if name is NameCache.MISSING:
+            r = self.db.execute("SELECT name FROM %s WHERE number=?" % self.conf.t_name, (number,))
+            row = r.fetchone()
+            name = row[0] if row else None
+            self.name_cache.put(number, name)
+        return name
 
     def get_username(self, number):
-        r = self.db.execute("SELECT name FROM %s WHERE number=?" % self.conf.t_name, (number,))
-        try:
-            name = r.fetchone()[0]
-        except Exception as e:
+        name = self._lookup_username(number)
+        if name is None:
             name = number
         return name
 
+    def get_usernames(self, numbers):
+        """ Batch version of get_username. Returns a dict mapping each number
+        to its name, looking up everything that isn't cached in as few queries
+        as possible. """
+        names = self._lookup_usernames(numbers)
+        for n in names:
+            if names[n] is None:
+                names[n] = n
+        return names
+
+    def _lookup_usernames(self, numbers):
+        """ Batch version of _lookup_username: like get_usernames, but numbers
+        without a name map to None. """
+        names = {}
+        missing = []
+        for n in numbers:
+            name = self.name_cache.get(n)
+            if name is NameCache.MISSING:
+                missing.append(n)
+            else:
+                names[n] = name
+        # Stay well under SQLite's limit on the number of bound parameters.
+        chunk = 500
+        for i in range(0, len(missing), chunk):
+            batch = missing[i:i + chunk]
+            found = {}
+            r = self.db.execute("SELECT number, name FROM %s WHERE number IN (%s)" % \
+                                (self.conf.t_name, ",".join("?" * len(batch))), batch)
+            for number, name in r.fetchall():
+                found[str(number)] = name
+            for n in batch:
+                name = found.get(str(n))
+                self.name_cache.put(n, name)
+                names[n] = name
+        return names
+
     def handle_incoming(self, message, confirmed=False):
         self.log.info("Incoming: %s" % message)
         self.msg = message
-        if not message.is_valid():
-            log.info("Ignoring invalid message.")
-            return
-        elif self.cmd_handler.looks_like_command(message):
-            self.parse_command(message, confirmed)
-        else:
-            self.post_to_list(message)
+        metrics = self.metrics
+        start = time.time()
+        tracer = self.tracer
+        tracer.begin(message)
+        try:
+            # A confirmed action runs inside the message that confirmed it,
+            # which has already revalidated. Doing it again would also commit
+            # that message's writes so far, since the sqlite3 module commits
+            # before a PRAGMA.
+            if not confirmed:
+                with tracer.span("revalidate"):
+                    self.list_cache.revalidate()
+                    self.name_cache.revalidate()
+            if not message.is_valid():
+                self.log.info("Ignoring invalid message.")
+                metrics.inc("inbound", "invalid")
+                return
+            # A confirmed action is the replay of a message we've already
+            # let through.
+            if self.dedupe and not confirmed:
+                with tracer.span("dedupe"):
+                    duplicate = self.dedupe.seen(message)
+                if duplicate:
+                    self.log.info("Dropping duplicate of a recent message.")
+                    metrics.inc("inbound", "duplicate")
+                    return
+            with tracer.span("parse"):
+                command = self.cmd_handler.tokenize(message)
+            if command:
+                self.run_command(message, command, confirmed)
+            else:
+                self.post_to_list(message)
+            # Anything queued in the outbox goes out with this commit.
+            with tracer.span("commit"):
+                self.db.commit()
+        except:
+            # Don't leave a half-handled message's writes open for the next
+            # one, or cached reads of rows that were never committed.
+            self.db.rollback()
+            self.list_cache.invalidate()
+            self.name_cache.invalidate()
+            if not confirmed:
+                metrics.inc("inbound_errors")
+            raise
+        finally:
+            tracer.end()
+        if self.delivery_pool:
+            self.delivery_pool.notify()
+        # A confirmed action is timed as part of the message that confirmed
+        # it.
+        if not confirmed:
+            metrics.observe("inbound_latency", time.time() - start)
+            metrics.maybe_flush()
+
+    def reset(self):
+        """ Clear per-message state. Long-lived processes that reuse one
+        SMSWall for many messages should call this after each one. """
+        self.msg = None
 
     def confirm_action(self, sender):
         """ Confirm some pending action. Sensitive actions, like deleting a
         list, may need to be confirmed before they are actually executed. These
-        actions are stored in the confirm_action table, which we should
-        periodically flush. The stored action is just a command message that
-        gets re-submitted to handle_incoming with the 'confirmed' flag set to
-        true.
+        actions are stored in the confirm_action table until they expire
+        (see Expiry.py); expired actions can't be confirmed even if they
+        haven't been deleted yet. The stored action is just a command message
+        that gets re-submitted to handle_incoming with the 'confirmed' flag set
+        to true.
         """
         db = self.db
-        r = db.execute("SELECT sender, receiver, command FROM %s WHERE sender=?" % self.conf.t_confirm, (sender,))
-        conf_actions = r.fetchall()
-        if len(conf_actions) == 0:
+        r = db.execute("SELECT sender, receiver, command FROM %s WHERE sender=? AND expires > ? ORDER BY time DESC LIMIT 1" % self.conf.t_confirm,
+                       (sender, time.time()))
+        row = r.fetchone()
+        # Whatever was pending, it's dealt with now.
+        db.execute("DELETE FROM %s WHERE sender=?" % self.conf.t_confirm, (sender,))
+        if row is None:
             self.reply("There is nothing awaiting confirmation for you.")
             return
 
-        assert(len(conf_actions) == 1)
-        sender, recipient, command = conf_actions[0]
+        sender, recipient, command = row
         confirm_msg = Message(sender, recipient, None, command)
-        i = (sender,)
-        db.execute("DELETE FROM %s WHERE sender=?" % self.conf.t_confirm, i)
         self.handle_incoming(confirm_msg, True)
 
     def add_pending_action(self, message):
         """ A user can have up to one pending action. This method generates a
         confirmation response to the sender. """
         t_confirm = self.conf.t_confirm
-        items = (time.time(), message.sender, message.recipient, message.body)
-        self.db.execute("INSERT INTO %s VALUES (?,?,?,?)" % t_confirm, items)
-        self.db.commit()
+        now = time.time()
+        # A new action replaces whatever the sender had pending.
+        self.db.execute("DELETE FROM %s WHERE sender=?" % t_confirm, (message.sender,))
+        items = (now, message.sender, message.recipient, message.body, now + self.conf.confirm_ttl)
+        self.db.execute("INSERT INTO %s(time, sender, receiver, command, expires) VALUES (?,?,?,?,?)" % t_confirm, items)
         self.reply("Reply to this message with the word \"confirm\" to " +
                     "confirm your previous command.")
+        self.db.commit()
 
     def post_to_list(self, message):
         """ Post a message to a list. """
         list_ = List(message.recipient, self)
-        if not list_.exists():
+        with self.tracer.span("authorize"):
+            exists = list_.exists()
+            allowed = exists and (not list_.only_owners_can_post() or list_.is_owner(message.sender))
+        if not exists:
             self.reply("The list %s doesn't exist. Try sending 'help' to 1000 for help." % message.recipient)
             return
-        if list_.only_owners_can_post() and not list_.is_owner(message.sender):
+        if not allowed:
             self.reply("Sorry, only list owners may post to this list.")
             return
+        self.metrics.inc("inbound", "post")
         list_.post(message)
 
     def clean_confirm_actions(self, age):
@@ -160,35 +498,77 @@ class SMSWall:
         self.send(m)
 
     def send(self, message):
-        """ Send the specified message. """
+        """ Send the specified message. In outbox mode this only queues it;
+        it's sent once the current transaction commits. """
         sender = message.sender
         recv = message.recipient
         subj = message.subject
         body = message.body
 
         self.log.debug("Sending: %s" % message)
-        # TODO: do something sensible with return value
-        self.msg_sender.send_sms(sender, recv, subj, body)
+        with self.tracer.span("send"):
+            if self.outbox:
+                self.outbox.enqueue(sender, [recv], subj, body)
+                return
+            # TODO: do something sensible with return value
+            try:
+                self.msg_sender.send_sms(sender, recv, subj, body)
+            except SendError as e:
+                if e.failed is None:
+                    raise
+                # Refused, but whatever else this message did has happened
+                # (and may have sent other messages already), so don't undo it.
+                self.log.error("Sending to %s failed: %s" % (recv, e))
+                self.metrics.inc("send_errors", self.msg_sender.name)
+                return
+        if not self.msg_sender.deferred:
+            self.metrics.inc("sent", self.msg_sender.name)
 
-    def parse_command(self, message, confirmed):
-        """ Recognize command, parse arguments, and call appropriate handler.
-        """
-        if message.body.startswith(self.conf.cmd_char):
-            body = message.body[1:]
-        else:
-            body = message.body
-
-        if len(body.split()) > 1:
-            cmd, args = body.split(None, 1)
-            args = args.split()
-        elif len(body.split()) == 1:
-            cmd = body.split()[0]
-            args = None
-        else:
-            cmd = None
-            args = None
+    def send_bulk(self, sender, recipients, subject, body, rendered=None):
+        """ Send the same message to every number in recipients, which may be
+        any iterable. Pass rendered if the body has already been rendered.
+        Returns the number of recipients. """
+        return self.send_job(FanoutJob(sender, recipients, subject, body, rendered))
+
+    def send_job(self, job):
+        """ Send a FanoutJob, handing the recipients to the Sender (or the
+        outbox) a batch at a time. Returns the number of recipients. """
+        self.log.debug("Sending: %s" % job)
+        count = 0
+        with self.tracer.span("send"):
+            if self.outbox:
+                count = self.outbox.enqueue(job.sender, job.recipients, job.subject, job.body)
+            else:
+                # Render once for every recipient.
+                rendered = job.rendered or render(job.body)
+                name = self.msg_sender.name
+                if job.size:
+                    self.msg_sender.expect(job.sender, job.size * rendered.count)
+                counted = not self.msg_sender.deferred
+                for batch in job.batches():
+                    try:
+                        self.msg_sender.send_rendered(job.sender, batch, job.subject, rendered)
+                    except SendError as e:
+                        if e.failed is None:
+                            raise
+                        # Some of it went out, so there's no taking it
+                        # back; carry on with the rest.
+                        self.log.error("Sending to %d of %d recipients failed: %s" % (len(e.failed), len(batch), e))
+                        self.metrics.inc("send_errors", name, len(e.failed))
+                        self.metrics.inc("sent", name, len(batch) - len(e.failed))
+                    else:
+                        if counted:
+                            self.metrics.inc("sent", name, len(batch))
+                    count += len(batch)
+        self.log.debug("Sent to %d recipients." % count)
+        return count
 
+    def run_command(self, message, command, confirmed):
+        """ Run a ParsedCommand, replying with the error if it fails. """
+        if not confirmed:
+            self.metrics.inc("inbound", command.name if command.spec else "unknown")
         try:
-            self.cmd_handler.dispatch(message, cmd, args, confirmed)
+            with self.tracer.span("command"):
+                self.cmd_handler.dispatch(message, command, confirmed)
         except CommandError as e:
             self.reply(str(e).replace("\"", "")) # Send the failure message to the user.
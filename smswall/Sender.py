@@ -1,14 +1,81 @@
 import logging
 
+class SendError(RuntimeError):
+    """ Raised by Senders that know exactly which recipients didn't get the
+    message, so callers can retry just those. failed is the list of them. """
+
+    def __init__(self, msg, failed):
+        RuntimeError.__init__(self, msg)
+        self.failed = failed
+
 class Sender:
+    # Identifies the backend in the config (send_rates) and in metrics.
+    name = "sender"
+    # True for Senders whose send_* return before the message has actually
+    # gone out. They count what they send themselves.
+    deferred = False
+    # True for Senders whose send_* may be called from several threads at
+    # once. Others get wrapped in a LockedSender where that could happen.
+    thread_safe = False
+
     def send_sms(self, sender, receipient, subject, data):
         raise NotImplementedError
 
+    def send_bulk(self, sender, recipients, subject, data):
+        """ Send the same message to every number in recipients. Senders
+        that can hand off a batch in one go should override this; by default we
+        fall back to sending one message at a time. """
+        for r in recipients:
+            self.send_sms(sender, r, subject, data)
+
+    def expect(self, sender, messages):
+        """ Called before a fan-out that will send this many SMS in all, a
+        batch at a time, so a Sender that takes its time can say how long
+        it'll be. Does nothing by default. """
+        pass
+
+    def send_rendered(self, sender, recipients, subject, rendered):
+        """ Send a RenderedBody to every number in recipients. Senders that
+        can submit the segments themselves (rendered.parts) should override
+        this; by default we hand over the text and let the switch segment
+        it. """
+        self.send_bulk(sender, recipients, subject, rendered.text)
+
+class LockedSender(Sender):
+    """ Wraps a Sender that isn't thread-safe, so threads that share it take
+    turns. Every LockedSender for the same Sender has to use the same lock. """
+
+    thread_safe = True
+
+    def __init__(self, sender, lock):
+        self.sender = sender
+        self.lock = lock
+        self.name = sender.name
+        self.deferred = sender.deferred
+
+    def send_sms(self, sender, recipient, subject, data):
+        with self.lock:
+            return self.sender.send_sms(sender, recipient, subject, data)
+
+    def send_bulk(self, sender, recipients, subject, data):
+        with self.lock:
+            return self.sender.send_bulk(sender, recipients, subject, data)
+
+    def send_rendered(self, sender, recipients, subject, rendered):
+        with self.lock:
+            return self.sender.send_rendered(sender, recipients, subject, rendered)
+
+    def expect(self, sender, messages):
+        with self.lock:
+            self.sender.expect(sender, messages)
+
 class TestSender(Sender):
     """ Saves output to an easily parse-able file format to allow automated
     verification.
     """
 
+    name = "test"
+
     def __init__(self):
         self.msg_count = 0
         self.logger = logging.getLogger("testsender")
@@ -17,10 +84,29 @@ class TestSender(Sender):
         self.logger.info("%s" % msg)
         self.msg_count += 1
 
+    def send_bulk(self, sender, recipients, subject, data):
+        # Same output as send_sms, one line per recipient, but without the
+        # per-message call overhead.
+        info = self.logger.info
+        count = self.msg_count
+        for r in recipients:
+            info("%s" % [count, sender, r, subject, data])
+            count += 1
+        self.msg_count = count
+
 
 class LogSender(Sender):
+    name = "log"
+
     def send_sms(self, sender, recipient, subject, data):
         logging.basicConfig(level=logging.DEBUG)
         logging.info("Sent SMS. From: '%s' To: '%s' Subj: '%s' Message: '%s'" \
                      % (sender, recipient, subject, data))
         return True
+
+    def send_bulk(self, sender, recipients, subject, data):
+        recipients = list(recipients)
+        logging.basicConfig(level=logging.DEBUG)
+        logging.info("Sent SMS to %d recipients. From: '%s' To: '%s' Subj: '%s' Message: '%s'" \
+                     % (len(recipients), sender, ",".join(recipients), subject, data))
+        return True
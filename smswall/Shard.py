@@ -0,0 +1,204 @@
+import bisect
+import hashlib
+import multiprocessing
+import Queue
+import signal
+import sys
+
+from Config import *
+from Daemon import DaemonError
+from Inbound import *
+from SMSWall import *
+
+"""
+Multi-process handling for the daemon. One process with one sqlite connection
+(and the GIL) handles messages one at a time, so a post to a big list holds up
+every other list. With 'daemon_shards' set, the daemon instead forwards each
+message to one of that many worker processes, each with its own SMSWall, and
+just routes.
+
+Messages are assigned to workers by message_key (the list shortcode, or the
+sender for commands to the app number) on a consistent hash ring, so each list
+always goes to the same worker, which handles its messages in the order they
+arrived. A 'create' goes to the worker for the list it creates. Other messages
+with different keys are handled in parallel, so e.g. a 'delete' sent to the
+app number and a post sent to that list right after may be handled in either
+order.
+
+A worker that has died is restarted the next time something is sent to it,
+with a new queue (the dead one may have died holding the old queue's lock).
+What was still queued for it is moved over if it can be; whatever it was
+handling when it died is lost, and logged. If a worker's queue stays full for
+the pool's timeout (e.g. it keeps dying at startup), the request fails with
+DaemonError rather than holding up the daemon.
+
+Each worker runs its own delivery and expiry threads, and writes its metrics to
+metrics_file with ".shard<N>" appended. Each also paces its own sends, so the
+configured send_rates and send_burst are split evenly between the workers.
+"""
+
+class HashRing:
+    """ Consistent hashing: maps keys to nodes such that adding or removing a
+    node only moves the keys that belong on it. Each node gets replicas points
+    on the ring, to even out the load. """
+
+    def __init__(self, nodes, replicas=64):
+        self.points = []
+        for node in nodes:
+            for i in range(replicas):
+                self.points.append((self._hash("%s#%d" % (node, i)), node))
+        self.points.sort()
+        self.hashes = [h for h, node in self.points]
+
+    def _hash(self, key):
+        return long(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def node(self, key):
+        i = bisect.bisect(self.hashes, self._hash(key)) % len(self.points)
+        return self.points[i][1]
+
+def shard_config(config_dict, index, shards):
+    """ The config for worker index of shards: the same, but with files that
+    can't be shared between processes made per-worker, and with each worker
+    getting its share of the send rates. """
+    config_dict = dict(config_dict)
+    for key in ["metrics_file", "trace_file"]:
+        if config_dict.get(key):
+            config_dict[key] = "%s.shard%d" % (config_dict[key], index)
+    rates = config_dict.get('send_rates') or {}
+    config_dict['send_rates'] = dict((name, float(rate) / shards) for name, rate in rates.items())
+    config_dict['send_burst'] = max(config_dict.get('send_burst', 10) // shards, 1)
+    return config_dict
+
+def _shard_main(config_dict, index, queue, log):
+    # The daemon decides when we stop: it drains our queue on shutdown.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        app = SMSWall(Config(config_dict, log))
+    except Exception as e:
+        log.exception("Shard %d couldn't start." % index)
+        sys.exit(1)
+    app.start_workers()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            op, arg = item
+            try:
+                if op == "message":
+                    app.handle_incoming(arg)
+                elif op == "clean_confirm":
+                    app.clean_confirm_actions(arg)
+            except Exception as e:
+                log.exception("Shard %d error." % index)
+            finally:
+                app.reset()
+    finally:
+        app.stop_workers()
+        app.metrics.flush()
+        app.db.close()
+
+class ShardPool:
+    """ Stands in for the SMSWall behind an SMSWallDaemon, handing messages to
+    shards worker processes. Each has a queue of up to depth messages; when
+    it's full, handle_incoming waits up to timeout seconds for room. Nothing
+    is handled until start_workers() is called. """
+
+    def __init__(self, config_dict, log, shards, depth, timeout=5):
+        self.config_dict = config_dict
+        self.log = log
+        self.depth = depth
+        self.timeout = timeout
+        self.names = ["shard%d" % i for i in range(shards)]
+        self.ring = HashRing(self.names)
+        self.queues = {}
+        self.procs = {}
+        for name in self.names:
+            self.queues[name] = multiprocessing.Queue(depth)
+            self.procs[name] = self._process(name)
+        self.conf = None
+        self.db = None
+        self.metrics = None
+
+    def start_workers(self):
+        # Fork before we open a DB connection of our own; sqlite connections
+        # mustn't be carried across a fork.
+        for name in self.names:
+            self.procs[name].start()
+        self.conf = Config(self.config_dict, self.log)
+        self.db = self.conf.db_conn
+        self.metrics = self.conf.metrics
+        self.metrics.start_flushing()
+
+    def _process(self, name):
+        index = self.names.index(name)
+        config_dict = shard_config(self.config_dict, index, len(self.names))
+        p = multiprocessing.Process(target=_shard_main, name=name,
+                                    args=(config_dict, index, self.queues[name], self.log))
+        p.daemon = True
+        return p
+
+    def _restart(self, name):
+        """ Replace a dead worker, and its queue. """
+        old = self.queues[name]
+        queue = multiprocessing.Queue(self.depth)
+        # If it died in the middle of a get, the old queue stays locked and
+        # nothing more can be taken off it.
+        moved = 0
+        try:
+            while True:
+                queue.put_nowait(old.get_nowait())
+                moved += 1
+        except Queue.Empty:
+            pass
+        lost = old.qsize()
+        old.cancel_join_thread()
+        old.close()
+        self.log.error("Shard %s died (exit code %s); restarting it. Moved %d queued requests to the new one, lost %d, plus whatever it was handling." % \
+                       (name, self.procs[name].exitcode, moved, lost))
+        self.metrics.inc("shard_restarts", name)
+        if lost:
+            self.metrics.inc("shard_lost", name, lost)
+        self.queues[name] = queue
+        # It never touches our DB connection, and multiprocessing ends it
+        # with os._exit(), so it won't close it on us either.
+        self.procs[name] = self._process(name)
+        self.procs[name].start()
+
+    def _put(self, name, item):
+        if not self.procs[name].is_alive():
+            self._restart(name)
+        try:
+            self.queues[name].put(item, True, self.timeout)
+        except Queue.Full:
+            raise DaemonError("Shard %s is backed up; try again later." % name)
+
+    def shard(self, message):
+        """ Name of the worker that handles message. """
+        return self.ring.node(message_key(self.conf, message))
+
+    def handle_incoming(self, message):
+        name = self.shard(message)
+        self._put(name, ("message", message))
+        self.metrics.inc("sharded", name)
+
+    def clean_confirm_actions(self, age):
+        # They all share a DB, so any one of them will do.
+        self._put(self.names[0], ("clean_confirm", age))
+
+    def stop_workers(self):
+        """ Let the workers finish what's queued, then stop them. """
+        for name in self.names:
+            p = self.procs[name]
+            if p.is_alive():
+                try:
+                    self.queues[name].put(None, True, self.timeout)
+                except Queue.Full:
+                    self.log.error("Shard %s isn't taking anything; terminating it." % name)
+                    p.terminate()
+        for name in self.names:
+            if self.procs[name].pid is not None:
+                self.procs[name].join()
+        if self.metrics:
+            self.metrics.stop_flushing()
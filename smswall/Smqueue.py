@@ -0,0 +1,244 @@
+import collections
+import errno
+import Queue
+import select
+import socket
+import threading
+import time
+import uuid
+
+from Sender import *
+
+"""
+Sends SMS straight to smqueue as SIP MESSAGE requests, without going through
+the switch. Use it with sender_type 'smqueue'; the Yate and FreeSWITCH
+integrations then leave the outbound path to it.
+
+smqueue speaks SIP over UDP, so a "connection" here is a connected UDP socket.
+We keep a pool of them (one per concurrent sender, e.g. per delivery worker),
+and pipeline submissions on each: up to smqueue_window requests are in flight
+at once, answers are matched to requests by Call-ID, and requests that aren't
+answered within smqueue_timeout are retransmitted, like a SIP client
+transaction would, up to smqueue_retries times.
+
+FakeSmqueue is a stand-in server for tests and benchmarks.
+"""
+
+class SmqueueError(SendError):
+    """ failed is None if we don't know which recipients got through, e.g.
+    when the socket failed part way. """
+
+    def __init__(self, msg, failed=None):
+        SendError.__init__(self, msg, failed)
+
+def _message(call_id, sender, recipient, body, local_port, conf):
+    host = conf.smqueue_host
+    return "\r\n".join([
+        "MESSAGE sip:%s@%s:%d SIP/2.0" % (recipient, host, conf.smqueue_port),
+        "Via: SIP/2.0/UDP 127.0.0.1:%d;branch=z9hG4bK%s" % (local_port, uuid.uuid4().hex),
+        "Max-Forwards: 70",
+        "From: %s <sip:%s@127.0.0.1>;tag=%s" % (sender, sender, uuid.uuid4().hex[:8]),
+        "To: <sip:%s@%s>" % (recipient, host),
+        "Call-ID: %s" % call_id,
+        "CSeq: 1 MESSAGE",
+        "Content-Type: text/plain",
+        "Content-Length: %d" % len(body),
+        "",
+        body])
+
+def _parse(data):
+    """ Returns (first line, headers dict with lowercased names, body) for a
+    SIP message. """
+    head, _, body = data.partition("\r\n\r\n")
+    lines = head.split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return lines[0], headers, body
+
+class SmqueueConnection:
+    def __init__(self, conf):
+        self.conf = conf
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((conf.smqueue_host, conf.smqueue_port))
+        self.sock.setblocking(0)
+        self.local_port = self.sock.getsockname()[1]
+
+    def _responses(self):
+        """ Read every response that's waiting. Yields (Call-ID, status). """
+        while True:
+            try:
+                data = self.sock.recv(65535)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            line, headers, body = _parse(data)
+            parts = line.split(None, 2)
+            if len(parts) < 2 or not parts[0].startswith("SIP/"):
+                continue
+            try:
+                yield headers.get("call-id"), int(parts[1])
+            except ValueError:
+                continue
+
+    def submit(self, sender, recipients, body):
+        """ Send body to every recipient. Returns the recipients smqueue
+        didn't accept, or never answered for. """
+        conf = self.conf
+        todo = collections.deque(recipients)
+        pending = {} # Call-ID -> [recipient, request, attempts, deadline]
+        failed = []
+        while todo or pending:
+            now = time.time()
+            while todo and len(pending) < conf.smqueue_window:
+                recipient = todo.popleft()
+                call_id = "%s@smswall" % uuid.uuid4().hex
+                request = _message(call_id, sender, recipient, body, self.local_port, conf)
+                self.sock.send(request)
+                pending[call_id] = [recipient, request, 1, now + conf.smqueue_timeout]
+            deadline = min(p[3] for p in pending.values())
+            ready, _, _ = select.select([self.sock], [], [], max(deadline - time.time(), 0))
+            if ready:
+                for call_id, status in self._responses():
+                    if status < 200 or not call_id in pending:
+                        continue # provisional, or a late answer to a retransmission
+                    recipient = pending.pop(call_id)[0]
+                    if status >= 300:
+                        failed.append(recipient)
+            now = time.time()
+            for call_id, p in pending.items():
+                if p[3] > now:
+                    continue
+                if p[2] > conf.smqueue_retries:
+                    failed.append(p[0])
+                    del pending[call_id]
+                else:
+                    self.sock.send(p[1])
+                    p[2] += 1
+                    p[3] = now + conf.smqueue_timeout
+        return failed
+
+    def close(self):
+        self.sock.close()
+
+class SmqueueSender(Sender):
+    """ Sends through a pool of up to smqueue_connections connections. """
+
+    name = "smqueue"
+    thread_safe = True
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.log = conf.log
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+        self.opened = 0
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            opening = self.opened < self.conf.smqueue_connections
+            if opening:
+                self.opened += 1
+        if opening:
+            try:
+                return SmqueueConnection(self.conf)
+            except Exception as e:
+                self._discard(None)
+                raise SmqueueError("Can't reach smqueue: %s" % e)
+        # Every connection is busy. A submission retries for at most about
+        # (retries + 1) * timeout per window, so if we wait much longer than
+        # that something's stuck.
+        wait = max(10, 4 * (self.conf.smqueue_retries + 1) * self.conf.smqueue_timeout)
+        try:
+            return self.idle.get(True, wait)
+        except Queue.Empty:
+            raise SmqueueError("Timed out after %ds waiting for a connection to smqueue." % wait)
+
+    def _discard(self, conn):
+        """ Give up a connection (or, with None, a slot we failed to open),
+        so a new one can be opened in its place. """
+        if conn:
+            conn.close()
+        with self.lock:
+            self.opened -= 1
+
+    def send_sms(self, sender, recipient, subject, data):
+        self.send_bulk(sender, [recipient], subject, data)
+
+    def send_bulk(self, sender, recipients, subject, data):
+        conn = self._acquire()
+        ok = False
+        try:
+            failed = conn.submit(str(sender), [str(r) for r in recipients], data)
+            ok = True
+        except socket.error as e:
+            raise SmqueueError("Can't reach smqueue: %s" % e)
+        finally:
+            if ok:
+                self.idle.put(conn)
+            else:
+                # Something's wrong with it; don't hand it out again.
+                self._discard(conn)
+        if failed:
+            raise SmqueueError("smqueue didn't accept messages for %d of %d recipients: %s" % \
+                               (len(failed), len(recipients), ", ".join(failed[:10])), failed)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+class FakeSmqueue(threading.Thread):
+    """ Accepts SIP MESSAGEs on a local UDP port and answers 202 Accepted,
+    recording (sender, recipient, body) for each distinct message in
+    messages. With drop_every set, every drop_every'th datagram is ignored,
+    to exercise retransmission. Messages for numbers in reject are refused.
+    """
+
+    def __init__(self, port=0, drop_every=0, reject=()):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", port))
+        self.port = self.sock.getsockname()[1]
+        self.drop_every = drop_every
+        self.reject = set(reject)
+        self.received = 0
+        self.messages = []
+        self.seen = set()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            ready, _, _ = select.select([self.sock], [], [], 0.1)
+            if not ready:
+                continue
+            data, addr = self.sock.recvfrom(65535)
+            self.received += 1
+            if self.drop_every and self.received % self.drop_every == 0:
+                continue
+            line, headers, body = _parse(data)
+            call_id = headers.get("call-id")
+            recipient = line.split()[1][len("sip:"):].split("@")[0]
+            status = "480 Temporarily Unavailable" if recipient in self.reject else "202 Accepted"
+            if not call_id in self.seen and not recipient in self.reject:
+                self.seen.add(call_id)
+                sender = headers.get("from", "").split("<sip:", 1)[-1].split("@")[0]
+                self.messages.append((sender, recipient, body))
+            response = "\r\n".join(["SIP/2.0 " + status] +
+                                   ["%s: %s" % (h, headers.get(h.lower(), "")) for h in ["Via", "From", "To", "Call-ID", "CSeq"]] +
+                                   ["Content-Length: 0", "", ""])
+            self.sock.sendto(response, addr)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sock.close()
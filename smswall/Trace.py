@@ -0,0 +1,107 @@
+import json
+import logging
+import time
+import uuid
+
+"""
+Per-stage timing of incoming message handling. With 'trace_file' set in the
+config, every incoming message gets a correlation id, and the time spent in
+each stage (command parsing, authorization, membership query, name lookup,
+sending, commit) is written to the trace file as one JSON object per line:
+
+    {"id": "...", "start": 1534567890.12, "total": 0.0042,
+     "sender": "12345", "recipient": "1500",
+     "spans": [{"stage": "authorize", "offset": 0.0001, "duration": 0.0003}, ...]}
+
+Offsets are relative to the start of the message. Spans can nest, e.g.
+"send" happens inside "command" for replies.
+
+Without trace_file, SMSWall gets a NullTracer, whose spans are a shared no-op
+object, so instrumentation costs a method call per stage.
+"""
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_span = _NullSpan()
+
+class NullTracer:
+    enabled = False
+
+    def begin(self, message):
+        pass
+
+    def span(self, stage):
+        return _null_span
+
+    def end(self):
+        pass
+
+class _Span:
+    def __init__(self, tracer, stage):
+        self.tracer = tracer
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer._record(self.stage, self.start, time.time())
+        return False
+
+class Tracer:
+    """ Records spans for the message currently being handled. One Tracer
+    belongs to one SMSWall, which handles one message at a time. """
+
+    enabled = True
+
+    def __init__(self, path):
+        self.out = logging.getLogger("smswall.trace.%s" % path)
+        if not self.out.handlers:
+            handler = logging.FileHandler(path)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.out.addHandler(handler)
+        self.out.setLevel(logging.INFO)
+        self.out.propagate = False
+        self.current = None
+        self.depth = 0
+
+    def begin(self, message):
+        # Confirmed actions re-enter handle_incoming; they're part of the
+        # message that confirmed them.
+        self.depth += 1
+        if self.depth > 1:
+            return
+        self.current = {"id": uuid.uuid4().hex,
+                        "start": time.time(),
+                        "sender": message.sender,
+                        "recipient": message.recipient,
+                        "spans": []}
+
+    @property
+    def trace_id(self):
+        return self.current and self.current["id"]
+
+    def span(self, stage):
+        return _Span(self, stage)
+
+    def _record(self, stage, start, end):
+        if self.current is None:
+            return # not handling a message
+        self.current["spans"].append({"stage": stage,
+                                      "offset": start - self.current["start"],
+                                      "duration": end - start})
+
+    def end(self):
+        self.depth -= 1
+        if self.depth > 0 or self.current is None:
+            return
+        trace = self.current
+        self.current = None
+        trace["total"] = time.time() - trace["start"]
+        self.out.info(json.dumps(trace))
@@ -1,6 +1,19 @@
+from Metrics import *
 from Config import *
+from Trace import *
+from Cache import *
+from Dedupe import *
 from List import *
 from Message import *
+from Render import *
 from Sender import *
+from Pacer import *
+from Smqueue import *
+from Outbox import *
+from Expiry import *
 from CommandHandler import *
 from SMSWall import *
+from Inbound import *
+from Shard import *
+from Async import *
+from Daemon import *
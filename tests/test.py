@@ -3,10 +3,21 @@ import os
 import subprocess
 import sys
 import commands
+import json
 import logging
+import multiprocessing
 import random
+import signal
+import socket
 import sqlite3
+import threading
+import time
 import timeit
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import smswall
+import benchmarks
 
 """
 Hacky hacky hacky testing for smswall. Make sure your config is set to use the
@@ -17,6 +28,8 @@ the appropriate parameter in __main__.
 # globals
 count = 0
 db_file = "/etc/OpenBTS/smswall.sqlite3"
+conf_file = "/etc/smswall.yaml"
+test_conf_file = "/tmp/smswall-test.yaml"
 
 def query(sql):
     db = sqlite3.connect(db_file, isolation_level=None)
@@ -29,7 +42,7 @@ def test_assert(expr):
 
 def clear():
     global count
-    for f in [db_file, "smswall.log"]:
+    for f in [db_file, db_file + "-wal", db_file + "-shm", "smswall.log"]:
         try:
             os.remove(f)
         except:
@@ -83,6 +96,25 @@ def log_has_string(string):
     logfile.close()
     return r
 
+def log_count_string(string):
+    n = 0
+    logfile = open("smswall.log", "r")
+    for line in logfile:
+        if "testsender" in line and string in line:
+            n += 1
+    logfile.close()
+    return n
+
+def write_config(**settings):
+    """ Write a copy of the config with the given settings changed to
+    test_conf_file, for tests that need a non-default configuration. """
+    config_dict = yaml.load(open(conf_file, "r").read())
+    config_dict.update(settings)
+    f = open(test_conf_file, "w")
+    f.write(yaml.dump(config_dict))
+    f.close()
+    return test_conf_file
+
 def counter(reset=False):
     global count
     count += 1
@@ -257,91 +289,850 @@ def testcase12():
     run("python smswall-interactive --debug --from 12345 --to 2000 --message 'test message'")
     assert log_has_string("(from: foo)")
 
+def testcase13():
+    clear()
+    start("Test 13: Hand messages to a running daemon.")
+    sock = "/tmp/smswall-test.sock"
+    if os.path.exists(sock):
+        os.remove(sock) # left over from a run that was killed
+    daemon = subprocess.Popen("exec python smswall-daemon --debug --socket %s" % sock, shell=True)
+    try:
+        for i in range(50):
+            if os.path.exists(sock):
+                break
+            time.sleep(0.1)
+        run("python smswall-interactive --socket %s -t 1000 -f 12345 -m 'create 1500'" % sock)
+        run("python smswall-interactive --socket %s -t 1500 -f 12345 -m 'add 43210'" % sock)
+        run("python smswall-interactive --socket %s -t 1500 -f 43210 -m 'test message'" % sock)
+        assert query("select * from list where shortcode='1500'") == 1
+        assert query("select * from membership where list='1500'") == 2
+        assert log_has_string("'1500', '12345', '', '(from: 43210) test message']")
+        client = smswall.SMSWallClient(sock)
+        try:
+            metrics = client.status()
+        finally:
+            client.close()
+        assert metrics["counters"]["inbound"] == {"create": 1, "add": 1, "post": 1}
+        assert metrics["histograms"]["fanout"]["count"] == 1
+        assert metrics["histograms"]["fanout"]["max"] == 1
+        assert metrics["histograms"]["db_latency"]["count"] > 0
+    finally:
+        daemon.terminate()
+        daemon.wait()
+    assert not os.path.exists(sock)
+
+    # A daemon that takes too long to answer isn't an error, and the message
+    # isn't handled again in-process.
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(sock)
+    listener.listen(1)
+    try:
+        output = commands.getoutput("python smswall-interactive --socket %s --timeout 0.5 -t 1000 -f 12345 -m 'create 1600'" % sock)
+        assert "the result is unknown" in output
+        assert "Traceback" not in output
+        assert query("select * from list where shortcode='1600'") == 0
+    finally:
+        listener.close()
+        os.remove(sock)
+
+def testcase14():
+    clear()
+    start("Test 14: Deliver through the outbox.")
+    conf = write_config(delivery="outbox")
+    run("python smswall-interactive -c %s -t 1000 -f 12345 -m 'create 1500'" % conf)
+    run("python smswall-interactive -c %s -t 1500 -f 12345 -m 'add 43210'" % conf)
+    run("python smswall-interactive -c %s --debug -t 1500 -f 43210 -m 'test message'" % conf)
+    assert query("select * from membership where list='1500'") == 2
+    assert log_has_string("'1500', '12345', '', '(from: 43210) test message']")
+    assert query("select * from outbox") == 0
+    assert query("select * from outboxjob") == 0
+
+    # Several delivery workers share a sender that isn't thread-safe: they
+    # take turns, and nothing is lost.
+    class Exclusive(RecordingSender):
+        name = "exclusive"
+        def __init__(self):
+            RecordingSender.__init__(self)
+            self.busy = False
+            self.overlapped = False
+        def send_bulk(self, sender, recipients, subject, data):
+            if self.busy:
+                self.overlapped = True
+            self.busy = True
+            time.sleep(0.01)
+            RecordingSender.send_bulk(self, sender, recipients, subject, data)
+            self.busy = False
+    env = benchmarks.BenchEnv(delivery="outbox", delivery_workers=4)
+    sender = Exclusive()
+    env.app.set_sender(sender)
+    try:
+        sc = benchmarks.generate(env, 1, 301)[0]
+        env.app.start_workers()
+        for i in range(5):
+            env.message("12345", sc, "post %d" % i)
+        for i in range(100):
+            if len(sender.sent) >= 1500:
+                break
+            time.sleep(0.1)
+        env.app.stop_workers()
+        assert not sender.overlapped
+        assert len(sender.sent) == 1500
+        assert len(set(sender.sent)) == 1500
+    finally:
+        env.app.stop_workers()
+        env.close()
+
+def testcase15():
+    clear()
+    start("Test 15: Migrate a DB created before schema versioning.")
+    db = sqlite3.connect(db_file)
+    db.execute("CREATE TABLE list (shortcode TEXT PRIMARY KEY, owner_only INTEGER, is_public INTEGER)")
+    db.execute("CREATE TABLE membership (list TEXT, member TEXT, UNIQUE(list, member) ON CONFLICT IGNORE)")
+    db.execute("CREATE TABLE owner (list TEXT, owner TEXT, UNIQUE(list, owner) ON CONFLICT IGNORE)")
+    db.execute("CREATE TABLE confirm (time REAL, sender TEXT, receiver TEXT, command TEXT)")
+    db.execute("CREATE TABLE name (number TEXT, name TEXT, UNIQUE(number) ON CONFLICT IGNORE)")
+    db.execute("INSERT INTO list VALUES ('1500', 0, 1)")
+    db.execute("INSERT INTO owner VALUES ('1500', '12345')")
+    for m in ["12345", "43210", "55555"]:
+        db.execute("INSERT INTO membership VALUES ('1500', ?)", (m,))
+    db.commit()
+    db.close()
+    run("python smswall-interactive -t 1500 -f 77777 -m 'join'")
+    assert query("select * from schemaversion where version>=3") == 1
+    assert query("select * from membership where list='1500'") == 4
+    assert query("select * from owner where list='1500' and owner='12345'") == 1
+    for index in ["membership_member", "confirm_sender", "confirm_time"]:
+        assert query("select * from sqlite_master where type='index' and name='%s'" % index) == 1
+    assert query("select * from sqlite_master where name='membership' and sql like '%WITHOUT ROWID'") == 1
+
+def testcase16():
+    clear()
+    start("Test 16: Sync the subscriber registry into the everyone list.")
+    sr_file = "/tmp/smswall-test-sr.db"
+    if os.path.exists(sr_file):
+        os.remove(sr_file)
+    sr = sqlite3.connect(sr_file)
+    sr.execute("CREATE TABLE sip_buddies (name TEXT, callerid TEXT)")
+    for n in ["11111", "22222", "33333"]:
+        sr.execute("INSERT INTO sip_buddies VALUES (?, ?)", ("IMSI" + n, n))
+    sr.commit()
+    sync = "PYTHONPATH=. python scripts/make-universal-list.py --subscriber-db %s --smswall-db %s" % (sr_file, db_file)
+    run("python smswall-interactive -t 1000 -f 12345 -m 'create 9999'")
+    # The sync table comes with the rest of the schema.
+    assert query("select * from sqlite_master where name='universalsync'") == 1
+    run(sync)
+    assert query("select * from membership where list='9999'") == 4
+    sr.execute("DELETE FROM sip_buddies WHERE callerid='22222'")
+    sr.execute("INSERT INTO sip_buddies VALUES ('IMSI44444', '44444')")
+    sr.commit()
+    run(sync)
+    assert query("select * from membership where list='9999'") == 4
+    assert query("select * from membership where list='9999' and member='22222'") == 0
+    assert query("select * from membership where list='9999' and member='44444'") == 1
+    # the owner isn't a subscriber, but stays on the list
+    assert query("select * from membership where list='9999' and member='12345'") == 1
+    # unchanged registry: nothing to do, even if the list was edited by hand
+    db = sqlite3.connect(db_file)
+    db.execute("DELETE FROM membership WHERE list='9999' AND member='11111'")
+    db.commit()
+    run(sync)
+    assert query("select * from membership where list='9999' and member='11111'") == 0
+    run(sync + " --full")
+    assert query("select * from membership where list='9999' and member='11111'") == 1
+    sr.close()
+    os.remove(sr_file)
+
+def testcase17():
+    clear()
+    start("Test 17: Add and remove several members at once, and import members from a file.")
+    run("python smswall-interactive -t 1000 -f 12345 -m 'create 1600'")
+    run("python smswall-interactive --debug -t 1600 -f 12345 -m 'add 20001 20002 20003'")
+    assert query("select * from membership where list='1600'") == 4
+    assert query("select * from name where number in ('20001', '20002', '20003')") == 3
+    assert log_has_string("'20002', None, \"You've been added to the list '1600'.\"]")
+    run("python smswall-interactive -t 1600 -f 12345 -m 'remove 20001 20003'")
+    assert query("select * from membership where list='1600'") == 2
+    # Removing one member only takes them off this list.
+    run("python smswall-interactive -t 1000 -f 12345 -m 'create 1700'")
+    run("python smswall-interactive -t 1700 -f 12345 -m 'add 20002'")
+    run("python smswall-interactive -t 1600 -f 12345 -m 'remove 20002'")
+    assert query("select * from membership where list='1600'") == 1
+    assert query("select * from membership where list='1700'") == 2
+    run("python smswall-interactive -t 1600 -f 12345 -m 'add 20002'")
+    f = open("/tmp/smswall-test-import.txt", "w")
+    f.write("30001\n30002, 30003\n\n30004 bogus\n")
+    f.close()
+    run("python smswall-interactive --import /tmp/smswall-test-import.txt -t 1600 -f 55555")
+    assert query("select * from membership where list='1600'") == 2
+    run("python smswall-interactive --debug --import /tmp/smswall-test-import.txt -t 1600 -f 12345")
+    assert query("select * from membership where list='1600'") == 6
+    assert log_has_string("Added 4 numbers to the list '1600'.")
+    # Numbers already on the list aren't counted again.
+    run("python smswall-interactive --debug --import /tmp/smswall-test-import.txt -t 1600 -f 12345")
+    assert log_has_string("Added 0 numbers to the list '1600'.")
+    os.remove("/tmp/smswall-test-import.txt")
+
+    # An import bigger than the name cache still looks names up in bulk.
+    env = benchmarks.BenchEnv(name_cache_size=10)
+    try:
+        env.message("12345", env.conf.app_number, "create 1600")
+        before = env.conf.metrics.snapshot()["histograms"]["db_latency"]["count"]
+        env.app.import_members("1600", "12345", [str(30000 + i) for i in range(200)])
+        assert env.conf.metrics.snapshot()["histograms"]["db_latency"]["count"] - before < 50
+        assert env.db.execute("SELECT COUNT(*) FROM name WHERE number=name").fetchone()[0] == 201
+    finally:
+        env.close()
+
+def testcase18():
+    clear()
+    start("Test 18: Trace per-stage timings of incoming messages.")
+    trace_file = "/tmp/smswall-test-trace.log"
+    if os.path.exists(trace_file):
+        os.remove(trace_file)
+    conf = write_config(trace_file=trace_file)
+    run("python smswall-interactive -c %s -t 1000 -f 12345 -m 'create 1500'" % conf)
+    run("python smswall-interactive -c %s -t 1500 -f 12345 -m 'add 43210'" % conf)
+    run("python smswall-interactive -c %s -t 1500 -f 43210 -m 'test message'" % conf)
+    traces = [json.loads(line) for line in open(trace_file, "r")]
+    assert len(traces) == 3
+    assert len(set(t["id"] for t in traces)) == 3
+    stages = [span["stage"] for span in traces[2]["spans"]]
+    for stage in ["authorize", "members", "names", "send", "commit"]:
+        assert stage in stages
+    assert "command" in [span["stage"] for span in traces[0]["spans"]]
+    os.remove(trace_file)
+
+def testcase19():
+    clear()
+    start("Test 19: Write runtime metrics to a file.")
+    metrics_file = "/tmp/smswall-test-metrics.json"
+    if os.path.exists(metrics_file):
+        os.remove(metrics_file)
+    conf = write_config(metrics_file=metrics_file, metrics_interval=0)
+    run("python smswall-interactive -c %s -t 1000 -f 12345 -m 'create 1500'" % conf)
+    run("python smswall-interactive -c %s -t 1000 -f 12345 -m 'bogus'" % conf)
+    metrics = json.load(open(metrics_file, "r"))
+    assert metrics["counters"]["inbound"] == {"unknown": 1}
+    assert metrics["counters"]["sent"] == {"test": 1}
+    assert metrics["histograms"]["inbound_latency"]["count"] == 1
+    os.remove(metrics_file)
+
+    # A long-running process keeps the file current while it's idle.
+    env = benchmarks.BenchEnv(metrics_file=metrics_file, metrics_interval=0.1)
+    try:
+        env.app.start_workers()
+        env.conf.metrics.inc("sent", "bench", 3)
+        time.sleep(0.5)
+        metrics = json.load(open(metrics_file, "r"))
+        assert metrics["counters"]["sent"] == {"bench": 3}
+        assert time.time() - metrics["time"] < 0.3
+    finally:
+        env.app.stop_workers()
+        env.close()
+    os.remove(metrics_file)
+
+def testcase20():
+    clear()
+    start("Test 20: Pace outgoing messages.")
+    bucket = smswall.TokenBucket(100, 5)
+    t = time.time()
+    for i in range(25):
+        bucket.take()
+    # The first 5 go out at once, the other 20 at 100/s.
+    assert 0.18 < time.time() - t < 1
+    assert bucket.eta(10) > 0.08
+    conf = write_config(send_rates={"test": 100}, send_burst=5)
+    run("python smswall-interactive -c %s -t 1000 -f 12345 -m 'create 1500'" % conf)
+    members = " ".join(str(20000 + i) for i in range(30))
+    run("python smswall-interactive -c %s -t 1500 -f 12345 -m 'add %s'" % (conf, members))
+    t = time.time()
+    run("python smswall-interactive -c %s --debug -t 1500 -f 20000 -m 'test message'" % conf)
+    assert time.time() - t > 0.25
+    assert log_count_string("(from: 20000) test message") == 30
+
+    # SMSWalls in one process can share a sender, and with it the rate.
+    env = benchmarks.BenchEnv(send_rates={"bench": 100})
+    try:
+        paced = env.app.msg_sender
+        assert isinstance(paced, smswall.PacedSender)
+        other = smswall.SMSWall(env.conf)
+        other.set_sender(paced, paced=True)
+        assert other.msg_sender is paced
+    finally:
+        env.close()
+
+    # A failure that doesn't say who it hit is passed on as it is.
+    class Flaky(RecordingSender):
+        name = "flaky"
+        def send_bulk(self, sender, recipients, subject, data):
+            if len(self.sent) >= 10:
+                raise smswall.SendError("switch went away", None)
+            RecordingSender.send_bulk(self, sender, recipients, subject, data)
+    sender = Flaky()
+    paced = smswall.PacedSender(sender, smswall.TokenBucket(1000, 10), logging.getLogger("smswall"))
+    try:
+        paced.send_bulk("1500", [str(20000 + i) for i in range(30)], None, "test message")
+        assert False
+    except smswall.SendError as e:
+        assert e.failed is None
+    assert len(sender.sent) == 10
+
+def testcase21():
+    start("Test 21: Fan out to a big list a batch at a time.")
+    for delivery in ["direct", "outbox"]:
+        env = benchmarks.BenchEnv(delivery=delivery)
+        try:
+            sc = benchmarks.generate(env, 1, 1201)[0]
+            env.message("12345", sc, "testmessage")
+            env.app.deliver_pending()
+            assert env.sender.messages == 1200
+            if delivery == "direct":
+                # Three batches of up to 500, in one call each.
+                assert env.sender.calls == 3
+            env.message("12345", env.conf.app_number, "delete %s" % sc)
+            env.message("12345", env.conf.app_number, "confirm")
+            env.app.deliver_pending()
+            assert env.db.execute("SELECT COUNT(*) FROM membership").fetchone()[0] == 0
+            # Every member hears about the deletion, and the owner gets
+            # two replies besides.
+            assert env.sender.messages == 1200 + 1201 + 2
+        finally:
+            env.close()
+
+    # The members are read inside the outbox's write, so a commit by someone
+    # else (e.g. a delivery worker) in between doesn't lock the poster out.
+    env = benchmarks.BenchEnv(delivery="outbox")
+    try:
+        sc = benchmarks.generate(env, 1, 11)[0]
+        members = smswall.List(sc, env.app).members()
+        other = env.conf.connect()
+        other.execute("INSERT INTO name VALUES ('99999', 'someone')")
+        other.commit()
+        other.close()
+        assert env.app.outbox.enqueue("12345", members, None, "hello") == 11
+        env.db.commit()
+    finally:
+        env.close()
+
+    # If the delete fails, nobody is told it happened.
+    env = benchmarks.BenchEnv()
+    try:
+        sc = benchmarks.generate(env, 1, 11)[0]
+        env.db.execute("CREATE TRIGGER keepowners BEFORE DELETE ON owner BEGIN SELECT RAISE(ABORT, 'no'); END")
+        env.db.commit()
+        sender = RecordingSender()
+        env.app.set_sender(sender)
+        env.message("12345", env.conf.app_number, "delete %s" % sc)
+        try:
+            env.message("12345", env.conf.app_number, "confirm")
+            assert False
+        except sqlite3.IntegrityError:
+            pass
+        assert not [data for r, data in sender.sent if "has been deleted" in data]
+        assert env.db.execute("SELECT COUNT(*) FROM membership").fetchone()[0] == 11
+    finally:
+        env.close()
+
+    # With the outbox, the delete and its notices commit together: if the
+    # notices can't be queued, the list isn't deleted either.
+    env = benchmarks.BenchEnv(delivery="outbox")
+    try:
+        sc = benchmarks.generate(env, 1, 11)[0]
+        env.message("12345", env.conf.app_number, "delete %s" % sc)
+        env.db.execute("CREATE TRIGGER noqueue BEFORE INSERT ON outboxjob BEGIN SELECT RAISE(ABORT, 'no'); END")
+        env.db.commit()
+        try:
+            env.message("12345", env.conf.app_number, "confirm")
+            assert False
+        except sqlite3.IntegrityError:
+            pass
+        assert env.db.execute("SELECT COUNT(*) FROM list").fetchone()[0] == 1
+        assert env.db.execute("SELECT COUNT(*) FROM membership").fetchone()[0] == 11
+        assert env.db.execute("SELECT COUNT(*) FROM confirm").fetchone()[0] == 1
+        env.db.execute("DROP TRIGGER noqueue")
+        env.message("12345", env.conf.app_number, "confirm")
+        assert env.db.execute("SELECT COUNT(*) FROM list").fetchone()[0] == 0
+        # The request to confirm, the reply and the 11 notices.
+        assert env.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 13
+    finally:
+        env.close()
+
+    # A paced post says how long it'll take once, not once per batch.
+    class Records(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.messages = []
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+    env = benchmarks.BenchEnv(send_rates={"bench": 1000}, send_burst=1)
+    records = Records()
+    env.conf.log.addHandler(records)
+    env.conf.log.setLevel(logging.INFO)
+    try:
+        sc = benchmarks.generate(env, 1, 1201)[0]
+        env.message("12345", sc, "testmessage")
+        assert env.sender.calls > 3
+        assert len([m for m in records.messages if m.startswith("Pacing 1200 messages")]) == 1
+    finally:
+        env.conf.log.removeHandler(records)
+        env.conf.log.setLevel(logging.NOTSET)
+        env.close()
+
+def testcase22():
+    clear()
+    start("Test 22: Drop retried incoming messages.")
+    conf = write_config(dedupe_window=60)
+    run("python smswall-interactive -c %s -t 1000 -f 12345 -m 'create 1500'" % conf)
+    run("python smswall-interactive -c %s -t 1500 -f 12345 -m 'add 43210'" % conf)
+    for i in range(3):
+        run("python smswall-interactive -c %s --debug -t 1500 -f 43210 -m 'test message'" % conf)
+    assert log_count_string("(from: 43210) test message") == 1
+    run("python smswall-interactive -c %s --debug -t 1500 -f 43210 -m 'another message'" % conf)
+    assert log_count_string("(from: 43210) another message") == 1
+    # Once the window has passed, the same message is handled again.
+    db = sqlite3.connect(db_file)
+    db.execute("UPDATE inbound SET time = time - 120")
+    db.commit()
+    db.close()
+    run("python smswall-interactive -c %s --debug -t 1500 -f 43210 -m 'test message'" % conf)
+    assert log_count_string("(from: 43210) test message") == 2
+    assert query("select * from inbound") == 1
+
+def testcase23():
+    clear()
+    start("Test 23: Check command arguments and answer help requests.")
+    run("python smswall-interactive -t 1000 -f 12345 -m 'create 1600'")
+    run("python smswall-interactive --debug -t 1600 -f 12345 -m 'add 4321O'")
+    assert query("select * from membership where list='1600'") == 1
+    assert log_has_string("Invalid command. Send 'help add' to 1000 for info.")
+    run("python smswall-interactive --debug -t 1600 -f 55555 -m 'HELP add'")
+    assert log_has_string("'55555', None, \"Send 'add <number> [<number> ...]' to any list")
+    run("python smswall-interactive --debug -t 1000 -f 55555 -m '.'")
+    assert log_has_string("Invalid command. Send 'help' to 1000 for a list of commands.")
+
+def testcase24():
+    clear()
+    start("Test 24: Expire pending actions.")
+    run("python smswall-interactive -t 1000 -f 12345 -m 'create 1600'")
+    run("python smswall-interactive -t 1000 -f 12345 -m 'create 1700'")
+    run("python smswall-interactive -t 1000 -f 12345 -m 'delete 1600'")
+    # A second action replaces the first.
+    run("python smswall-interactive -t 1000 -f 12345 -m 'delete 1700'")
+    assert query("select * from confirm where sender='12345'") == 1
+    db = sqlite3.connect(db_file)
+    db.execute("UPDATE confirm SET expires = expires - 7200")
+    db.commit()
+    db.close()
+    run("python smswall-interactive --debug -t 1000 -f 12345 -m 'confirm'")
+    assert log_has_string("There is nothing awaiting confirmation for you.")
+    assert query("select * from list") == 2
+    assert query("select * from confirm") == 0
+
+    env = benchmarks.BenchEnv(confirm_ttl=0.2)
+    try:
+        env.message("12345", env.conf.app_number, "create 1600")
+        env.app.start_workers()
+        env.message("12345", env.conf.app_number, "delete 1600")
+        count = "SELECT COUNT(*) FROM confirm"
+        assert env.db.execute(count).fetchone()[0] == 1
+        time.sleep(0.5)
+        assert env.db.execute(count).fetchone()[0] == 0
+    finally:
+        env.close()
+
+def testcase25():
+    clear()
+    start("Test 25: Render posts into SMS segments.")
+    r = smswall.render("hello")
+    assert (r.encoding, r.count) == ("gsm7", 1)
+    r = smswall.render("a" * 161)
+    assert [len(p) for p in r.parts] == [153, 8]
+    # The euro sign is in the extension table, so it takes two septets.
+    assert smswall.render("\xe2\x82\xac" * 80).count == 1
+    assert smswall.render("\xe2\x82\xac" * 81).count == 2
+    r = smswall.render("\xd0\xbf" * 71) # Cyrillic needs UCS-2
+    assert (r.encoding, [len(p) for p in r.parts]) == ("ucs2", [67, 4])
+    # Characters outside the BMP take two UTF-16 units, and a surrogate pair
+    # (as a narrow build has them) is never split.
+    assert smswall.render("\xf0\x9f\x98\x80" * 35).count == 1
+    assert smswall.render("\xf0\x9f\x98\x80" * 36).count == 2
+    r = smswall.render(u"\ud83d\ude00" * 36)
+    assert [len(p) for p in r.parts] == [66, 6]
+
+    conf = write_config(max_segments=1)
+    run("python smswall-interactive -c %s -t 1000 -f 12345 -m 'create 1500'" % conf)
+    run("python smswall-interactive -c %s -t 1500 -f 12345 -m 'add 43210'" % conf)
+    run("python smswall-interactive -c %s --debug -t 1500 -f 43210 -m '%s'" % (conf, "a" * 150))
+    assert log_has_string("'43210', None, 'Sorry, your message is too long: it would be sent as 2 texts")
+    assert not log_has_string("(from: 43210)")
+    run("python smswall-interactive -c %s --debug -t 1500 -f 43210 -m '%s'" % (conf, "a" * 140))
+    assert log_count_string("(from: 43210) " + "a" * 140) == 1
+
+    # More parts than SMS allows at all: refused the same way.
+    env = benchmarks.BenchEnv()
+    sender = RecordingSender()
+    env.app.set_sender(sender)
+    try:
+        env.message("12345", env.conf.app_number, "create 1500")
+        env.message("12345", "1500", "add 43210")
+        env.message("12345", "1500", "a" * (153 * smswall.MAX_PARTS))
+        assert [r for r, data in sender.sent if data.startswith("Sorry, your message is too long")] == ["12345"]
+        assert not [r for r, data in sender.sent if data.startswith("(from: 12345)")]
+    finally:
+        env.close()
+
+def testcase26():
+    clear()
+    start("Test 26: Send straight to smqueue.")
+    smqueue = smswall.FakeSmqueue(drop_every=7)
+    smqueue.start()
+    try:
+        conf = write_config(sender_type="smqueue", smqueue_port=smqueue.port, smqueue_timeout=0.05)
+        run("python smswall-interactive -c %s -t 1000 -f 12345 -m 'create 1500'" % conf)
+        members = " ".join(str(20000 + i) for i in range(100))
+        run("python smswall-interactive -c %s -t 1500 -f 12345 -m 'add %s'" % (conf, members))
+        run("python smswall-interactive -c %s -t 1500 -f 20000 -m 'test message'" % conf)
+        posts = [m for m in smqueue.messages if m[2] == "(from: 20000) test message"]
+        # Everything got through once, even though some requests were lost.
+        assert smqueue.received > len(smqueue.messages)
+        assert len(posts) == 100
+        assert len(set(m[1] for m in posts)) == 100
+        assert all(m[0] == "1500" for m in posts)
+    finally:
+        smqueue.stop()
+
+    # Nobody listening: the sender gives up and says so.
+    config_dict = yaml.load(open(conf, "r").read())
+    sender = smswall.SmqueueSender(smswall.Config(config_dict, logging.getLogger("smswall")))
+    try:
+        sender.send_bulk("1500", ["20000", "20001"], None, "test message")
+        assert False
+    except smswall.SmqueueError as e:
+        pass
+    sender.close()
+
+    # Connections that can't be opened don't use up the pool.
+    config_dict.update(smqueue_host="256.0.0.1", smqueue_connections=1)
+    sender = smswall.SmqueueSender(smswall.Config(config_dict, logging.getLogger("smswall")))
+    for i in range(3):
+        try:
+            sender.send_bulk("1500", ["20000"], None, "test message")
+            assert False
+        except smswall.SmqueueError as e:
+            pass
+    assert sender.opened == 0
+
+    # smqueue refuses some recipients: only those are retried, and direct
+    # sends carry on with the rest.
+    rejected = set(["20003", "20007"])
+    for delivery in ["outbox", "direct"]:
+        smqueue = smswall.FakeSmqueue(reject=rejected)
+        smqueue.start()
+        env = benchmarks.BenchEnv(delivery=delivery, smqueue_port=smqueue.port, smqueue_timeout=0.05)
+        try:
+            env.app.set_sender(smswall.SmqueueSender(env.conf))
+            env.message("12345", env.conf.app_number, "create 1500")
+            env.message("12345", "1500", "add %s" % " ".join(str(20000 + i) for i in range(10)))
+            env.message("12345", "1500", "hello")
+            env.app.deliver_pending()
+            posts = [m[1] for m in smqueue.messages if m[2] == "(from: 12345) hello"]
+            assert sorted(posts) == sorted(str(20000 + i) for i in range(10) if not str(20000 + i) in rejected)
+            assert env.conf.metrics.snapshot()["counters"]["send_errors"]["smqueue"] >= 2
+            if delivery == "outbox":
+                left = set(r[0] for r in env.db.execute("SELECT recipient FROM outbox").fetchall())
+                assert left == rejected
+        finally:
+            env.close()
+            smqueue.stop()
+
+class RecordingSender(smswall.Sender):
+    name = "record"
+
+    def __init__(self):
+        self.sent = []
+
+    def send_sms(self, sender, recipient, subject, data):
+        self.sent.append((recipient, data))
+
+    def send_bulk(self, sender, recipients, subject, data):
+        for r in recipients:
+            self.sent.append((r, data))
+
+def testcase27():
+    clear()
+    start("Test 27: Handle incoming messages in a worker pool.")
+    env = benchmarks.BenchEnv()
+    sender = RecordingSender()
+    def make_app():
+        app = smswall.SMSWall(env.conf, env.conf.connect())
+        app.set_sender(sender)
+        return app
+    try:
+        env.message("12345", env.conf.app_number, "create 1500")
+        env.message("12345", env.conf.app_number, "create 1600")
+        pool = smswall.InboundPool(env.conf, make_app, 4, 100)
+        pool.start()
+        for n in range(50):
+            for shortcode in ["1500", "1600"]:
+                assert pool.submit(smswall.Message("12345", shortcode, None, "add %d" % (20000 + n)))
+        # Handled after the adds to the same list, so everyone gets it.
+        assert pool.submit(smswall.Message("12345", "1500", None, "hello 1500"))
+        assert pool.submit(smswall.Message("12345", "1600", None, "hello 1600"))
+        pool.stop()
+        for shortcode in ["1500", "1600"]:
+            got = set(r for r, data in sender.sent if data == "(from: 12345) hello %s" % shortcode)
+            assert set(str(20000 + n) for n in range(50)) <= got
+    finally:
+        env.close()
+
+    # A full queue refuses new messages rather than growing.
+    class Blocked:
+        def __init__(self):
+            self.db = sqlite3.connect(":memory:")
+        def handle_incoming(self, message):
+            started.set()
+            release.wait()
+        def reset(self):
+            pass
+    started = threading.Event()
+    release = threading.Event()
+    env = benchmarks.BenchEnv()
+    try:
+        pool = smswall.InboundPool(env.conf, Blocked, 1, 1)
+        pool.start()
+        m = smswall.Message("12345", "1500", None, "test message")
+        assert pool.submit(m)
+        started.wait()
+        assert pool.submit(m)
+        assert not pool.submit(m)
+        assert env.conf.metrics.snapshot()["counters"]["inbound_rejected"] == 1
+        release.set()
+        pool.stop()
+
+        # Workers that can't start are reported, not left to fill up.
+        def broken():
+            raise IOError("no DB")
+        pool = smswall.InboundPool(env.conf, broken, 2, 1)
+        try:
+            pool.start()
+            assert False
+        except IOError as e:
+            pass
+    finally:
+        env.close()
+
+def testcase28():
+    clear()
+    start("Test 28: Shard the daemon's work across processes.")
+    keys = ["list:%d" % (1000 + i) for i in range(1000)]
+    before = smswall.HashRing(["shard%d" % i for i in range(4)])
+    after = smswall.HashRing(["shard%d" % i for i in range(5)])
+    moved = [k for k in keys if before.node(k) != after.node(k)]
+    # Only keys that now belong to the new shard move.
+    assert all(after.node(k) == "shard4" for k in moved)
+    assert 100 < len(moved) < 300
+    assert len(set(before.node(k) for k in keys)) == 4
+
+    config_dict = yaml.load(open(conf_file, "r").read())
+    pool = smswall.ShardPool(config_dict, logging.getLogger("smswall"), 3, 10)
+    pool.start_workers()
+    try:
+        # Creating a list goes to the list's shard, so it's done before the
+        # adds; removes only work if they're handled after the matching add.
+        for shortcode in ["1500", "1600"]:
+            pool.handle_incoming(smswall.Message("12345", "1000", None, "create %s" % shortcode))
+        for n in range(30):
+            for shortcode in ["1500", "1600"]:
+                pool.handle_incoming(smswall.Message("12345", shortcode, None, "add %d" % (20000 + n)))
+                if n % 2 == 0:
+                    pool.handle_incoming(smswall.Message("12345", shortcode, None, "remove %d" % (20000 + n)))
+    finally:
+        pool.stop_workers()
+        pool.db.close()
+    for shortcode in ["1500", "1600"]:
+        assert query("select * from membership where list='%s' and member like '2%%'" % shortcode) == 15
+    assert sum(pool.metrics.snapshot()["counters"]["sharded"].values()) == 92
+
+    # Each shard paces its share of the configured rate.
+    shard = smswall.shard_config({"send_rates": {"yate": 10}, "send_burst": 10}, 1, 4)
+    assert shard["send_rates"] == {"yate": 2.5}
+    assert shard["send_burst"] == 2
+
+    # A shard killed while waiting on its queue is replaced, with a queue
+    # it can read.
+    pool = smswall.ShardPool(config_dict, logging.getLogger("smswall"), 1, 10)
+    pool.start_workers()
+    try:
+        pool.handle_incoming(smswall.Message("12345", "1000", None, "create 1700"))
+        for i in range(50):
+            if query("select * from list where shortcode='1700'"):
+                break
+            time.sleep(0.1)
+        os.kill(pool.procs["shard0"].pid, signal.SIGKILL)
+        pool.procs["shard0"].join()
+        pool.handle_incoming(smswall.Message("12345", "1700", None, "add 20000"))
+    finally:
+        pool.stop_workers()
+        pool.db.close()
+    assert query("select * from membership where list='1700'") == 2
+    assert pool.metrics.snapshot()["counters"]["shard_restarts"]["shard0"] == 1
+
+    # Shards that keep dying don't hang the daemon.
+    config_dict["db_file"] = "/nonexistent/smswall.sqlite3"
+    pool = smswall.ShardPool(config_dict, logging.getLogger("smswall"), 1, 1, timeout=0.2)
+    for p in pool.procs.values():
+        p.start()
+    pool.conf = smswall.Config(yaml.load(open(conf_file, "r").read()), logging.getLogger("smswall"))
+    pool.metrics = pool.conf.metrics
+    try:
+        for i in range(20):
+            pool.handle_incoming(smswall.Message("12345", "1500", None, "test message"))
+            time.sleep(0.1)
+        assert False
+    except smswall.DaemonError as e:
+        pass
+    assert pool.metrics.snapshot()["counters"]["shard_restarts"]["shard0"] >= 1
+    pool.stop_workers()
+    pool.conf.db_conn.close()
+
+class SlowSender(RecordingSender):
+    name = "slow"
+
+    def send_bulk(self, sender, recipients, subject, data):
+        time.sleep(0.2)
+        if data == "(from: 12345) fail":
+            raise IOError("switch went away")
+        RecordingSender.send_bulk(self, sender, recipients, subject, data)
+
+def testcase29():
+    clear()
+    start("Test 29: Handle messages without waiting on sends.")
+    f = smswall.Executor(1).submit(int, "x")
+    try:
+        f.result(1)
+        assert False
+    except ValueError:
+        pass
+
+    env = benchmarks.BenchEnv()
+    sender = SlowSender()
+    wall = smswall.AsyncSMSWall(env.conf, sender, send_workers=10)
+    try:
+        env.message("12345", env.conf.app_number, "create 1500")
+        env.message("12345", "1500", "add 20000 20001")
+        t = time.time()
+        futures = [wall.handle_incoming(smswall.Message("12345", "1500", None, "post %d" % i)) for i in range(10)]
+        futures.append(wall.handle_incoming(smswall.Message("12345", "1500", None, "fail")))
+        for f in futures:
+            f.result(5)
+        # Handled without waiting for the sends, which then overlap.
+        assert time.time() - t < 0.2
+        assert wall.pending() > 0
+        wall.drain()
+        assert time.time() - t < 1.0
+        for i in range(10):
+            assert ("20000", "(from: 12345) post %d" % i) in sender.sent
+        assert wall.pending() == 0
+        counters = env.conf.metrics.snapshot()["counters"]
+        assert counters["send_errors"]["slow"] == 2
+        # Counted once they've gone out, not when they were started.
+        assert counters["sent"]["slow"] == 20
+    finally:
+        wall.close()
+        env.close()
+
+    # A big post is held a few batches at a time, not all at once.
+    class Watching(RecordingSender):
+        name = "watching"
+        queued = []
+        def send_bulk(self, sender, recipients, subject, data):
+            self.queued.append(wall.sender.executor.queue.qsize())
+            time.sleep(0.02)
+            RecordingSender.send_bulk(self, sender, recipients, subject, data)
+    env = benchmarks.BenchEnv()
+    sender = Watching()
+    wall = smswall.AsyncSMSWall(env.conf, sender, send_workers=2)
+    try:
+        sc = benchmarks.generate(env, 1, 10001)[0]
+        wall.handle_incoming(smswall.Message("12345", sc, None, "big post")).result(30)
+        wall.drain()
+        assert len(sender.sent) == 10000
+        assert len(sender.queued) == 20
+        assert max(sender.queued) <= 4
+    finally:
+        wall.close()
+        env.close()
+
+    # With outbox delivery, failed sends stay queued for another try.
+    env = benchmarks.BenchEnv(delivery="outbox")
+    sender = SlowSender()
+    wall = smswall.AsyncSMSWall(env.conf, sender)
+    try:
+        env.message("12345", env.conf.app_number, "create 1500")
+        env.message("12345", "1500", "add 20000 20001")
+        wall.handle_incoming(smswall.Message("12345", "1500", None, "fail")).result(5)
+        env.db.execute("DELETE FROM outbox WHERE job NOT IN (SELECT id FROM outboxjob WHERE body='(from: 12345) fail')")
+        env.db.commit()
+        wall.deliver_pending().result(5)
+        assert env.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 2
+        assert env.conf.metrics.snapshot()["counters"]["send_errors"]["slow"] == 2
+    finally:
+        wall.close()
+        env.close()
+
 """
-Performance tests.
+Performance tests. These run in-process through the benchmarks package, so
+they measure smswall rather than interpreter startup; see benchmarks/run.py
+for the full suite with JSON output.
 """
 def perf1_testcase():
-    clear()
     num = 100
     start("Perf test 1: Create %d lists." % num)
-    t = timeit.Timer('run("python smswall-interactive -t 1000 -f 1234 -m \'create %d\'" % (counter()+3000))', "from __main__ import run, counter")
-    r = t.timeit(num) / num
+    r = benchmarks.bench_create_lists(num)["mean"]
     print "List creation: %s sec per list" % (r)
     assert r < 1 # TODO: pitiful time, need to improve
 
 def perf2_testcase():
-    clear()
     num = 1000
     start("Perf test 2: Create 1 list, handle %d joins." % num)
-    run("python smswall-interactive -t 1000 -f 1234 -m 'create 1500'")
-    t = timeit.Timer('run("python smswall-interactive -t 1500 -f %d -m \'join\'" % (counter()+10000))', "from __main__ import run, counter")
-    r = t.timeit(num) / num
+    r = benchmarks.bench_joins(num)["mean"]
     print "Join: %s sec per list join" % (r)
 
 def perf3_testcase():
-    clear()
     num = 100
     start("Perf test 3: Create 1 list, %d users. Handle %d posts." % (num, num))
-    run("python smswall-interactive -t 1000 -f 1234 -m 'create 1500'")
-    t = timeit.Timer('run("python smswall-interactive -t 1500 -f %d -m \'join\'" % (counter()+10000))', "from __main__ import run, counter")
-    r = t.timeit(num) / num
+    r = benchmarks.bench_joins(num)["mean"]
     print "Join: %s sec per list join" % (r)
-    t = timeit.Timer('run("python smswall-interactive -t 1500 -f 1234 -m testmessage")', "from __main__ import run")
-    r = t.timeit(num) / num
+    r = benchmarks.bench_posts(members=num, posts=num)["mean"]
     print "Post: %s sec per post (sent to %d users, %.5f per user)" % (r, num, r/num)
 
 def perf4_testcase():
-    clear()
     num = 1000
-    start("Perf test 3: Create 1 list, %d users. Handle %d posts." % (num, num))
-    run("python smswall-interactive -t 1000 -f 1234 -m 'create 1500'")
-    t = timeit.Timer('run("python smswall-interactive -t 1500 -f %d -m \'join\'" % (counter()+10000))', "from __main__ import run, counter")
-    r = t.timeit(num) / num
+    start("Perf test 4: Create 1 list, %d users. Handle %d posts." % (num, num))
+    r = benchmarks.bench_joins(num)["mean"]
     print "Join: %s sec per list join" % (r)
-    t = timeit.Timer('run("python smswall-interactive -t 1500 -f 1234 -m testmessage")', "from __main__ import run")
-    r = t.timeit(100) / 100
+    r = benchmarks.bench_posts(members=num, posts=100)["mean"]
     print "Post: %s sec per post (sent to %d users, %.6f per user)" % (r, num, r/num)
 
 def perf5_testcase():
-    clear()
     num = 100
     start("Perf test 5: Create %d lists, 3 users on each, post to every list." % (num))
-    for i in xrange(1, num+1):
-        run("python smswall-interactive -t 1000 -f 12345 -m 'create %d'" % (i+3000))
-        for j in xrange(0,2):
-            run("python smswall-interactive -t %d -f %d -m 'join'" % (i+3000, j + random.randint(100000,200000)))
-    t = timeit.Timer('run("python smswall-interactive -t %d -f 12345 -m testmessage" % (counter()+3000))', "from __main__ import run, counter")
-    r = t.timeit(num) / num
+    r = benchmarks.bench_posts_many_lists(lists=num, members=3)["mean"]
     print "Post: %s sec per post (sent to 3 users, %.5f per user)" % (r, r/3)
 
 def perf6_testcase():
-    clear()
     num = 1000
     start("Perf test 6: Create %d lists, 3 users on each, post to every list." % (num))
-    for i in xrange(1, num+1):
-        run("python smswall-interactive -t 1000 -f 12345 -m 'create %d'" % (i+3000))
-        for j in xrange(0,2):
-            run("python smswall-interactive -t %d -f %d -m 'join'" % (i+3000, j + random.randint(100000,200000)))
-    t = timeit.Timer('run("python smswall-interactive -t %d -f 12345 -m testmessage" % (counter()+3000))', "from __main__ import run, counter")
-    r = t.timeit(num) / num
+    r = benchmarks.bench_posts_many_lists(lists=num, members=3)["mean"]
     print "Post: %s sec per post (sent to 3 users, %.5f per user)" % (r, r/3)
 
 """
 Stress tests -- off by default; if we pass these we pass Burning Man.
 """
 def stress1_testcase():
-    clear()
     num = 100000
-    start("Stress test 1: Create 1 list, %d users. Handle %d posts." % (num, num))
-    run("python smswall-interactive -t 1000 -f 1234 -m 'create 1500'")
-    print "Adding users... "
-    db = sqlite3.connect(db_file)
-    for i in xrange(100000, 200000):
-        db.execute("insert into membership(list, member) values (?,?)", (1500, i))
-    db.commit()
-    print "Users added."
-    t = timeit.Timer('run("python smswall-interactive -t 1500 -f 1234 -m testmessage")', "from __main__ import run")
-    r = t.timeit(100) / 100
+    start("Stress test 1: Create 1 list, %d users. Handle 100 posts." % (num))
+    r = benchmarks.bench_posts(members=num, posts=100)["mean"]
     print "Post: %s sec per post (sent to %d users, %.6f per user)" % (r, num, r/num)
 
 def stress2_testcase():
@@ -366,6 +1157,37 @@ def stress2_testcase():
     r = t.timeit(num) / num
     print "Post: %s sec per post (sent to %d users, %.5f per user)" % (r, num_users, r/num_users)
 
+def stress3_worker(conf, shortcode, first, num):
+    config_dict = yaml.load(open(conf, "r").read())
+    app = smswall.SMSWall(smswall.Config(config_dict, logging.getLogger("smswall")))
+    for i in xrange(first, first + num):
+        app.handle_incoming(smswall.Message(str(i), str(shortcode), None, "join"))
+        app.handle_incoming(smswall.Message(str(i), "1000", None, "setname user%d" % i))
+
+def stress3_testcase():
+    num_procs = 8
+    num = 250
+    start("Stress test 3: %d processes writing concurrently, %d joins and %d renames each, for every DB profile." % (num_procs, num, num))
+    for profile in ["legacy", "default", "safe", "throughput"]:
+        clear()
+        # legacy is the old behaviour, so no retries either
+        conf = write_config(db_profile=profile, db_retries=(0 if profile == "legacy" else 5))
+        run("python smswall-interactive -c %s -t 1000 -f 1234 -m 'create 1500'" % conf)
+        procs = [multiprocessing.Process(target=stress3_worker, args=(conf, 1500, 100000 + p*num, num)) \
+                 for p in range(num_procs)]
+        t = time.time()
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        t = time.time() - t
+        failed = len([p for p in procs if p.exitcode != 0])
+        handled = 2 * (query("select * from membership where list='1500'") - 1)
+        print "Profile %s: %.1f msgs/sec (%d of %d writers died)" % (profile, handled/t, failed, num_procs)
+        if profile != "legacy":
+            assert failed == 0
+            assert query("select * from membership where list='1500'") == num*num_procs + 1
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Tester for smswall. By default, only runs basic tests.")
     parser.add_argument("-b", action="store_true", dest='basic', help="Run basic tests (default: true).")
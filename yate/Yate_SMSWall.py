@@ -1,24 +1,52 @@
 #!/usr/bin/python
+import errno
+import os
+import select
+import sys
+
+# Yate talks to us over stdin. Read it unbuffered, so select() on it sees
+# every message that's waiting rather than just what hasn't been buffered yet.
+# This has to happen before libyate gets hold of sys.stdin.
+sys.stdin = os.fdopen(sys.stdin.fileno(), "r", 0)
+
 from libyate import Yate
 from libvbts import YateMessenger
 import logging
-import sys
 import re
-import time
+import threading
 import smswall
 import yaml
 
+# How long the main loop sleeps with nothing from Yate before it flushes
+# anyway, as a safety net.
+IDLE_FLUSH = 1.0
+
 class YateSender(smswall.Sender):
 
+	name = "yate"
+
 	def __init__(self, smsw):
 		self.smsw = smsw
+		# Inbound and outbox delivery workers send from their own threads,
+		# and they all share the one pipe to Yate with the main loop.
+		self.lock = smsw.lock
 
 	def send_sms(self, sender, recipient, subject, data):
 		sender = str(sender)
 		#sender_name = self.smsw.ym.SR_get("name", ("callerid", sender))
 		#ipaddr = self.smsw.ym.SR_get("ipaddr", ("callerid", sender))
 		#port = str(self.smsw.ym.SR_get("port", ("callerid", sender)))
-		self.smsw.ym.send_smqueue_sms(self.smsw.app, recipient, "%s <sip:%s@127.0.0.1>" % (sender, sender), data)
+		with self.lock:
+			self.smsw.ym.send_smqueue_sms(self.smsw.app, recipient, "%s <sip:%s@127.0.0.1>" % (sender, sender), data)
+
+	def send_bulk(self, sender, recipients, subject, data):
+		sender = str(sender)
+		from_hdr = "%s <sip:%s@127.0.0.1>" % (sender, sender)
+		send = self.smsw.ym.send_smqueue_sms
+		yate = self.smsw.app
+		with self.lock:
+			for r in recipients:
+				send(yate, r, from_hdr, data)
 
 class SMSWall:
 	""" initialize the object """
@@ -29,10 +57,34 @@ class SMSWall:
    		logging.basicConfig(filename="/var/log/smswall.log", level="DEBUG")
 		self.ym = YateMessenger.YateMessenger()
 		self.to_be_handled = to_be_handled
+		self.wall = None
 
 		conf_file = open("/etc/smswall.yaml", "r")
 		config_dict = yaml.load("".join(conf_file.readlines()))
 		self.conf = smswall.Config(config_dict, self.log)
+		self.lock = threading.Lock()
+		self.sender = YateSender(self)
+
+		# This one runs the background workers; incoming messages are handled
+		# by the inbound pool's, one per thread.
+		self.wall = self.make_wall(self.conf.db_conn)
+		self.inbound = smswall.InboundPool(self.conf, lambda: self.make_wall(self.conf.connect()),
+						   self.conf.inbound_workers, self.conf.inbound_depth)
+
+	def make_wall(self, db):
+		wall = smswall.SMSWall(self.conf, db)
+		if self.wall:
+			# Share the main app's sender, so everything is paced by one
+			# bucket (and smqueue gets one pool of connections).
+			wall.set_sender(self.wall.msg_sender, paced=True)
+			# Let inbound workers wake the delivery workers when they queue
+			# a post; start_workers() has run by the time they're built.
+			wall.delivery_pool = self.wall.delivery_pool
+		elif self.conf.sender_type != "smqueue":
+			# With sender_type 'smqueue', SMSWall already talks to smqueue
+			# itself.
+			wall.set_sender(self.sender)
+		return wall
 
 	def yatecall(self, d):
 		if d == "":
@@ -52,22 +104,25 @@ class SMSWall:
  				self.app.Acknowledge()
  				return
 
-			self.app.handled = True
-			self.app.retval = "202"
-			self.app.Acknowledge()
-
 			try:
 				sender = self.ym.SR_get("callerid", ("name", res["caller"]))
 				recipient = res['vbts_tp_dest_address']
 				message = res['vbts_text']
 				msg = smswall.Message(sender, recipient, None, message)
-				app = smswall.SMSWall(self.conf)
-				ys = YateSender(self)
-				app.msg_sender = ys
-				app.handle_incoming(msg)
-
 			except Exception as e:
 				self.app.Output(str(e))
+				msg = None
+
+			# Hand the message to a worker and acknowledge right away, so we
+			# can read the next one while it's handled. If its worker is
+			# backed up, leave it unhandled so smqueue retries it later.
+			if msg is None or self.inbound.submit(msg):
+				self.app.handled = True
+				self.app.retval = "202"
+			else:
+				self.app.handled = False
+				self.log.warning("SMSWall busy (%d queued), refusing %s" % (self.inbound.depth(), self.app.id))
+			self.app.Acknowledge()
 
 		elif d == "answer":
 			self.app.Output("SMSWall Answered: " +  self.app.name + " id: " + self.app.id)
@@ -82,6 +137,17 @@ class SMSWall:
 		for (msg, pri) in self.to_be_handled:
 			self.app.Uninstall(msg)
 
+	def wait_for_yate(self, timeout):
+		""" Block until Yate has written to us, or timeout seconds pass.
+		Returns True if there's something to read. """
+		try:
+			readable, _, _ = select.select([sys.stdin], [], [], timeout)
+		except select.error as e:
+			if e.args[0] == errno.EINTR:
+				return False
+			raise
+		return bool(readable)
+
 	def main(self, priority, regexs):
 		self.regexs = regexs
 		try:
@@ -92,15 +158,23 @@ class SMSWall:
 				self.log.info("Installing %s at %d" % (msg, priority))
 				self.app.Install(msg, priority)
 
+			self.wall.start_workers()
+			self.inbound.start()
+			# Sleep until Yate sends us something, then handle it right away,
+			# rather than polling.
 			while True:
-				self.app.flush()
-				time.sleep(0.1)
+				self.wait_for_yate(IDLE_FLUSH)
+				with self.lock:
+					self.app.flush()
 		except:
 			self.app.Output("Unexpected error:" + str(sys.exc_info()[0]))
 			self.close()
 
 	def close(self):
-		self.uninstall()
+		with self.lock:
+			self.uninstall()
+		self.inbound.stop()
+		self.wall.stop_workers()
 		self.app.close()
 
 def Usage():